@@ -0,0 +1,17 @@
+"""
+Benchmark and load-test suite for the trivia API.
+
+    python -m benchmarks --sizes 10000,100000 --out results.json
+
+Every run seeds a local database (SQLite by default, or the Postgres URL
+given with --database) with synthetic questions, runs the micro
+benchmarks, the load driver, the response encoding comparison and
+the in-memory question store in-process, with no network involved, times cold starts of the app in
+fresh interpreters, and writes one JSON document that can be diffed
+between commits.
+
+    python -m benchmarks --sizes 10000 --asgi 128
+
+adds an ASGI against WSGI comparison of the endpoints flaskr.asgi serves
+natively, at 128 concurrent clients (needs aiosqlite or asyncpg).
+"""
@@ -0,0 +1,138 @@
+"""
+Benchmark and load-test suite.
+
+Seeds a synthetic question bank of each size, runs the micro benchmarks,
+the threaded load test, the compression, store and optional ASGI
+comparisons and the cold start measurements, and prints the results as
+JSON. Every size gets a fresh SQLite file in a temporary directory
+unless --database is given.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+from flaskr import create_app
+from migrations import migrate
+from models import db
+
+from .asgi import run_asgi_comparison
+from .compression import run_compression
+from .data import seed_database, write_sql
+from .load import run_load
+from .micro import run_micro
+from .startup import run_startup
+from .store import run_store
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('--database',
+                        help='SQLAlchemy URL, defaults to a fresh SQLite file per size. '
+                             'Its questions are DELETED and replaced, so it needs --force')
+    parser.add_argument('--force', action='store_true',
+                        help='allow --database, wiping the question bank there')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='comma separated question bank sizes (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='calls per micro benchmark (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per endpoint in the load run (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='load driver threads (default: %(default)s)')
+    parser.add_argument('--asgi', type=int, metavar='CONCURRENCY', nargs='?', const=64,
+                        help='also compare the ASGI and WSGI apps at this concurrency '
+                             '(default when given: %(const)s)')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='cold starts per startup variant, 0 to skip (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sql-out', help='also write the largest bank as insert statements here')
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+    if args.database and not args.force:
+        parser.error('--database {} would have its questions deleted, '
+                     'pass --force if that is what you want'.format(args.database))
+    return args
+
+
+def run_size(database, size, args):
+    app = create_app({'DATABASE_PATH': database})
+    with app.app_context():
+        migrate(db.engine)
+        started = time.perf_counter()
+        inserted = seed_database(size, args.seed)
+        seed_seconds = time.perf_counter() - started
+        dialect = db.engine.dialect.name
+    result = {
+        'seeded': inserted,
+        'seed_seconds': round(seed_seconds, 3),
+        'micro': run_micro(app, size, args.iterations, args.seed),
+        'load': run_load(app, size, args.requests, args.concurrency, args.seed),
+        'compression': run_compression(app, args.iterations),
+        'store': run_store(app, size, args.iterations, args.seed),
+    }
+    if args.asgi:
+        result['asgi'] = run_asgi_comparison(app, size, args.requests, args.asgi, args.seed)
+    return dialect, result
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    workdir = tempfile.mkdtemp(prefix='trivia-bench-')
+
+    results = {}
+    dialect = None
+    for size in sizes:
+        database = args.database or 'sqlite:///{}'.format(
+            os.path.join(workdir, 'bench-{}.db'.format(size)))
+        dialect, results[str(size)] = run_size(database, size, args)
+
+    startup = None
+    if args.startup_runs:
+        startup = run_startup(database, args.startup_runs)
+
+    if args.sql_out:
+        write_sql(args.sql_out, max(sizes), args.seed)
+
+    document = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'dialect': dialect,
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'requests_per_endpoint': args.requests,
+            'concurrency': args.concurrency,
+            'asgi_concurrency': args.asgi,
+        },
+        'results': results,
+        'startup': startup,
+    }
+    encoded = json.dumps(document, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as out:
+            out.write(encoded + '\n')
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+ASGI against WSGI under high concurrency.
+
+The endpoints served natively by flaskr.asgi are driven twice: through
+the WSGI stack by ``concurrency`` threads (see load.hammer) and through
+the ASGI app by ``concurrency`` tasks on one event loop. Both run
+in-process against the same database.
+"""
+import asyncio
+import json
+import time
+
+from flaskr.asgi import TriviaASGI
+
+from .load import endpoint_requests, hammer
+from .timing import summarize
+
+NATIVE_ENDPOINTS = ('GET /categories', 'GET /questions',
+                    'GET /categories/<id>/questions', 'POST /quizzes')
+
+
+async def asgi_call(asgi_app, method, path, body=None):
+    """Run one request through ``asgi_app`` and return (status, body)."""
+    status, _, body = await asgi_request(asgi_app, method, path, body)
+    return status, body
+
+
+async def asgi_request(asgi_app, method, path, body=None, headers=()):
+    """
+    Run one request with the extra (name, value) ``headers`` through
+    ``asgi_app`` and return (status, response headers by name, body).
+    """
+    path, _, query = path.partition('?')
+    payload = b'' if body is None else json.dumps(body).encode('utf-8')
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query.encode('latin-1'),
+        'headers': [(b'content-type', b'application/json')] + [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        'server': ('localhost', 80),
+    }
+    messages = [{'type': 'http.request', 'body': payload}]
+    response = {'status': None, 'headers': {}, 'body': []}
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {name.decode('latin-1'): value.decode('latin-1')
+                                   for name, value in message['headers']}
+        else:
+            response['body'].append(message.get('body', b''))
+
+    await asgi_app(scope, receive, send)
+    return response['status'], response['headers'], b''.join(response['body'])
+
+
+async def swarm(asgi_app, make_request, total, concurrency):
+    latencies = []
+    errors = [0]
+    remaining = [total]
+
+    async def worker():
+        while remaining[0]:
+            remaining[0] -= 1
+            method, path, body = make_request()
+            started = time.perf_counter()
+            status, _ = await asgi_call(asgi_app, method, path, body)
+            latencies.append(time.perf_counter() - started)
+            if status >= 500:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+def run_asgi_comparison(app, size, requests_per_endpoint=500, concurrency=64, seed=0):
+    asgi_app = TriviaASGI(app)
+    requests = [(name, make_request) for name, make_request in endpoint_requests(size, seed=seed)
+                if name in NATIVE_ENDPOINTS]
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        loop.run_until_complete(asgi_app.connect())
+        for name, make_request in requests:
+            results[name] = {
+                'wsgi': hammer(app, make_request, requests_per_endpoint, concurrency),
+                'asgi': loop.run_until_complete(
+                    swarm(asgi_app, make_request, requests_per_endpoint, concurrency)),
+            }
+    finally:
+        loop.run_until_complete(asgi_app.close())
+        loop.close()
+    return results
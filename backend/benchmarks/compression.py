@@ -0,0 +1,51 @@
+"""
+Bytes on the wire and CPU cost of each response encoding.
+
+Real responses are rendered uncompressed through the app, in both the
+object and the columnar shape, then encoded with every gzip level and
+Brotli quality of interest. The encoding cost is measured on its own.
+"""
+from models import Question
+from flaskr.compression import brotli, compress
+from flaskr.serialization import dumps, ordered, question_dict, question_rows, shape_questions
+
+from .timing import measure
+
+ENCODINGS = [('gzip', 1), ('gzip', 6), ('gzip', 9), ('br', 4), ('br', 11)]
+LARGE_LISTING = 1000
+
+
+def payloads(app):
+    client = app.test_client()
+    bodies = {}
+    for path in ['/categories',
+                 '/questions?page=1', '/questions?page=1&shape=columns',
+                 '/categories/1/questions', '/categories/1/questions?shape=columns']:
+        bodies['GET ' + path] = client.get(path, headers={'Accept-Encoding': 'identity'}).data
+    with app.app_context():
+        questions = [question_dict(row) for row in
+                     question_rows(Question.query).order_by(Question.id).limit(LARGE_LISTING)]
+    for shape in ('objects', 'columns'):
+        bodies['{} questions ({})'.format(len(questions), shape)] = \
+            dumps(ordered({'questions': shape_questions(questions, shape)})) + b'\n'
+    return bodies
+
+
+def run_compression(app, iterations=200):
+    results = {}
+    for name, body in payloads(app).items():
+        entry = {'identity': {'bytes': len(body)}}
+        for encoding, level in ENCODINGS:
+            if encoding == 'br' and brotli is None:
+                continue
+            encoded = compress(body, encoding, level=level, brotli_quality=level)
+            timing = measure(lambda: compress(body, encoding, level=level, brotli_quality=level),
+                             iterations)
+            entry['{}-{}'.format(encoding, level)] = {
+                'bytes': len(encoded),
+                'ratio': round(len(encoded) / len(body), 3) if body else None,
+                'p50_ms': timing['p50_ms'],
+                'mean_ms': timing['mean_ms'],
+            }
+        results[name] = entry
+    return results
@@ -0,0 +1,66 @@
+"""
+Synthetic question bank.
+
+Questions are generated deterministically from a seed, in the shape of
+questions.txt, and can either be written as insert statements or loaded
+straight into the database through the bulk import pipeline.
+"""
+import random
+
+from models import Category, Question, db
+from flaskr.bulk_import import import_questions
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+
+SUBJECTS = ['boxer', 'painter', 'river', 'planet', 'movie', 'team', 'element',
+            'composer', 'empire', 'novel', 'mountain', 'inventor']
+VERBS = ['discovered', 'won', 'painted', 'founded', 'crossed', 'wrote',
+         'invented', 'named', 'defeated', 'directed']
+OBJECTS = ['in 1930', 'the first World Cup', 'the Mona Lisa', 'Lake Victoria',
+           'the periodic table', 'the Nile', 'peanut butter', 'an Oscar']
+
+
+def generate_questions(count, seed=0):
+    """Yield ``count`` question records with ids starting at 1."""
+    rng = random.Random(seed)
+    for number in range(1, count + 1):
+        yield {
+            'id': number,
+            'question': 'Which {} {} {}? (#{})'.format(
+                rng.choice(SUBJECTS), rng.choice(VERBS), rng.choice(OBJECTS), number),
+            'answer': '{} {}'.format(rng.choice(SUBJECTS).title(), number),
+            'difficulty': rng.randint(1, 5),
+            'category': rng.randint(1, len(CATEGORIES)),
+        }
+
+
+def write_sql(path, count, seed=0):
+    """Write questions.txt style insert statements to ``path``."""
+    with open(path, 'w', encoding='utf-8') as out:
+        for record in generate_questions(count, seed):
+            out.write(
+                "insert into questions (id, question, answer, difficulty, category) "
+                "values ({id},'{question}','{answer}',{difficulty},{category});\n".format(
+                    **dict(record,
+                           question=record['question'].replace("'", "''"),
+                           answer=record['answer'].replace("'", "''"))))
+
+
+def seed_database(count, seed=0):
+    """
+    Replace the question bank with ``count`` generated questions. This
+    deletes every question of the database; __main__ only points it at a
+    database of its own unless --force is given.
+    """
+    if Category.query.count() == 0:
+        for category_type in CATEGORIES:
+            db.session.add(Category(category_type))
+        db.session.commit()
+    Question.query.delete()
+    db.session.commit()
+
+    records = ((number, record) for number, record in
+               enumerate(generate_questions(count, seed), 1))
+    category_ids = set(category.id for category in Category.query)
+    summary = import_questions(records, category_ids)
+    return summary['inserted']
@@ -0,0 +1,71 @@
+"""
+End-to-end load driver.
+
+Each endpoint is hammered through the full WSGI stack by ``concurrency``
+threads, each with its own test client, and the latency of every
+request is recorded. No sockets are opened.
+"""
+import random
+import threading
+import time
+
+from .timing import summarize
+
+
+def endpoint_requests(size, categories=6, seed=0):
+    """(name, request factory) pairs; a factory returns (method, path, json)."""
+    rng = random.Random(seed)
+    last_page = max(size // 10, 1)
+    words = ['boxer', 'river', 'won', 'planet', 'movie', 'the']
+    return [
+        ('GET /categories',
+         lambda: ('GET', '/categories', None)),
+        ('GET /questions',
+         lambda: ('GET', '/questions?page={}'.format(rng.randint(1, last_page)), None)),
+        ('GET /categories/<id>/questions',
+         lambda: ('GET', '/categories/{}/questions'.format(rng.randint(1, categories)), None)),
+        ('POST /questions (search)',
+         lambda: ('POST', '/questions', {'searchTerm': rng.choice(words)})),
+        ('POST /quizzes',
+         lambda: ('POST', '/quizzes', {
+             'previous_questions': [rng.randint(1, size) for _ in range(rng.randint(0, 4))],
+             'quiz_category': {'id': rng.randint(0, categories)}})),
+    ]
+
+
+def hammer(app, make_request, total, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+                method, path, body = make_request()
+            started = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 500:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+def run_load(app, size, requests_per_endpoint=500, concurrency=8, seed=0):
+    return {
+        name: hammer(app, make_request, requests_per_endpoint, concurrency)
+        for name, make_request in endpoint_requests(size, seed=seed)
+    }
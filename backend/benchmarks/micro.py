@@ -0,0 +1,67 @@
+"""
+Micro benchmarks of the hot helpers, called directly inside a request
+context so that routing and the WSGI layer are left out.
+"""
+import json
+import random
+
+from flask import request
+
+from models import Question, db
+from flaskr import load_category_dictionary, retrieve_category_dictionary
+from flaskr.pagination import QUESTIONS_PER_PAGE, encode_cursor, listing_steps
+from flaskr.reads import run, session_fetch
+
+from .timing import measure
+
+
+def run_micro(app, size, iterations=200, seed=0):
+    rng = random.Random(seed)
+    last_page = max(size // QUESTIONS_PER_PAGE, 1)
+    results = {}
+
+    trivia = app.extensions['trivia']
+
+    def paginate(path):
+        # the steps of the GET /questions view, without its response cache
+        def call():
+            with app.test_request_context(path):
+                run(listing_steps(request.args, trivia['counts'], trivia['category_cache'],
+                                  store=trivia['question_store']), session_fetch)
+        return call
+
+    with app.app_context():
+        deep_id = db.session.query(Question.id).order_by(Question.id) \
+            .offset(max(size - QUESTIONS_PER_PAGE - 1, 0)).limit(1).scalar() or 0
+        question_ids = [row[0] for row in db.session.query(Question.id).limit(1000)]
+
+    results['listing_steps.first_page'] = measure(
+        paginate('/questions?page=1'), iterations)
+    results['listing_steps.last_page_offset'] = measure(
+        paginate('/questions?page={}'.format(last_page)), iterations)
+    results['listing_steps.last_page_cursor'] = measure(
+        paginate('/questions?after_id={}'.format(encode_cursor(deep_id))), iterations)
+
+    with app.app_context():
+        results['retrieve_category_dictionary.cached'] = measure(
+            retrieve_category_dictionary, iterations)
+        results['retrieve_category_dictionary.uncached'] = measure(
+            load_category_dictionary, iterations)
+
+    get_quiz = app.view_functions['get_quiz']
+
+    def quiz(previous_count):
+        def call():
+            body = json.dumps({
+                'previous_questions': rng.sample(question_ids, min(previous_count, len(question_ids))),
+                'quiz_category': {'id': rng.randint(0, 6)}
+            })
+            with app.test_request_context('/quizzes', method='POST', data=body,
+                                          content_type='application/json'):
+                get_quiz()
+        return call
+
+    results['get_quiz.no_previous'] = measure(quiz(0), iterations)
+    results['get_quiz.50_previous'] = measure(quiz(50), iterations)
+    return results
+
@@ -0,0 +1,55 @@
+"""
+Cold start cost of a worker.
+
+Each run is a fresh interpreter that imports the app, builds it with
+create_app and serves its first request (GET /categories), timing every
+step. The "migrate_on_boot" variant also runs the migration check right
+after create_app, which is what every worker used to do before schema
+changes moved to the `flask migrate` step.
+"""
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import flaskr
+imported = time.perf_counter()
+app = flaskr.create_app({'DATABASE_PATH': sys.argv[1]})
+if sys.argv[2] == 'migrate_on_boot':
+    from migrations import migrate
+    from models import db
+    with app.app_context():
+        migrate(db.engine)
+created = time.perf_counter()
+status = app.test_client().get('/categories').status_code
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000,
+                  'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000,
+                  'total_ms': (served - started) * 1000,
+                  'status': status}))
+'''
+
+
+def cold_start(database, mode):
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT, database, mode],
+                                     cwd=BACKEND, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run_startup(database, runs=5):
+    results = {}
+    for mode in ('lazy', 'migrate_on_boot'):
+        samples = [cold_start(database, mode) for _ in range(runs)]
+        results[mode] = {
+            key: round(median(sample[key] for sample in samples), 3)
+            for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms')
+        }
+        results[mode]['runs'] = runs
+    return results
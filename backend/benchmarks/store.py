@@ -0,0 +1,57 @@
+"""
+The question store, with its columns in process memory and in a shared
+snapshot file: full load time, memory per question (and projected per
+million questions) and the cost of its reads next to an idle change
+feed poll.
+"""
+import os
+import random
+import tempfile
+import time
+
+from flaskr import create_app
+from flaskr.pagination import QUESTIONS_PER_PAGE
+
+from .timing import measure
+
+MILLION = 1000000
+
+
+def run_store_variant(app, setting, size, iterations, rng):
+    store_app = create_app({'DATABASE_PATH': app.config['SQLALCHEMY_DATABASE_URI'],
+                            'QUESTION_STORE': setting})
+    store = store_app.extensions['trivia']['question_store']
+
+    started = time.perf_counter()
+    store.sync()
+    load_seconds = time.perf_counter() - started
+    memory = store.stats()['memory']
+    last_page = max(size // QUESTIONS_PER_PAGE, 1)
+    question_ids = [row[0] for row in store.index_rows()[:1000]]
+
+    def poll():
+        store.mark_stale()
+        store.sync()
+
+    return {
+        'load_seconds': round(load_seconds, 3),
+        'memory': memory,
+        'projected_mb_per_million': round(memory['per_question'] * MILLION / 2 ** 20, 1),
+        'page.first': measure(lambda: store.page(None, 1), iterations),
+        'page.last_offset': measure(lambda: store.page(None, last_page), iterations),
+        'page.category': measure(lambda: store.page(rng.randint(1, 6), 1), iterations),
+        'questions.10': measure(lambda: store.questions(rng.sample(question_ids,
+                                                                   min(10, len(question_ids)))),
+                                iterations),
+        'sync.idle_poll': measure(poll, iterations),
+    }
+
+
+def run_store(app, size, iterations=200, seed=0):
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix='trivia-store-')
+    snapshot = 'snapshot://' + os.path.join(workdir, 'questions.snapshot')
+    return {
+        'memory': run_store_variant(app, 'memory://', size, iterations, rng),
+        'snapshot': run_store_variant(app, snapshot, size, iterations, rng),
+    }
@@ -0,0 +1,43 @@
+import math
+import time
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    # rounded first so float noise such as 0.07 * 100 = 7.000000000000001 does not bump the rank
+    rank = max(math.ceil(round(fraction * len(ordered), 9)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """Latency summary in milliseconds, plus RPS when ``elapsed`` is given."""
+    ordered = sorted(latencies)
+    summary = {
+        'count': len(ordered),
+        'errors': errors,
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        'p50_ms': None,
+        'p95_ms': None,
+        'p99_ms': None,
+    }
+    for name, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        value = percentile(ordered, fraction)
+        summary[name] = None if value is None else round(value * 1000, 3)
+    if elapsed:
+        summary['rps'] = round(len(ordered) / elapsed, 1)
+    return summary
+
+
+def measure(function, iterations, warmup=3):
+    """Call ``function`` repeatedly and summarize the per-call latency."""
+    for _ in range(warmup):
+        function()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
@@ -1,42 +1,125 @@
-import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import click
+from flask import (Flask, Response, current_app, g, has_app_context, request, abort, jsonify,
+                   stream_with_context)
 from flask_cors import CORS
-import random
-from pprint import pprint
-import traceback
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
 
-from models import setup_db, Question, Category, db
+from models import setup_db, database_path, REPLICA_BIND, Question, Category, RoutingSession, db
+from migrations import migrate
+from .pagination import CountCache, listing_steps
+from .reads import CATEGORIES_SQL, run, session_fetch
+from .sampling import QuestionIdIndex, quiz_batch_size, quiz_steps
+from .quiz_sessions import make_session_store
+from .search import SearchIndex
+from .cache import CachedValue, ResponseCache, make_response_store
+from .bulk_import import BATCH_SIZE, import_questions, read_csv, read_ndjson, validate
+from .export import MIMETYPES, export_stream
+from .serialization import SHAPES, json_response, shape_questions
+from .compression import compress_response, init_compression, negotiate
+from .instrumentation import finish_request, init_instrumentation
+from .stats import reconcile, stats_summary
+from .question_store import CHANGE_FEED_KEEP, make_question_store, prune_changes
+from .answers import AnswerChecker
+from .duplicates import (SIMILARITY_THRESHOLD, duplicates_report, find_duplicates,
+                         index_questions, index_unsigned, write_report)
+from .write_behind import make_write_behind, replay_logs
 
-QUESTIONS_PER_PAGE = 10
+CATEGORY_CACHE_TTL = 5 * 60
+
+# read-only POST endpoints that may be served from the read replica
+REPLICA_ENDPOINTS = {'search_question_by_string', 'get_quiz', 'get_next_session_question',
+                     'check_quiz_answer'}
 
-def paginate_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page-1)*10
-    end = start + QUESTIONS_PER_PAGE
-    
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-    return current_questions
+
+def load_category_dictionary():
+    return {category_id: category_type
+            for category_id, category_type in session_fetch(CATEGORIES_SQL)}
 
 def retrieve_category_dictionary():
-    categories = Category.query.order_by(Category.id).all()
-    cat_dict = {}
-    for cat in categories:
-        cat_dict[cat.id] = cat.type
-    return cat_dict
-        
+    """The category dictionary, through the category cache of the current app."""
+    return current_app.extensions['trivia']['category_cache'].get()
+
+def reads_from_replica(app, method, endpoint):
+    """Whether a request to ``endpoint`` may be served from the read replica."""
+    return (REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+            and (method in ('GET', 'HEAD') or endpoint in REPLICA_ENDPOINTS))
+
+def note_category_change(mapper, connection, target):
+    object_session(target).info['categories_changed'] = True
+
+def categories_committed(session):
+    # acted on after the commit, so no reader caches the old categories again
+    if session.info.pop('categories_changed', False) and has_app_context():
+        trivia = current_app.extensions.get('trivia')
+        if trivia is not None:
+            trivia['categories_changed']()
+
+def categories_rolled_back(session):
+    session.info.pop('categories_changed', None)
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Category, _event, note_category_change)
+event.listen(RoutingSession, 'after_commit', categories_committed)
+event.listen(RoutingSession, 'after_rollback', categories_rolled_back)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get('DATABASE_PATH', database_path))
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
-    CORS(app)
-    cors = CORS(app, resouces={r"/api/*": {"origins": "*"}})
+    CORS(app, resources={r"/*": {"origins": "*"}})
+    init_instrumentation(app)
+    init_compression(app)
+
+    @app.before_request
+    def route_reads_to_replica():
+        g.read_replica = reads_from_replica(app, request.method, request.endpoint)
+
+    # per app, as apps of one process may point at different databases. The
+    # response cache version retires cached categories too, in every worker
+    # sharing it (see cache.py)
+    response_cache = ResponseCache(make_response_store(app.config.get('RESPONSE_CACHE')))
+    category_cache = CachedValue(load_category_dictionary, CATEGORY_CACHE_TTL,
+                                 version=response_cache.store.current_version)
+    counts = CountCache()
+    question_store = make_question_store(app, app.config.get('QUESTION_STORE'))
+    question_index = QuestionIdIndex(store=question_store)
+    quiz_sessions = make_session_store(app.config.get('QUIZ_SESSION_STORE'))
+    search_index = SearchIndex()
+    answer_checker = AnswerChecker()
+
+    def question_bank_changed():
+        counts.clear()
+        question_index.invalidate()
+        search_index.invalidate()
+        response_cache.bump()
+        answer_checker.invalidate()
+        if question_store is not None:
+            question_store.mark_stale()
+
+    def categories_changed():
+        category_cache.invalidate()
+        question_bank_changed()
+
+    write_behind = make_write_behind(app, app.config.get('QUESTION_WRITE_BEHIND'),
+                                     on_flush=question_bank_changed)
+
+    app.extensions['trivia'] = {
+        'category_cache': category_cache,
+        'counts': counts,
+        'question_store': question_store,
+        'write_behind': write_behind,
+        'question_index': question_index,
+        'response_cache': response_cache,
+        'question_bank_changed': question_bank_changed,
+        'categories_changed': categories_changed,
+    }
 
     """
     @TODO: Use the after_request decorator to set Access-Control-Allow
@@ -46,7 +129,7 @@ def create_app(test_config=None):
     def after_request(response):
         response.headers.add('ACCESS-CONTROL-ALLOW-HEADERS','Content-Type,Authorization,true')
         response.headers.add('ACCESS-CONTROL-ALLOW-METHODS','GET, PUT, POST, DELETE, OPTIONS')
-        return response
+        return finish_request(app, compress_response(app, response))
 
     """
     @TODO:Create an endpoint to handle GET requests for all categories.
@@ -54,14 +137,59 @@ def create_app(test_config=None):
     """
     
     @app.route('/categories', methods=['GET'])
+    @response_cache.cached
     def get_all_categories():
         categories = retrieve_category_dictionary()
         if len(categories) == 0:
             abort(404)
 
-        return jsonify({
+        response = jsonify({
             'categories': categories
         })
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(CATEGORY_CACHE_TTL)
+        return response
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        summary = stats_summary(retrieve_category_dictionary())
+        summary['success'] = True
+        return jsonify(summary)
+
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Bring the database schema up to date."""
+        applied = migrate(db.engine)
+        if applied:
+            click.echo('applied migrations: {}'.format(', '.join(str(version) for version in applied)))
+        else:
+            click.echo('schema is up to date')
+
+    @app.cli.command('reconcile-stats')
+    def reconcile_stats_command():
+        """Recount the question_stats table from the questions table."""
+        reconcile()
+        db.session.commit()
+        question_bank_changed()
+        click.echo('question stats rebuilt')
+
+    @app.cli.command('prune-question-changes')
+    @click.option('--keep', default=CHANGE_FEED_KEEP, show_default=True,
+                  help='Number of newest change feed entries to keep.')
+    def prune_question_changes_command(keep):
+        """Trim the question_changes feed followed by QUESTION_STORE."""
+        pruned = prune_changes(keep)
+        db.session.commit()
+        click.echo('pruned {} change feed entries'.format(pruned))
+
+    @app.route('/cache/stats', methods=['GET'])
+    def get_cache_stats():
+        return jsonify({
+            'categories': category_cache.stats(),
+            'responses': response_cache.stats(),
+            'answers': answer_checker.stats(),
+            'questions': question_store.stats() if question_store is not None else None,
+            'write_behind': write_behind.stats() if write_behind is not None else None
+        })
 
     """
     @TODO: Create an endpoint to handle GET requests for questions,
@@ -71,23 +199,10 @@ def create_app(test_config=None):
     """
     
     @app.route('/questions', methods=['GET'])
+    @response_cache.cached
     def get_a_page_of_questions():
-        page=request.args.get('page', 1, type=int)
-        start=(page-1) * QUESTIONS_PER_PAGE
-        end=start+10
-        body=request.get_json()
-        questions = Question.query.order_by(Question.id).all()
-        
-        if len(questions[start:end]) == 0:
-            abort(404)
-        else:
-            json_formatted_questions = [question.format() for question in questions]
-            return jsonify({
-                'questions': json_formatted_questions[start:end],
-                'total_questions': len(questions),
-                'categories': retrieve_category_dictionary(),
-                'current_category': "all"
-            })
+        return json_response(run(listing_steps(request.args, counts, category_cache,
+                                               store=question_store), session_fetch))
           
        
     """
@@ -99,26 +214,82 @@ def create_app(test_config=None):
     @TODO: Create an endpoint to DELETE question using a question ID.
     DONE
     """
-    @app.route('/questions/<question_id>', methods=['DELETE'])         
+    @app.route('/questions/<question_id>', methods=['DELETE'])
     def delete_a_question(question_id):
         try:
-            if len(Question.query.filter_by(id=question_id).all()) == 1:
-                Question.query.filter_by(id=question_id).delete()
-                db.session.commit()
-                return jsonify({
-                    'question_id': question_id
-                })
-            else:
-                abort(404)
-        except:
-            db.session.rollback()
+            ids = [int(question_id)]
+        except ValueError:
             abort(404)
-        finally:
-            db.session.close()
-            
-        
-              
-    
+        if not Question.delete_many(ids):
+            abort(404)
+        db.session.commit()
+        question_bank_changed()
+        return jsonify({
+            'question_id': question_id,
+            'deleted': 1
+        })
+
+    """
+    Batch delete: the body is {"ids": [...]}, removed in one statement.
+    Ids that did not exist are reported back in not_found.
+    """
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions():
+        body = request.get_json(silent=True) or {}
+        ids = body.get('ids') if isinstance(body, dict) else None
+        if (not isinstance(ids, list) or not ids
+                or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids)):
+            abort(422)
+
+        deleted = Question.delete_many(ids)
+        db.session.commit()
+        if deleted:
+            question_bank_changed()
+        return jsonify({
+            'success': True,
+            'deleted': len(deleted),
+            'question_ids': sorted(deleted),
+            'not_found': sorted(set(ids) - deleted)
+        })
+
+    """
+    Near duplicates of a question, most similar first, see duplicates.py.
+    ?threshold= (0 to 1, default 0.6) is the least estimated similarity.
+    """
+    @app.route('/questions/<int:question_id>/duplicates', methods=['GET'])
+    @response_cache.cached
+    def get_question_duplicates(question_id):
+        threshold = request.args.get('threshold', SIMILARITY_THRESHOLD, type=float)
+        if not 0 < threshold <= 1:
+            abort(400)
+        question = Question.query.get(question_id)
+        if question is None:
+            abort(404)
+
+        duplicates = find_duplicates(question, threshold)
+        return json_response({
+            'success': True,
+            'question_id': question_id,
+            'duplicates': duplicates,
+            'total_duplicates': len(duplicates)
+        })
+
+    @app.cli.command('index-duplicates')
+    @click.option('--processes', type=int, help='Defaults to one per core.')
+    def index_duplicates_command(processes):
+        """Compute the duplicate detection signatures missing from the bank."""
+        click.echo('signed {} questions'.format(index_unsigned(processes)))
+
+    @app.cli.command('duplicates-report')
+    @click.option('--threshold', default=SIMILARITY_THRESHOLD, show_default=True)
+    @click.option('--processes', type=int, help='Defaults to one per core.')
+    @click.option('--out', type=click.File('w'), default='-', help='Defaults to stdout.')
+    def duplicates_report_command(threshold, processes, out):
+        """Group the whole bank into clusters of near-duplicate questions."""
+        rows = db.session.query(Question.id, Question.question).order_by(Question.id)
+        report = duplicates_report([tuple(row) for row in rows], threshold, processes)
+        write_report(report, out)
+
     """
     TEST: Click trash icon next to a question to removed the ?
     This removal will persist in the DB and when you refresh the page.
@@ -131,6 +302,16 @@ def create_app(test_config=None):
     
     @app.route('/questions/add', methods=['POST'])
     def add_question():
+        if write_behind is not None:
+            # acknowledged once logged, inserted by the next flush (write_behind.py)
+            row = validate(request.get_json(silent=True), retrieve_category_dictionary())
+            if isinstance(row, str):
+                abort(422)
+            write_behind.append(row)
+            return jsonify({
+                'result': 'added',
+                'queued': True
+            })
         try:
             body = request.get_json()
             question = body.get('question')
@@ -140,17 +321,87 @@ def create_app(test_config=None):
             new_question = Question(question=question, answer=answer, difficulty=difficulty, category=category)
                                             
             db.session.add(new_question)
+            db.session.flush()
+            index_questions([(new_question.id, new_question.question)])
             db.session.commit()
+            question_bank_changed()
             return jsonify({
                 'result': 'added'
             })
         except:
             db.session.rollback()
             abort(422)
-        finally:
-            db.session.close()
    
 
+    """
+    Bulk import: the body is streamed as NDJSON, or as CSV when sent
+    with a text/csv content type or ?format=csv.
+    """
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_add_questions():
+        if request.args.get('format') == 'csv' or request.mimetype == 'text/csv':
+            records = read_csv(request.stream)
+        else:
+            records = read_ndjson(request.stream)
+
+        summary = import_questions(records, retrieve_category_dictionary())
+        if summary['inserted'] == 0 and summary['rejected'] == 0:
+            abort(400)
+        if summary['inserted']:
+            question_bank_changed()
+
+        summary['success'] = True
+        return jsonify(summary)
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']),
+                  help='Defaults to csv for .csv files and ndjson otherwise.')
+    @click.option('--batch-size', default=BATCH_SIZE, show_default=True)
+    def import_questions_command(path, file_format, batch_size):
+        """Import questions from an NDJSON or CSV file."""
+        if file_format is None:
+            file_format = 'csv' if path.endswith('.csv') else 'ndjson'
+        with open(path, encoding='utf-8', newline='') as source:
+            reader = read_csv if file_format == 'csv' else read_ndjson
+            summary = import_questions(reader(source), retrieve_category_dictionary(),
+                                       batch_size=batch_size)
+        question_bank_changed()
+        for error in summary['errors']:
+            click.echo('line {line}: {error}'.format(**error), err=True)
+        click.echo('inserted {inserted}, rejected {rejected}'.format(**summary))
+
+    @app.cli.command('replay-question-log')
+    @click.option('--directory', help='Defaults to QUESTION_WRITE_BEHIND.')
+    def replay_question_log_command(directory):
+        """Insert the questions left in the write-behind logs of stopped processes."""
+        directory = directory or app.config.get('QUESTION_WRITE_BEHIND')
+        if not directory:
+            raise click.UsageError('no write-behind log directory configured')
+        inserted, dropped = replay_logs(directory, app.logger)
+        if inserted:
+            question_bank_changed()
+        click.echo('replayed {}, dropped {}'.format(inserted, dropped))
+
+    @app.route('/questions/export', methods=['GET'])
+    def export_questions():
+        file_format = request.args.get('format', 'ndjson')
+        if file_format not in MIMETYPES:
+            abort(400)
+        # the export only streams gzip, so only a gzip the client accepts counts
+        gzip = negotiate(request.headers.get('Accept-Encoding'), ('gzip',)) == 'gzip'
+
+        stream = export_stream(file_format,
+                               category=request.args.get('category', type=int),
+                               difficulty=request.args.get('difficulty', type=int),
+                               gzip=gzip)
+        response = Response(stream_with_context(stream), mimetype=MIMETYPES[file_format])
+        response.headers['Content-Disposition'] = 'attachment; filename=questions.{}'.format(file_format)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
     """
     @TODO:
     Create a POST endpoint to get questions based on a search term.
@@ -160,16 +411,20 @@ def create_app(test_config=None):
     def search_question_by_string():
         body = request.get_json()
         searchTerm=body.get('searchTerm')
+        page=body.get('page', 1)
+        shape=body.get('shape', 'objects')
+        if not isinstance(page, int) or page < 1 or shape not in SHAPES:
+            abort(400)
+        if searchTerm is not None and not isinstance(searchTerm, str):
+            abort(400)
         
-        questions = Question.query.filter(Question.question.ilike("%" + searchTerm + "%")).order_by(Question.id).all()
-        
-        data = []
-        for question in questions:
-            data.append(question.format())
+        results = search_index.search(searchTerm,
+                                      include_answers=bool(body.get('include_answers')),
+                                      page=page)
         
-        return jsonify({
-            'questions': data,
-            'totalQuestions': len(questions),
+        return json_response({
+            'questions': shape_questions(results.questions, shape),
+            'totalQuestions': results.total,
             'currentCategory': "All"
         })
 
@@ -181,18 +436,10 @@ def create_app(test_config=None):
     category to be shown.
     """
     @app.route('/categories/<int:category_id>/questions')
+    @response_cache.cached
     def get_questions_for_selected_category(category_id):
-        questions = Question.query.filter_by(category=category_id).order_by(Question.id).all()
-        
-        if len(questions) == 0:
-            abort(404)
-        
-        json_formatted_questions = [question.format() for question in questions]
-        return jsonify({
-            'questions': json_formatted_questions,
-            'total_questions': len(questions),
-            'current_category': retrieve_category_dictionary()[category_id]
-        })
+        return json_response(run(listing_steps(request.args, counts, category_cache, category_id,
+                                               store=question_store), session_fetch))
     
     
     """
@@ -201,27 +448,103 @@ def create_app(test_config=None):
     This endpoint should take category and previous question parameters
     and return a random questions within the given category,
     if provided, and that is not one of the previous questions.
+
+    Optional: "difficulty" (1-5) weights the draw towards that difficulty
+    and "ramp": true raises it as the quiz goes on. Questions served least
+    recently are preferred either way. With "count" (up to 50) the next
+    questions of the quiz come back at once in "questions".
     """
     @app.route('/quizzes', methods=['POST'])
     def get_quiz():
+        question_index.ensure_loaded()
+        steps = quiz_steps(question_index, request.get_json(silent=True), app.logger)
+        return json_response(run(steps, session_fetch))
+        
+
+    """
+    Answer checking: the body is {"question_id": 1, "answer": "..."}.
+    Case, accents, punctuation and a leading article do not matter and
+    a typo every few letters is forgiven, see answers.py.
+    """
+    @app.route('/quizzes/answer', methods=['POST'])
+    def check_quiz_answer():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+        question_id = body.get('question_id')
+        guess = body.get('answer')
+        if (not isinstance(question_id, int) or isinstance(question_id, bool)
+                or not isinstance(guess, str)):
+            abort(422)
+
+        compiled = answer_checker.compiled(
+            question_id, lambda question_id: question_index.fetch([question_id]).get(question_id))
+        if compiled is None:
+            abort(404)
+        verdict = compiled.check(guess)
+        return jsonify({
+            'success': True,
+            'question_id': question_id,
+            'correct': verdict.correct,
+            'answer': compiled.answer
+        })
+
+    """
+    Quiz sessions: the server keeps the ids already played, so the client
+    no longer resends its previous questions every turn. With "count"
+    (up to 50) in the body of /next, the next questions of the session come
+    back at once in "questions", like POST /quizzes.
+    """
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
         try:
             body = request.get_json()
-            previous_questions=body.get('previous_questions',None)
-            quiz_category=body.get('quiz_category')
-            category_id=quiz_category['id']
-            if (category_id != 0):
-                questions = db.session.query(Question).filter(Question.category==category_id, Question.id.notin_(previous_questions)).order_by(Question.id).all()
-                question = random.choice(questions)
-            else:
-                questions = db.session.query(Question).filter(Question.id.notin_(previous_questions)).order_by(Question.id).all()
-                question = random.choice(questions)
-            return jsonify({
-                'question': question.format()
+            category_id = int(body.get('quiz_category')['id'])
+        except Exception:
+            abort(422)
+
+        total_questions = len(question_index.ids(category_id))
+        if total_questions == 0:
+            abort(404)
+
+        return jsonify({
+            'session_id': quiz_sessions.create(category_id),
+            'total_questions': total_questions
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    def get_next_session_question(session_id):
+        try:
+            count = quiz_batch_size(request.get_json(silent=True) or {})
+        except (AttributeError, ValueError):
+            abort(422)
+        try:
+            category_id, served = quiz_sessions.get(session_id)
+        except KeyError:
+            abort(404)
+
+        questions = []
+        while len(questions) < (count or 1):
+            drawn = question_index.draw_many(category_id, (count or 1) - len(questions), served)
+            if not drawn:
+                break
+            for question in drawn:
+                try:
+                    if quiz_sessions.mark_served(session_id, question['id']):
+                        questions.append(question)
+                except KeyError:
+                    abort(404)
+                # a question served meanwhile by another turn of this session is dropped
+                served.add(question['id'])
+
+        if count is not None:
+            return json_response({
+                'questions': questions,
+                'question': questions[0] if questions else None
             })
-        except Exception as err:
-            print(traceback.format_exc())
-            abort(500)
-        
+        return jsonify({
+            'question': questions[0] if questions else None
+        })
 
     """   
     TEST: In the "Play" tab, after a user selects "All" or a category,
@@ -0,0 +1,155 @@
+"""
+Server side answer checking for the quiz.
+
+Answers and guesses are compared in a normalized form: accents, case and
+punctuation are dropped and a leading article ("The Liver") is ignored.
+A guess is correct when its normal form equals the answer's, has the
+same words in another order, or is within a small edit distance of it
+(a typo every few letters) with the same numbers: "Apollo 12" is no
+typo of "Apollo 13". The distance is computed with the
+bit-parallel algorithm of Myers (as formulated by Hyyro), whose match
+masks depend on the answer only; they are compiled once per question
+and kept in an LRU, so checking a guess is one normalization and a loop
+of integer operations per guess character.
+"""
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+ANSWER_CACHE_SIZE = 10000
+ARTICLES = ('the', 'a', 'an')
+
+PUNCTUATION = re.compile(r'[\W_]+', re.UNICODE)
+LEADING_ARTICLE = re.compile(r'^(?:{}) '.format('|'.join(ARTICLES)))
+
+Verdict = namedtuple('Verdict', ['correct', 'distance'])
+
+
+def normalize(text):
+    """Lowercase ``text`` without accents, punctuation or a leading article."""
+    text = text or ''
+    if not text.isascii():
+        decomposed = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    words = PUNCTUATION.sub(' ', text.casefold()).strip()
+    return LEADING_ARTICLE.sub('', words)
+
+
+def allowed_distance(length):
+    """Typos tolerated in an answer of ``length`` characters: none up to 4, then one per 5."""
+    return 0 if length <= 4 else length // 5
+
+
+def numbers(words):
+    return [word for word in words if word.isdigit()]
+
+
+class CompiledAnswer(object):
+    """The normal form of an answer and the Myers match masks of it."""
+
+    __slots__ = ('answer', 'normal', 'words', 'numbers', 'masks', 'high', 'max_distance')
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.normal = normalize(answer)
+        self.words = sorted(self.normal.split())
+        self.numbers = numbers(self.words)
+        masks = {}
+        for position, char in enumerate(self.normal):
+            masks[char] = masks.get(char, 0) | (1 << position)
+        self.masks = masks
+        self.high = 1 << (len(self.normal) - 1) if self.normal else 0
+        self.max_distance = allowed_distance(len(self.normal))
+
+    def distance(self, text, bound):
+        """
+        Levenshtein distance between the answer and ``text``, or
+        ``bound + 1`` as soon as it is known to exceed ``bound``.
+        """
+        length = len(self.normal)
+        if abs(length - len(text)) > bound:
+            return bound + 1
+        if length == 0:
+            return len(text)
+        full = (1 << length) - 1
+        positive, negative, score = full, 0, length
+        remaining = len(text)
+        for char in text:
+            match = self.masks.get(char, 0)
+            vertical = match | negative
+            horizontal = (((match & positive) + positive) ^ positive) | match
+            horizontal_positive = negative | (~(horizontal | positive) & full)
+            horizontal_negative = positive & horizontal
+            if horizontal_positive & self.high:
+                score += 1
+            elif horizontal_negative & self.high:
+                score -= 1
+            remaining -= 1
+            # every character left lowers the score by at most one
+            if score - remaining > bound:
+                return bound + 1
+            horizontal_positive = ((horizontal_positive << 1) | 1) & full
+            horizontal_negative = (horizontal_negative << 1) & full
+            positive = horizontal_negative | (~(vertical | horizontal_positive) & full)
+            negative = horizontal_positive & vertical
+        return score
+
+    def check(self, guess):
+        normal = normalize(guess)
+        if not normal:
+            return Verdict(False, None)
+        words = sorted(normal.split())
+        if normal == self.normal or words == self.words:
+            return Verdict(True, 0)
+        if numbers(words) != self.numbers:
+            return Verdict(False, None)
+        distance = self.distance(normal, self.max_distance)
+        if distance > self.max_distance:
+            return Verdict(False, None)
+        return Verdict(True, distance)
+
+
+class AnswerChecker(object):
+    """Compiled answers by question id, at most ``size`` of them."""
+
+    def __init__(self, size=ANSWER_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compiled(self, question_id, load_question):
+        """
+        The CompiledAnswer of ``question_id``, or None if it does not
+        exist. ``load_question`` is called on a miss and returns the
+        question dict or None.
+        """
+        with self._lock:
+            compiled = self._compiled.get(question_id)
+            if compiled is not None:
+                self._compiled.move_to_end(question_id)
+                self.hits += 1
+                return compiled
+        question = load_question(question_id)
+        if question is None:
+            return None
+        compiled = CompiledAnswer(question['answer'])
+        with self._lock:
+            self.misses += 1
+            self._compiled[question_id] = compiled
+            while len(self._compiled) > self.size:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def invalidate(self):
+        with self._lock:
+            self._compiled.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._compiled),
+        }
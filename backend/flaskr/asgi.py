@@ -0,0 +1,429 @@
+"""
+ASGI serving mode.
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+
+The hot read endpoints (GET /categories, GET /questions,
+GET /categories/<id>/questions and POST /quizzes) are served on the
+event loop through an async driver, asyncpg for Postgres or aiosqlite
+for SQLite, so a slow database round-trip no longer holds a worker
+thread. They run the read steps of the Flask views (see reads.py), so
+the SQL, argument checks and payloads are the same and so are the
+bytes. The work the Flask app does around its views is done here too:
+GETs go through the app's response cache and get the same ETags, reads
+go to the replica like g.read_replica decides, 200 responses are
+compressed and every response gets Server-Timing and is counted in
+/metrics (sampled profiling is left to the Flask routes). Every other
+route is handed to the Flask app from create_app on a thread pool, so
+the whole API is available under ASGI.
+
+With QUESTION_STORE set the steps that read the question store run on
+the thread pool, since a store sync may query the database.
+"""
+import asyncio
+import functools
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from flask import abort
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+
+from models import REPLICA_BIND
+from . import CATEGORY_CACHE_TTL, create_app, reads_from_replica
+from .pagination import listing_steps
+from .reads import category_steps, run_async
+from .sampling import quiz_steps
+from .serialization import dumps, ordered
+from .compression import ENCODING_SUFFIX, compress_body, response_encoding
+from .instrumentation import RequestStats, record_request
+
+WSGI_THREADS = 32
+WSGI_QUEUE_SIZE = 16
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    422: 'unprocessable',
+    500: 'internal server error',
+}
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET, PUT, POST, DELETE, OPTIONS'),
+]
+
+
+class AsyncDatabase(object):
+    """
+    Thin async query runner. SQL is written with ``?`` placeholders and
+    rewritten to ``$n`` for asyncpg; rows come back as tuples.
+    """
+
+    def __init__(self, url, pool_size=10, root_path='.'):
+        self.url = url
+        self.pool_size = pool_size
+        self.root_path = root_path
+        self.is_sqlite = url.startswith('sqlite')
+        self._connecting = None
+        self._connection = None
+        self._pool = None
+
+    async def connect(self):
+        """Connect once; concurrent callers wait for the same attempt."""
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        await asyncio.shield(self._connecting)
+
+    async def _connect(self):
+        if self.is_sqlite:
+            import aiosqlite
+            path = self.url.split(':///', 1)[1]
+            if not os.path.isabs(path):
+                # relative paths are resolved like Flask-SQLAlchemy does
+                path = os.path.join(self.root_path, path)
+            self._connection = await aiosqlite.connect(path)
+        else:
+            import asyncpg
+            dsn = re.sub(r'^postgresql\+\w+://', 'postgresql://', self.url)
+            self._pool = await asyncpg.create_pool(dsn, min_size=1, max_size=self.pool_size)
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+        if self._pool is not None:
+            await self._pool.close()
+
+    @staticmethod
+    def _numbered(sql):
+        counter = iter(range(1, sql.count('?') + 1))
+        return re.sub(r'\?', lambda match: '${}'.format(next(counter)), sql)
+
+    async def fetch(self, sql, *params):
+        await self.connect()
+        if self.is_sqlite:
+            async with self._connection.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        async with self._pool.acquire() as connection:
+            rows = await connection.fetch(self._numbered(sql), *params)
+        return [tuple(row) for row in rows]
+
+
+class TriviaASGI(object):
+
+    def __init__(self, flask_app, wsgi_threads=WSGI_THREADS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=wsgi_threads)
+        self.question_store = flask_app.extensions['trivia']['question_store']
+        self.category_cache = flask_app.extensions['trivia']['category_cache']
+        self.counts = flask_app.extensions['trivia']['counts']
+        self.question_index = flask_app.extensions['trivia']['question_index']
+        self.response_cache = flask_app.extensions['trivia']['response_cache']
+        config = flask_app.config
+        primary = AsyncDatabase(config['SQLALCHEMY_DATABASE_URI'], config['DB_POOL_SIZE'],
+                                flask_app.root_path)
+        replica = (config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA_BIND)
+        # keyed by reads_from_replica()
+        self.databases = {False: primary, True: primary}
+        if replica:
+            self.databases[True] = AsyncDatabase(replica, config['DB_POOL_SIZE'],
+                                                 flask_app.root_path)
+        self.routes = [
+            ('GET', re.compile(r'^/categories$'), self.get_all_categories),
+            ('GET', re.compile(r'^/questions$'), self.get_a_page_of_questions),
+            ('GET', re.compile(r'^/categories/(\d+)/questions$'),
+             self.get_questions_for_selected_category),
+            ('POST', re.compile(r'^/quizzes$'), self.get_quiz),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = await self.read_body(receive)
+        for method, pattern, handler in self.routes:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                await self.native(scope, body, send, handler, match.groups())
+                return
+        await self.call_wsgi(scope, body, send)
+
+    async def native(self, scope, body, send, handler, args):
+        """
+        Serve a native route. Its handler is named after the Flask
+        endpoint, which is the endpoint label in /metrics.
+        """
+        stats = RequestStats()
+        method = scope['method']
+        endpoint = handler.__name__
+        database = self.databases[reads_from_replica(self.flask_app, method, endpoint)]
+
+        async def fetch(sql, *params):
+            started = time.perf_counter()
+            rows = await database.fetch(sql, *params)
+            stats.db_time += time.perf_counter() - started
+            stats.queries += 1
+            stats.rows += len(rows)
+            stats.statements[sql] += 1
+            return rows
+
+        def call(steps):
+            return run_async(steps, fetch, self.in_thread)
+
+        request_headers = dict(scope['headers'])
+        if method == 'GET':
+            status, headers, body = await self.cached_get(
+                scope, request_headers, handler, args, call, stats)
+        else:
+            status, headers, payload = await self.call_handler(handler, scope, body, args, call)
+            body = self.encode(payload, stats)
+            headers = self.header_pairs(headers) + [(b'content-type', b'application/json')]
+            if status == 200:
+                headers.append((b'vary', b'Accept-Encoding'))
+                body, encoding = self.compress(request_headers, body)
+                if encoding is not None:
+                    headers.append((b'content-encoding', encoding.encode('ascii')))
+        timing = record_request(self.flask_app, endpoint, method, status, stats)
+        await self.send_response(send, status, headers + [(b'server-timing', timing.encode('ascii'))],
+                                 body)
+
+    async def call_handler(self, handler, scope, body, args, call):
+        """
+        (status, headers, payload) of ``handler``; the error payload when it
+        aborts, and a logged 500 like Flask's when it fails.
+        """
+        try:
+            return await handler(scope, body, call, *args)
+        except HTTPException as error:
+            return self.error(error.code)
+        except Exception:
+            self.flask_app.logger.exception('Exception on %s [%s]', scope['path'], scope['method'])
+            return self.error(500)
+
+    async def cached_get(self, scope, request_headers, handler, args, call, stats):
+        """GET through the response cache of the Flask app, with ETag and 304."""
+        cache = self.response_cache
+        key = cache.key(scope['path'], parse_qsl(scope['query_string'].decode('latin-1'),
+                                                 keep_blank_values=True))
+        entry = cache.lookup(key)
+        if entry is None:
+            version = cache.store.current_version()
+            status, headers, payload = await self.call_handler(handler, scope, b'', args, call)
+            if status != 200:
+                return status, self.header_pairs(headers) + [
+                    (b'content-type', b'application/json')], self.encode(payload, stats)
+            entry = cache.save(key, version, self.encode(payload, stats), 'application/json',
+                               headers)
+
+        headers = self.header_pairs(entry.headers)
+        if_none_match = request_headers.get(b'if-none-match')
+        if if_none_match:
+            candidates = [ENCODING_SUFFIX.sub('"', tag.strip())
+                          for tag in if_none_match.decode('latin-1').split(',')]
+            if '"{}"'.format(entry.etag) in candidates or '*' in candidates:
+                etag = '"{}"'.format(entry.etag)
+                return 304, headers + [(b'etag', etag.encode('ascii'))], b''
+
+        body, encoding = self.compress(request_headers, entry.body)
+        headers += [(b'content-type', b'application/json'), (b'vary', b'Accept-Encoding')]
+        if encoding is None:
+            etag = '"{}"'.format(entry.etag)
+        else:
+            # the same ETag suffix as flaskr.compression
+            etag = '"{}-{}"'.format(entry.etag, encoding)
+            headers.append((b'content-encoding', encoding.encode('ascii')))
+        return 200, headers + [(b'etag', etag.encode('ascii'))], body
+
+    def compress(self, request_headers, body):
+        """(body, encoding) like compress_response, for a 200 JSON body."""
+        config = self.flask_app.config
+        encoding = response_encoding(
+            config, len(body), request_headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if encoding is None:
+            return body, None
+        return compress_body(config, body, encoding), encoding
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self):
+        # every native route is a read, see reads_from_replica()
+        await self.databases[True].connect()
+
+    async def close(self):
+        for database in set(self.databases.values()):
+            await database.close()
+        self.executor.shutdown(wait=False)
+
+    async def in_thread(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def encode(payload, stats):
+        started = time.perf_counter()
+        body = dumps(ordered(payload)) + b'\n'
+        stats.serialize_time += time.perf_counter() - started
+        return body
+
+    @staticmethod
+    def header_pairs(headers):
+        return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+
+    @staticmethod
+    async def send_response(send, status, headers, body):
+        headers = list(headers) + CORS_HEADERS + [
+            (b'content-length', str(len(body)).encode('ascii'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    def error(status):
+        return status, [], {
+            'success': 'False',
+            'error': status,
+            'message': ERROR_MESSAGES[status]
+        }
+
+    @staticmethod
+    def query_args(scope):
+        """The query arguments of ``scope`` as Flask's request.args would hold them."""
+        return MultiDict(parse_qsl(scope['query_string'].decode('latin-1'),
+                                   keep_blank_values=True))
+
+    # native handlers, named after the Flask endpoints they stand in for
+
+    async def get_all_categories(self, scope, body, call):
+        categories = await call(category_steps(self.category_cache))
+        if len(categories) == 0:
+            abort(404)
+        headers = [('Cache-Control', 'public, max-age={}'.format(CATEGORY_CACHE_TTL))]
+        return 200, headers, {'categories': categories}
+
+    async def get_a_page_of_questions(self, scope, body, call):
+        return 200, [], await call(listing_steps(
+            self.query_args(scope), self.counts, self.category_cache, store=self.question_store))
+
+    async def get_questions_for_selected_category(self, scope, body, call, category_id):
+        return 200, [], await call(listing_steps(
+            self.query_args(scope), self.counts, self.category_cache, int(category_id),
+            store=self.question_store))
+
+    async def get_quiz(self, scope, body, call):
+        try:
+            body = json.loads(body.decode('utf-8'))
+        except ValueError:
+            body = None
+        return 200, [], await call(quiz_steps(self.question_index, body, self.flask_app.logger))
+
+    # everything else runs through the Flask app
+
+    def wsgi_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    async def call_wsgi(self, scope, body, send):
+        """
+        Run the Flask app on one pool thread for the whole response, so
+        streamed responses keep their request context, and relay its
+        chunks through a bounded queue.
+        """
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(WSGI_QUEUE_SIZE)
+        environ = self.wsgi_environ(scope, body)
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put(('start', int(status.split(' ', 1)[0]), headers))
+            return lambda data: put(('body', data))
+
+        def run():
+            try:
+                iterable = self.flask_app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if chunk:
+                            put(('body', chunk))
+                finally:
+                    if hasattr(iterable, 'close'):
+                        iterable.close()
+            finally:
+                put(('end', None))
+
+        future = loop.run_in_executor(self.executor, run)
+        while True:
+            kind, *item = await queue.get()
+            if kind == 'start':
+                status, headers = item
+                await send({
+                    'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers],
+                })
+            elif kind == 'body':
+                await send({'type': 'http.response.body', 'body': item[0], 'more_body': True})
+            else:
+                break
+        await send({'type': 'http.response.body', 'body': b''})
+        await future
+
+
+def create_asgi_app(test_config=None):
+    return TriviaASGI(create_app(test_config))
@@ -0,0 +1,144 @@
+"""
+Bulk question import.
+
+Records arrive as NDJSON (one JSON object per line) or CSV with a
+header row, are validated in batches and loaded with a single COPY per
+batch on Postgres or one executemany INSERT elsewhere. Bad rows are
+reported by line number and skipped; good rows are committed batch by
+batch, together with their duplicate detection signatures.
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import text
+
+from models import Question, db
+from .duplicates import index_questions_after
+
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+DIFFICULTIES = range(1, 6)
+COLUMNS = ('question', 'answer', 'difficulty', 'category')
+
+
+class UnreadableRecord(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+def read_ndjson(lines):
+    """Yield (line number, record) for NDJSON ``lines``."""
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+        except ValueError as err:
+            record = UnreadableRecord('invalid JSON: {}'.format(err))
+        yield line_number, record
+
+
+def read_csv(lines):
+    """Yield (line number, record) for CSV ``lines`` with a header row."""
+    decoded = (line.decode('utf-8') if isinstance(line, bytes) else line
+               for line in lines)
+    reader = csv.DictReader(decoded)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def validate(record, category_ids):
+    """Return a (question, answer, difficulty, category) row or an error message."""
+    if isinstance(record, UnreadableRecord):
+        return record.error
+    if not isinstance(record, dict):
+        return 'expected an object'
+    question = record.get('question')
+    answer = record.get('answer')
+    if not isinstance(question, str) or not question.strip():
+        return 'question is required'
+    if not isinstance(answer, str) or not answer.strip():
+        return 'answer is required'
+    try:
+        difficulty = int(record.get('difficulty'))
+        category = int(record.get('category'))
+    except (TypeError, ValueError):
+        return 'difficulty and category must be integers'
+    if difficulty not in DIFFICULTIES:
+        return 'difficulty must be between 1 and 5'
+    if category not in category_ids:
+        return 'unknown category {}'.format(category)
+    return (question.strip(), answer.strip(), difficulty, category)
+
+
+def copy_rows(rows):
+    """Load ``rows`` through Postgres COPY on the session's connection."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY questions (question, answer, difficulty, category) '
+            'FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(rows):
+    db.session.execute(Question.__table__.insert(),
+                       [dict(zip(COLUMNS, row)) for row in rows])
+
+
+def insert_batch(rows):
+    """Insert ``rows`` and their signatures in the session's transaction; the caller commits."""
+    # neither COPY nor executemany return the new ids, sign what is above the old maximum
+    after_id = db.session.execute(text('SELECT coalesce(max(id), 0) FROM questions')).scalar()
+    if db.engine.dialect.name == 'postgresql':
+        copy_rows(rows)
+    else:
+        insert_rows(rows)
+    index_questions_after(after_id)
+
+
+def load_batch(rows):
+    insert_batch(rows)
+    db.session.commit()
+
+
+def import_questions(records, category_ids, batch_size=BATCH_SIZE):
+    """
+    Validate and load ``records`` (pairs from read_ndjson/read_csv).
+    Returns a summary with the inserted and rejected counts and the
+    first MAX_REPORTED_ERRORS errors.
+    """
+    inserted = 0
+    rejected = 0
+    errors = []
+    batch = []
+    try:
+        for line_number, record in records:
+            row = validate(record, category_ids)
+            if isinstance(row, str):
+                rejected += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': line_number, 'error': row})
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                load_batch(batch)
+                inserted += len(batch)
+                batch = []
+        if batch:
+            load_batch(batch)
+            inserted += len(batch)
+    except Exception:
+        db.session.rollback()
+        raise
+    return {
+        'inserted': inserted,
+        'rejected': rejected,
+        'errors': errors
+    }
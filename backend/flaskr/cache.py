@@ -0,0 +1,301 @@
+"""
+Small process-wide caches for data that rarely changes, and the HTTP
+response cache of the read endpoints.
+
+Cached responses are keyed by path and query arguments and tagged with
+the question bank version they were rendered at. Any question add or
+delete and any category change bumps the version, which retires every
+entry at once. The version lives in the process (memory://), in a small
+memory-mapped file shared by all workers of a host (shm:///path), or in
+Redis next to the entries (redis://). memory:// only suits a single
+process: with more workers a bump in one leaves the others serving stale
+responses until RESPONSE_CACHE_TTL, so set RESPONSE_CACHE to shm:// or
+redis:// there.
+"""
+import fcntl
+import functools
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlencode
+
+from flask import current_app, request
+
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 60
+
+CachedResponse = namedtuple('CachedResponse', ['version', 'etag', 'mimetype', 'headers', 'body'])
+
+
+class CachedValue(object):
+    """
+    Holds the result of ``loader()`` for ``ttl`` seconds or until
+    invalidate() is called, and counts hits and misses. With a
+    ``version`` callable the value is also dropped once that returns
+    something else than it did at load time.
+    """
+
+    def __init__(self, loader, ttl, version=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        self._loaded_version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._value = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        value = self.peek()
+        if value is not None:
+            return value
+        with self._lock:
+            if (self._value is None or self._expires <= time.monotonic()
+                    or self._loaded_version != self._current_version()):
+                self.misses += 1
+                self._loaded_version = self._current_version()
+                self._value = self.loader()
+                self._expires = time.monotonic() + self.ttl
+            else:
+                self.hits += 1
+            return self._value
+
+    def peek(self):
+        """The cached value if it is still fresh (counted as a hit), else None."""
+        if (self._value is not None and self._expires > time.monotonic()
+                and self._loaded_version == self._current_version()):
+            self.hits += 1
+            return self._value
+        return None
+
+    def _current_version(self):
+        return self.version() if self.version is not None else None
+
+    def put(self, value):
+        """Store a value loaded elsewhere, e.g. by an async loader."""
+        with self._lock:
+            self.misses += 1
+            self._loaded_version = self._current_version()
+            self._value = value
+            self._expires = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
+
+class LocalVersion(object):
+    """Bank version counter of this process only."""
+
+    def __init__(self):
+        self.value = 0
+
+    def current(self):
+        return self.value
+
+    def bump(self):
+        self.value += 1
+
+
+class SharedVersion(object):
+    """
+    Bank version counter in an 8 byte memory-mapped file, so a bump in
+    one worker retires the cached responses of every worker on the host.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+            self._map = mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+
+    def current(self):
+        return struct.unpack_from('<Q', self._map)[0]
+
+    def bump(self):
+        with open(self.path, 'rb') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            struct.pack_into('<Q', self._map, 0, self.current() + 1)
+
+
+class MemoryResponseStore(object):
+    """LRU of at most ``max_entries`` responses, each kept ``ttl`` seconds."""
+
+    def __init__(self, version=None, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.version = version or LocalVersion()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def current_version(self):
+        return self.version.current()
+
+    def get(self, key):
+        version = self.version.current()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if entry.version != version or expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def bump(self):
+        self.version.bump()
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisResponseStore(object):
+    """
+    Responses kept in Redis hashes, shared by every worker. An entry is
+    read together with the bank version in one round trip.
+    """
+
+    FIELDS = ('version', 'etag', 'mimetype', 'headers', 'body')
+
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL, prefix='trivia:responses:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.version_key = prefix + 'version'
+        self.evictions = 0
+
+    def current_version(self):
+        return int(self.client.get(self.version_key) or 0)
+
+    def get(self, key):
+        pipe = self.client.pipeline()
+        pipe.get(self.version_key)
+        pipe.hmget(self.prefix + key, *self.FIELDS)
+        version, (entry_version, etag, mimetype, headers, body) = pipe.execute()
+        if body is None or int(entry_version) != int(version or 0):
+            return None
+        return CachedResponse(int(entry_version), etag.decode('ascii'), mimetype.decode('ascii'),
+                              [tuple(header) for header in json.loads(headers)], body)
+
+    def set(self, key, entry):
+        pipe = self.client.pipeline()
+        pipe.hset(self.prefix + key, mapping={
+            'version': entry.version,
+            'etag': entry.etag,
+            'mimetype': entry.mimetype,
+            'headers': json.dumps(entry.headers),
+            'body': entry.body,
+        })
+        pipe.expire(self.prefix + key, self.ttl)
+        pipe.execute()
+
+    def bump(self):
+        # stale entries are never read again and expire with their ttl
+        self.client.incr(self.version_key)
+
+
+def make_response_store(url=None):
+    """Build the store named by ``url``: None or memory://, shm:///path or redis://."""
+    if not url or url.startswith('memory://'):
+        return MemoryResponseStore()
+    if url.startswith('shm://'):
+        return MemoryResponseStore(SharedVersion(url[len('shm://'):]))
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        import redis
+        return RedisResponseStore(redis.Redis.from_url(url))
+    raise ValueError('unsupported response cache: {}'.format(url))
+
+
+def response_etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Caches the 200 responses of the views it decorates and answers
+    If-None-Match with 304 from a strong ETag over the body.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, args):
+        """Cache key of ``path`` with the (name, value) pairs of ``args``."""
+        return path + '?' + urlencode(sorted(args))
+
+    def lookup(self, key):
+        entry = self.store.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def save(self, key, version, body, mimetype, headers):
+        entry = CachedResponse(version, response_etag(body), mimetype, headers, body)
+        self.store.set(key, entry)
+        return entry
+
+    def cached(self, view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = self.key(request.path, request.args.items(multi=True))
+            entry = self.lookup(key)
+            if entry is None:
+                # tag with the version seen before rendering, so a bump
+                # that races with the render still retires the entry
+                version = self.store.current_version()
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                headers = [(name, value) for name, value in response.headers
+                           if name not in ('Content-Type', 'Content-Length', 'ETag')]
+                entry = self.save(key, version, response.get_data(), response.mimetype, headers)
+            response = current_app.response_class(entry.body, mimetype=entry.mimetype,
+                                                  headers=entry.headers)
+            response.set_etag(entry.etag)
+            return response.make_conditional(request)
+        return wrapper
+
+    def bump(self):
+        self.store.bump()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.store.evictions,
+            'version': self.store.current_version(),
+        }
@@ -0,0 +1,110 @@
+"""
+Response compression.
+
+Bodies of at least COMPRESS_MIN_SIZE bytes with a compressible content
+type are encoded with Brotli (when the brotli package is installed) or
+gzip, whichever the client's Accept-Encoding prefers. Streamed responses
+(the export) are left alone, they compress themselves.
+
+A compressed response is a different representation, so its ETag gets
+an encoding suffix ("<sha1>-gzip"). The suffix is stripped from
+If-None-Match before the views see it, so conditional requests keep
+matching the ETag of the uncompressed body.
+"""
+import gzip
+import re
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 4
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+ENCODING_SUFFIX = re.compile(r'-(?:gzip|br)"')
+
+
+def supported_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding, encodings=None):
+    """Best of ``encodings`` (in server preference order) for an Accept-Encoding value."""
+    encodings = encodings or supported_encodings()
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        quality = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding, level=COMPRESS_LEVEL, brotli_quality=COMPRESS_BROTLI_QUALITY):
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=level)
+
+
+def response_encoding(config, size, accept_encoding):
+    """The encoding of a compressible 200 body of ``size`` bytes, None to send it as is."""
+    if size < config['COMPRESS_MIN_SIZE']:
+        return None
+    return negotiate(accept_encoding)
+
+
+def compress_body(config, body, encoding):
+    return compress(body, encoding, config['COMPRESS_LEVEL'], config['COMPRESS_BROTLI_QUALITY'])
+
+
+def compressible(mimetype):
+    return any(mimetype.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def init_compression(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_LEVEL', COMPRESS_LEVEL)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', COMPRESS_BROTLI_QUALITY)
+
+    @app.before_request
+    def strip_encoding_from_etags():
+        if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            request.environ['HTTP_IF_NONE_MATCH'] = ENCODING_SUFFIX.sub('"', if_none_match)
+
+
+def compress_response(app, response):
+    """Encode ``response`` in place when it qualifies; returns it."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or not compressible(response.mimetype or '')):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = response_encoding(app.config, len(body), request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    response.set_data(compress_body(app.config, body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
@@ -0,0 +1,327 @@
+"""
+Duplicate and near-duplicate question detection.
+
+Every question text is normalized like quiz answers (answers.normalize),
+cut into overlapping SHINGLE_SIZE character shingles and summarized by a
+MinHash signature of NUM_HASHES values: the fraction of equal values of
+two signatures estimates the Jaccard similarity of their shingle sets.
+The signature is split into BANDS bands whose hashes are stored in
+question_buckets (migration 0007). Two questions become candidates when
+they share a bucket in any band, so a lookup reads a few index entries
+instead of the whole bank; with 16 bands of 4 values a pair at 0.6
+similarity is found with 89% probability, one at 0.8 with over 99.9%.
+
+Signatures are written when a question is added or bulk imported, and
+`flask index-duplicates` fills in those of questions loaded any other
+way. `flask duplicates-report` compares the whole bank offline, with the
+signatures computed and the candidate pairs checked on all cores.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import struct
+import time
+
+from sqlalchemy import bindparam, text
+
+from models import Question, db
+from .answers import normalize
+from .serialization import question_dict, question_rows
+
+SHINGLE_SIZE = 5
+NUM_HASHES = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_HASHES // BANDS
+SIMILARITY_THRESHOLD = 0.6
+MAX_DUPLICATES = 50
+INDEX_BATCH_SIZE = 1000
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+PERMUTATION_SEED = 0x64757073
+
+
+def universal_hashes(count, seed=PERMUTATION_SEED):
+    """(a, b) of the hashes (a * x + b) mod p standing in for random permutations."""
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(count)]
+
+
+PERMUTATIONS = universal_hashes(NUM_HASHES)
+SIGNATURE = struct.Struct('<{}I'.format(NUM_HASHES))
+BAND = struct.Struct('<{}I'.format(ROWS_PER_BAND))
+
+
+def shingles(text_value):
+    """Hashes of the character shingles of the normalized ``text_value``."""
+    normal = normalize(text_value)
+    if not normal:
+        return set()
+    pieces = {normal[start:start + SHINGLE_SIZE]
+              for start in range(max(len(normal) - SHINGLE_SIZE + 1, 1))}
+    return {int.from_bytes(hashlib.blake2b(piece.encode('utf-8'), digest_size=4).digest(), 'little')
+            for piece in pieces}
+
+
+def signature(text_value):
+    """MinHash signature of ``text_value``, a tuple of NUM_HASHES ints, or None if it is empty."""
+    hashes = shingles(text_value)
+    if not hashes:
+        return None
+    return tuple(min((a * value + b) % MERSENNE_PRIME & MAX_HASH for value in hashes)
+                 for a, b in PERMUTATIONS)
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for x, y in zip(first, second) if x == y) / NUM_HASHES
+
+
+def band_buckets(values):
+    """The (band, bucket) pairs of a signature, buckets as signed 64 bit ints."""
+    buckets = []
+    for band in range(BANDS):
+        rows = values[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(BAND.pack(*rows), digest_size=8).digest()
+        buckets.append((band, int.from_bytes(digest, 'little', signed=True)))
+    return buckets
+
+
+def signatures_of(rows):
+    """[(id, signature)] of (id, question text) ``rows``, empty texts left out."""
+    signed = []
+    for question_id, question in rows:
+        values = signature(question)
+        if values is not None:
+            signed.append((question_id, values))
+    return signed
+
+
+# storage
+
+def insert_statement(table, columns):
+    names = ', '.join(columns)
+    values = ', '.join(':' + column for column in columns)
+    if db.engine.dialect.name == 'postgresql':
+        return text('INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING'.format(
+            table, names, values))
+    return text('INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(table, names, values))
+
+
+def store_signatures(signed):
+    """Write signatures and buckets in the session's transaction; the caller commits."""
+    if not signed:
+        return
+    db.session.execute(insert_statement('question_signatures', ('question_id', 'signature')), [
+        {'question_id': question_id, 'signature': SIGNATURE.pack(*values)}
+        for question_id, values in signed])
+    db.session.execute(insert_statement('question_buckets', ('band', 'bucket', 'question_id')), [
+        {'band': band, 'bucket': bucket, 'question_id': question_id}
+        for question_id, values in signed for band, bucket in band_buckets(values)])
+
+
+def index_questions(rows):
+    """Sign and store (id, question text) ``rows``; the caller commits."""
+    store_signatures(signatures_of(rows))
+
+
+def unsigned_questions(after_id=0, limit=INDEX_BATCH_SIZE):
+    """Up to ``limit`` (id, question) rows above ``after_id`` without a signature, in id order."""
+    return db.session.execute(text(
+        'SELECT id, question FROM questions WHERE id > :after_id AND NOT EXISTS '
+        '(SELECT 1 FROM question_signatures WHERE question_id = questions.id) '
+        'ORDER BY id LIMIT :limit'), {'after_id': after_id, 'limit': limit}).fetchall()
+
+
+def index_questions_after(after_id):
+    """Sign the questions above ``after_id`` that have no signature yet; the caller commits."""
+    while True:
+        rows = unsigned_questions(after_id)
+        if not rows:
+            return
+        index_questions(rows)
+        after_id = rows[-1][0]
+
+
+def stored_signatures(question_ids):
+    rows = db.session.execute(text(
+        'SELECT question_id, signature FROM question_signatures WHERE question_id IN :ids'
+    ).bindparams(bindparam('ids', expanding=True)), {'ids': list(question_ids)})
+    return {question_id: SIGNATURE.unpack(bytes(packed)) for question_id, packed in rows}
+
+
+def candidates(values, exclude):
+    """Ids sharing at least one band bucket with signature ``values``."""
+    buckets = band_buckets(values)
+    conditions = ' OR '.join('(band = :band{0} AND bucket = :bucket{0})'.format(band)
+                             for band, _ in buckets)
+    params = {}
+    for band, bucket in buckets:
+        params['band{}'.format(band)] = band
+        params['bucket{}'.format(band)] = bucket
+    rows = db.session.execute(text(
+        'SELECT DISTINCT question_id FROM question_buckets WHERE ' + conditions), params)
+    return set(row[0] for row in rows) - {exclude}
+
+
+def find_duplicates(question, threshold=SIMILARITY_THRESHOLD, limit=MAX_DUPLICATES):
+    """
+    Questions similar to ``question`` (a Question) by at least
+    ``threshold``, most similar first, as question dicts with their
+    estimated ``similarity``. Reads only, a missing signature of
+    ``question`` itself is computed on the spot.
+    """
+    values = stored_signatures([question.id]).get(question.id) or signature(question.question)
+    if values is None:
+        return []
+
+    found = candidates(values, question.id)
+    if not found:
+        return []
+    scored = [(similarity(values, other), question_id)
+              for question_id, other in stored_signatures(found).items()]
+    scored = sorted([pair for pair in scored if pair[0] >= threshold], reverse=True)[:limit]
+    rows = {row.id: row for row in question_rows(
+        Question.query.filter(Question.id.in_([question_id for _, question_id in scored])))}
+    duplicates = []
+    for score, question_id in scored:
+        if question_id in rows:
+            duplicate = question_dict(rows[question_id])
+            duplicate['similarity'] = score
+            duplicates.append(duplicate)
+    return duplicates
+
+
+def index_unsigned(processes=None, batch_size=INDEX_BATCH_SIZE * 10):
+    """
+    Sign every question without a signature, committing batch by batch,
+    with the signatures computed on ``processes`` cores. Returns the
+    number of questions signed.
+    """
+    indexed = 0
+    after_id = 0
+    with multiprocessing.Pool(processes or os.cpu_count() or 1) as pool:
+        while True:
+            rows = [tuple(row) for row in unsigned_questions(after_id, batch_size)]
+            if not rows:
+                return indexed
+            signed = [pair for chunk in pool.map(signatures_of, _chunks(rows, INDEX_BATCH_SIZE))
+                      for pair in chunk]
+            store_signatures(signed)
+            db.session.commit()
+            indexed += len(signed)
+            after_id = rows[-1][0]
+
+
+# offline report
+
+_report_signatures = {}
+
+
+def _init_report_worker(signatures):
+    global _report_signatures
+    _report_signatures = signatures
+
+
+def _similar_pairs(pairs_and_threshold):
+    pairs, threshold = pairs_and_threshold
+    similar = []
+    for first, second in pairs:
+        score = similarity(_report_signatures[first], _report_signatures[second])
+        if score >= threshold:
+            similar.append((first, second, score))
+    return similar
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def duplicates_report(rows, threshold=SIMILARITY_THRESHOLD, processes=None, chunk_size=2000):
+    """
+    Group (id, question text) ``rows`` into clusters of near duplicates.
+    Signatures are computed and candidate pairs checked in a pool of
+    ``processes`` workers (one per core by default); bucketing runs here.
+    """
+    rows = list(rows)
+    processes = processes or os.cpu_count() or 1
+    timings = {}
+    started = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        signatures = dict(pair for signed in pool.imap_unordered(
+            signatures_of, _chunks(rows, chunk_size)) for pair in signed)
+    timings['signatures_seconds'] = round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    # copies share one signature: pair them directly and bucket one of them
+    identical = {}
+    for question_id, values in sorted(signatures.items()):
+        identical.setdefault(values, []).append(question_id)
+    similar = [(copies[0], copy, 1.0) for copies in identical.values() for copy in copies[1:]]
+    buckets = {}
+    for values, copies in identical.items():
+        for key in band_buckets(values):
+            buckets.setdefault(key, []).append(copies[0])
+    pairs = set()
+    for members in buckets.values():
+        members.sort()
+        for position, first in enumerate(members):
+            for second in members[position + 1:]:
+                pairs.add((first, second))
+    pairs = sorted(pairs)
+    timings['bucketing_seconds'] = round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    with multiprocessing.Pool(processes, _init_report_worker, (signatures,)) as pool:
+        similar += [pair for found in pool.imap_unordered(
+            _similar_pairs, ((chunk, threshold) for chunk in _chunks(pairs, chunk_size * 10)))
+            for pair in found]
+    timings['verify_seconds'] = round(time.perf_counter() - started, 3)
+
+    # union-find over the similar pairs
+    parent = {}
+
+    def root(question_id):
+        parent.setdefault(question_id, question_id)
+        while parent[question_id] != question_id:
+            parent[question_id] = parent[parent[question_id]]
+            question_id = parent[question_id]
+        return question_id
+
+    best = {}
+    for first, second, _ in similar:
+        parent[root(first)] = root(second)
+    for first, second, score in similar:
+        cluster = root(first)
+        best[cluster] = max(best.get(cluster, 0), score)
+    clusters = {}
+    for question_id in parent:
+        clusters.setdefault(root(question_id), []).append(question_id)
+
+    texts = dict(rows)
+    report = [{'ids': sorted(members),
+               'max_similarity': best[cluster],
+               'questions': [texts[question_id] for question_id in sorted(members)]}
+              for cluster, members in clusters.items()]
+    report.sort(key=lambda cluster: (-len(cluster['ids']), cluster['ids'][0]))
+    return {
+        'questions': len(rows),
+        'signed': len(signatures),
+        'candidate_pairs': len(pairs),
+        'similar_pairs': len(similar),
+        'clusters': len(report),
+        'duplicate_questions': sum(len(cluster['ids']) - 1 for cluster in report),
+        'threshold': threshold,
+        'processes': processes,
+        'timings': timings,
+        'groups': report,
+    }
+
+
+def write_report(report, out):
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
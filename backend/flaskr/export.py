@@ -0,0 +1,84 @@
+"""
+Streaming export of the question bank.
+
+Rows are read through a server-side cursor in batches (yield_per), so
+memory stays flat whatever the table size, and are written out as
+NDJSON or CSV in chunks, optionally gzip-compressed on the fly.
+"""
+import csv
+import io
+import json
+import zlib
+
+from models import Question, db
+
+EXPORT_BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+# the export formats keep their own column order, apart from the sorted API keys
+FIELDS = ('id', 'question', 'answer', 'difficulty', 'category')
+
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_rows(category=None, difficulty=None):
+    """Yield (id, question, answer, difficulty, category) tuples in id order."""
+    query = db.session.query(Question.id, Question.question, Question.answer,
+                             Question.difficulty, Question.category)
+    if category is not None:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    return (query.order_by(Question.id)
+            .execution_options(stream_results=True)
+            .yield_per(EXPORT_BATCH_SIZE))
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield (json.dumps(dict(zip(FIELDS, row))) + '\n').encode('utf-8')
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def chunked(lines, size=CHUNK_SIZE):
+    """Join encoded ``lines`` into chunks of about ``size`` bytes."""
+    parts = []
+    length = 0
+    for line in lines:
+        parts.append(line)
+        length += len(line)
+        if length >= size:
+            yield b''.join(parts)
+            parts = []
+            length = 0
+    if parts:
+        yield b''.join(parts)
+
+
+def gzipped(chunks, level=GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_stream(file_format, category=None, difficulty=None, gzip=False):
+    rows = export_rows(category, difficulty)
+    lines = csv_lines(rows) if file_format == 'csv' else ndjson_lines(rows)
+    chunks = chunked(lines)
+    return gzipped(chunks) if gzip else chunks
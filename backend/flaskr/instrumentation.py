@@ -0,0 +1,267 @@
+"""
+Per-request instrumentation.
+
+For every request the wall time, database time, query count, rows
+fetched and serialization time are collected. SQLAlchemy cursor events
+feed the database figures. The figures are sent back as a Server-Timing
+header and aggregated into Prometheus counters and histograms served
+on /metrics. Statements repeated within one request (N+1 patterns) are
+counted and logged. The ASGI handlers of flaskr.asgi fill a RequestStats
+from their async queries and report it through record_request().
+
+With PROFILE_SAMPLE_RATE > 0 a fraction of requests is also profiled:
+cProfile stats (.prof) and folded stacks (.folded, the input format of
+flamegraph.pl and speedscope) are written to PROFILE_DIR.
+"""
+import cProfile
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+                   1.0, 2.5, 5.0, 7.5, 10.0)
+REPEATED_QUERY_THRESHOLD = 3
+SAMPLER_INTERVAL = 0.001
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.serialize_time = 0.0
+        self.statements = Counter()
+
+
+class Metrics(object):
+    """Minimal Prometheus registry: labelled counters and histograms."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[(name, labels)] += amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                              for key, value in pairs) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, ([list(value[0]), value[1], value[2]]))
+                                for key, value in self.histograms.items())
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append('{}{} {}'.format(name, self._labels(labels), repr(float(value))))
+        for (name, labels), (counts, total, count) in histograms:
+            header(name)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(
+                    name, self._labels(labels, [('le', bound)]), bucket_count))
+            lines.append('{}_bucket{} {}'.format(name, self._labels(labels, [('le', '+Inf')]), count))
+            lines.append('{}_sum{} {}'.format(name, self._labels(labels), repr(total)))
+            lines.append('{}_count{} {}'.format(name, self._labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('trivia_requests_total', 'counter', 'Requests handled.')
+metrics.describe('trivia_request_duration_seconds', 'histogram', 'Wall time per request.')
+metrics.describe('trivia_db_duration_seconds', 'histogram', 'Database time per request.')
+metrics.describe('trivia_db_queries_total', 'counter', 'SQL statements executed.')
+metrics.describe('trivia_db_rows_total', 'counter', 'Rows reported by the driver.')
+metrics.describe('trivia_serialization_duration_seconds', 'histogram', 'JSON encoding time per request.')
+metrics.describe('trivia_repeated_queries_total', 'counter',
+                 'Statements executed more than once in a request (N+1 candidates).')
+
+
+def current_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    stats = current_stats()
+    if stats is None:
+        return
+    stats.db_time += time.perf_counter() - started
+    stats.queries += 1
+    stats.statements[statement] += 1
+    # psycopg2 reports the size of a SELECT result, SQLite reports -1
+    if cursor.rowcount and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+def record_serialization(seconds):
+    stats = current_stats()
+    if stats is not None:
+        stats.serialize_time += seconds
+
+
+class StackSampler(object):
+    """Samples the stack of one thread into folded-stack counts."""
+
+    def __init__(self, thread_id, interval=SAMPLER_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def folded(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+def init_instrumentation(app):
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'trivia-profiles'))
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+        rate = app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            g.profiler = cProfile.Profile()
+            g.sampler = StackSampler(threading.get_ident())
+            g.sampler.start()
+            g.profiler.enable()
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        # only reached with a live profiler when finish_request did not run
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            g.pop('sampler').stop()
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def record_request(app, endpoint, method, status, stats):
+    """Count one finished request in /metrics; returns its Server-Timing header value."""
+    wall = time.perf_counter() - stats.started
+    labels = (('endpoint', endpoint),)
+
+    metrics.inc('trivia_requests_total', labels + (('method', method), ('status', status)))
+    metrics.observe('trivia_request_duration_seconds', labels, wall)
+    metrics.observe('trivia_db_duration_seconds', labels, stats.db_time)
+    metrics.observe('trivia_serialization_duration_seconds', labels, stats.serialize_time)
+    metrics.inc('trivia_db_queries_total', labels, stats.queries)
+    metrics.inc('trivia_db_rows_total', labels, stats.rows)
+
+    repeated = 0
+    for statement, count in stats.statements.items():
+        if count > 1:
+            repeated += count - 1
+        if count >= REPEATED_QUERY_THRESHOLD:
+            app.logger.warning('statement ran %d times in one request to %s: %s',
+                               count, endpoint, statement[:200])
+    if repeated:
+        metrics.inc('trivia_repeated_queries_total', labels, repeated)
+
+    return ', '.join([
+        'app;dur={:.3f}'.format(wall * 1000),
+        'db;dur={:.3f};desc="{} queries, {} repeated"'.format(
+            stats.db_time * 1000, stats.queries, repeated),
+        'serialize;dur={:.3f}'.format(stats.serialize_time * 1000),
+    ])
+
+
+def finish_request(app, response):
+    """Emit Server-Timing, update /metrics and flush a sampled profile."""
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    response.headers.add('Server-Timing', record_request(
+        app, endpoint, request.method, response.status_code, stats))
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        sampler = g.pop('sampler')
+        sampler.stop()
+        write_profile(app.config['PROFILE_DIR'], endpoint, profiler, sampler)
+    return response
+
+
+def write_profile(directory, endpoint, profiler, sampler):
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, '{}-{}-{}'.format(
+        int(time.time() * 1000), endpoint, threading.get_ident()))
+    profiler.dump_stats(base + '.prof')
+    with open(base + '.folded', 'w') as out:
+        out.write(sampler.folded())
@@ -0,0 +1,177 @@
+"""
+Paging engine shared by the question list endpoints.
+
+Pages are cut in SQL with LIMIT/OFFSET, or with a keyset cursor
+(``after_id``) so that deep pages cost the same as the first one.
+Totals come from the question_stats table (see stats.py) and are cached
+for a short time, in a CountCache of each app. The listings are read
+steps (see reads.py), shared by the Flask views and the ASGI handlers.
+"""
+import base64
+import functools
+import time
+from collections import namedtuple
+
+from flask import abort, current_app
+
+from .reads import QUESTION_COLUMNS_SQL, category_steps, run, session_fetch
+from .serialization import SHAPES, question_dict, shape_questions
+from .stats import TOTAL_SQL
+
+QUESTIONS_PER_PAGE = 10
+COUNT_TTL = 30
+
+Page = namedtuple('Page', ['questions', 'total', 'next_cursor'])
+
+
+def encode_cursor(last_id):
+    raw = 'q:{}'.format(last_id).encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the question id stored in ``cursor``, or raise ValueError."""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('malformed cursor')
+    prefix, _, last_id = raw.partition(':')
+    if prefix != 'q' or not last_id.isdigit():
+        raise ValueError('malformed cursor')
+    return int(last_id)
+
+
+class CountCache(object):
+    """
+    Question totals by key, 'all' or ('category', id), kept ``ttl``
+    seconds. One per app, as apps may point at different databases.
+    """
+
+    def __init__(self, ttl=COUNT_TTL):
+        self.ttl = ttl
+        self._counts = {}
+
+    def get(self, key):
+        cached = self._counts.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def put(self, key, total):
+        self._counts[key] = (time.monotonic() + self.ttl, total)
+
+    def clear(self):
+        self._counts.clear()
+
+
+def page_steps(counts, category_id=None, page=1, after_id=None, per_page=QUESTIONS_PER_PAGE):
+    """
+    Steps (see reads.py) loading one page of all questions, or of
+    ``category_id``, ordered by id.
+
+    With ``after_id`` the page starts right after that id (keyset paging),
+    otherwise ``page`` is translated into an OFFSET. One extra row is
+    fetched to know whether a next cursor should be handed out. The total
+    is read from question_stats through ``counts``, a CountCache.
+    """
+    where = []
+    params = []
+    if category_id is not None:
+        where.append('category = ?')
+        params.append(category_id)
+    count_sql = TOTAL_SQL
+    if where:
+        count_sql += ' WHERE ' + ' AND '.join(where)
+    count_params = list(params)
+
+    if after_id is not None:
+        where.append('id > ?')
+        params.append(after_id)
+    sql = QUESTION_COLUMNS_SQL
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY id LIMIT ?'
+    params.append(per_page + 1)
+    if after_id is None:
+        sql += ' OFFSET ?'
+        params.append((page - 1) * per_page)
+    rows = yield sql, params
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][3])
+
+    count_key = 'all' if category_id is None else ('category', category_id)
+    total = counts.get(count_key)
+    if total is None:
+        total = (yield count_sql, count_params)[0][0]
+        counts.put(count_key, total)
+    return Page(questions=[question_dict(row) for row in rows],
+                total=total, next_cursor=next_cursor)
+
+
+def fetch_page(category_id=None, page=1, after_id=None, per_page=QUESTIONS_PER_PAGE):
+    """One page of all questions or of ``category_id`` through db.session, see page_steps()."""
+    return run(page_steps(current_app.extensions['trivia']['counts'], category_id,
+                          page, after_id, per_page), session_fetch)
+
+
+def list_arguments(args):
+    """
+    The ``page``, ``after_id`` and ``shape`` of a question listing from
+    its query ``args`` (a werkzeug MultiDict). Raises ValueError on a bad
+    page number, cursor or shape.
+    """
+    page = args.get('page', 1, type=int)
+    if page < 1:
+        raise ValueError('page out of range')
+
+    after_id = None
+    cursor = args.get('after_id')
+    if cursor:
+        after_id = decode_cursor(cursor)
+
+    shape = args.get('shape', 'objects')
+    if shape not in SHAPES:
+        raise ValueError('unknown shape')
+    return page, after_id, shape
+
+
+def listing_steps(args, counts, category_cache, category_id=None, store=None):
+    """
+    Steps of GET /questions (``category_id`` None) and of
+    GET /categories/<id>/questions: the listing payload of the page asked
+    for in ``args``, read from ``store`` when there is a question store.
+    Aborts with 400 on bad arguments and 404 past the last page.
+    """
+    try:
+        page, after_id, shape = list_arguments(args)
+    except ValueError:
+        abort(400)
+    if store is not None:
+        result = yield functools.partial(store.page, category_id, page, after_id)
+    else:
+        result = yield from page_steps(counts, category_id, page, after_id)
+    if len(result.questions) == 0:
+        abort(404)
+
+    categories = yield from category_steps(category_cache)
+    if category_id is None:
+        return {
+            'questions': shape_questions(result.questions, shape),
+            'total_questions': result.total,
+            'categories': categories,
+            'current_category': "all",
+            'next_cursor': result.next_cursor
+        }
+    if category_id not in categories:
+        abort(500)
+    return {
+        'questions': shape_questions(result.questions, shape),
+        'total_questions': result.total,
+        'current_category': categories[category_id],
+        'next_cursor': result.next_cursor
+    }
+
@@ -0,0 +1,474 @@
+"""
+In-process copy of the question bank for the read endpoints.
+
+With QUESTION_STORE set, question pages and quiz sampling are served
+from memory. Questions are held in columns ordered by id: ids in an
+array of int64, category and difficulty as 16 bit codes into small value
+tables, question texts in a list and answers, which repeat a lot, in a
+list of interned strings. Every category has a sorted id array of its
+own, so any page is a bisect and a slice.
+
+The store follows the question_changes feed (migration 0006): sync()
+reads the entries past the last one it applied and reloads just those
+questions. It runs at most every poll interval, and right away after a
+local write (mark_stale) or, on Postgres, a NOTIFY on question_changes.
+Feed ids lower than the last one seen that are still missing belong to
+transactions in flight, they are looked for again for GAP_TIMEOUT
+seconds. A large change, or a feed pruned past the last entry seen,
+reloads everything.
+
+QUESTION_STORE = 'snapshot:///path' keeps the columns in a memory-mapped
+snapshot file (see snapshot.py) shared by all workers of the host
+instead. A change then has the file rebuilt, by whichever worker gets
+there first, and every worker maps the new file.
+"""
+import array
+import bisect
+import select
+import sys
+import threading
+import time
+
+from sqlalchemy import bindparam, text
+
+from models import db
+from migrations import QUESTION_CHANGES_CHANNEL
+from .pagination import QUESTIONS_PER_PAGE, Page, encode_cursor
+from .serialization import question_dict
+from .snapshot import build_lock, open_snapshot, write_snapshot
+
+POLL_INTERVAL = 1.0
+LISTEN_POLL_INTERVAL = 30.0
+LISTEN_TIMEOUT = 60.0
+GAP_TIMEOUT = 60.0
+GAP_WINDOW = 1000
+RELOAD_THRESHOLD = 10000
+CHANGE_FEED_KEEP = 100000
+
+QUESTION_SQL = 'SELECT id, category, difficulty, question, answer FROM questions'
+# two subqueries, SQLite only reads min() or max() off the index on its own
+FEED_BOUNDS_SQL = ('SELECT (SELECT min(id) FROM question_changes), '
+                   '(SELECT max(id) FROM question_changes)')
+
+EMPTY = array.array('q')
+
+
+class ValueCodes(object):
+    """Small integer codes for the few distinct values of a column."""
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class QuestionColumns(object):
+    """The bank as columns in id order, see the module docstring."""
+
+    def __init__(self):
+        self.ids = array.array('q')
+        self.category_codes = array.array('H')
+        self.difficulty_codes = array.array('H')
+        self.questions = []
+        self.answers = []
+        self.categories = ValueCodes()
+        self.difficulties = ValueCodes()
+        self.by_category = {}
+        self.strings = {}
+
+    def intern(self, value):
+        return self.strings.setdefault(value, value)
+
+    def position(self, question_id):
+        position = bisect.bisect_left(self.ids, question_id)
+        if position < len(self.ids) and self.ids[position] == question_id:
+            return position
+        return None
+
+    def append(self, row):
+        """Add a row with an id above every id held, as a full load does."""
+        question_id, category, difficulty, question, answer = row
+        self.ids.append(question_id)
+        self.category_codes.append(self.categories.code(category))
+        self.difficulty_codes.append(self.difficulties.code(difficulty))
+        self.questions.append(question)
+        self.answers.append(self.intern(answer))
+        if category is not None:
+            self.by_category.setdefault(category, array.array('q')).append(question_id)
+
+    def put(self, row):
+        """Insert or replace a row; replacing is a remove and an insert."""
+        question_id, category, difficulty, question, answer = row
+        self.remove(question_id)
+        position = bisect.bisect_left(self.ids, question_id)
+        self.ids.insert(position, question_id)
+        self.category_codes.insert(position, self.categories.code(category))
+        self.difficulty_codes.insert(position, self.difficulties.code(difficulty))
+        self.questions.insert(position, question)
+        self.answers.insert(position, self.intern(answer))
+        if category is not None:
+            bisect.insort(self.by_category.setdefault(category, array.array('q')), question_id)
+
+    def remove(self, question_id):
+        position = self.position(question_id)
+        if position is None:
+            return
+        self._unindex(self.categories.values[self.category_codes[position]], question_id)
+        del self.ids[position]
+        del self.category_codes[position]
+        del self.difficulty_codes[position]
+        del self.questions[position]
+        del self.answers[position]
+
+    def _unindex(self, category, question_id):
+        ids = self.by_category.get(category)
+        if ids is None:
+            return
+        position = bisect.bisect_left(ids, question_id)
+        if position < len(ids) and ids[position] == question_id:
+            del ids[position]
+
+    def row(self, position):
+        """The question_dict row (answer, category, difficulty, id, question) at ``position``."""
+        return (self.answers[position],
+                self.categories.values[self.category_codes[position]],
+                self.difficulties.values[self.difficulty_codes[position]],
+                self.ids[position],
+                self.questions[position])
+
+    def index_rows(self):
+        categories = self.categories.values
+        difficulties = self.difficulties.values
+        return [(question_id, categories[category_code], difficulties[difficulty_code])
+                for question_id, category_code, difficulty_code
+                in zip(self.ids, self.category_codes, self.difficulty_codes)]
+
+    def memory_usage(self):
+        arrays = [self.ids, self.category_codes, self.difficulty_codes] + list(self.by_category.values())
+        array_bytes = sum(sys.getsizeof(column) for column in arrays)
+        text_bytes = (sum(sys.getsizeof(question) for question in self.questions)
+                      + sum(sys.getsizeof(answer) for answer in self.strings))
+        container_bytes = (sys.getsizeof(self.questions) + sys.getsizeof(self.answers)
+                           + sys.getsizeof(self.strings))
+        total = array_bytes + text_bytes + container_bytes
+        return {
+            'arrays': array_bytes,
+            'text': text_bytes,
+            'containers': container_bytes,
+            'total': total,
+            'per_question': round(total / len(self.ids), 1) if self.ids else 0,
+        }
+
+
+class QuestionStore(object):
+
+    def __init__(self, app, poll_interval=POLL_INTERVAL, listen=True, snapshot_path=None):
+        self.app = app
+        self.snapshot_path = snapshot_path
+        self.poll_interval = poll_interval
+        self.listen = listen
+        self.listening = False
+        self.version = 0
+        self.full_loads = 0
+        self.syncs = 0
+        self.changes_applied = 0
+        self._columns = None
+        self._last_change = 0
+        self._gaps = {}
+        self._due = True
+        self._polled_at = 0
+        self._listener = None
+        self._lock = threading.Lock()
+        self._syncing = threading.Lock()
+
+    def mark_stale(self):
+        """Have the next read look at the change feed, e.g. after a local write."""
+        self._due = True
+
+    def _sync_due(self):
+        if self._due or self._columns is None:
+            return True
+        interval = self.poll_interval
+        if self.listening and not self._gaps:
+            interval = max(interval, LISTEN_POLL_INTERVAL)
+        return time.monotonic() - self._polled_at >= interval
+
+    def sync(self):
+        """Catch up with the change feed when a poll is due."""
+        if not self._sync_due():
+            return
+        with self._syncing:
+            if not self._sync_due():
+                return
+            # cleared first, so a notification arriving meanwhile is not lost
+            self._due = False
+            self._polled_at = time.monotonic()
+            engine = db.get_engine(self.app)
+            self._start_listener(engine)
+            try:
+                with engine.connect() as connection:
+                    if self._columns is None:
+                        self._reload(connection)
+                    else:
+                        self._follow(connection)
+            except Exception:
+                self._due = True
+                raise
+
+    def _reload(self, connection):
+        if self.snapshot_path is not None:
+            self._use_snapshot(self._snapshot(connection))
+            return
+        last_change = self._feed_bounds(connection)[1] or 0
+        gaps = self._recent_gaps(connection, last_change)
+        columns = QuestionColumns()
+        for row in self._question_rows(connection):
+            columns.append(row)
+        with self._lock:
+            self._columns = columns
+            self._last_change = last_change
+            self._gaps = gaps
+            self.version += 1
+            self.full_loads += 1
+
+    @staticmethod
+    def _feed_bounds(connection):
+        return connection.execute(text(FEED_BOUNDS_SQL)).first()
+
+    @staticmethod
+    def _question_rows(connection):
+        rows = connection.execution_options(stream_results=True).execute(
+            text(QUESTION_SQL + ' ORDER BY id'))
+        return (tuple(row) for row in rows)
+
+    def _recent_gaps(self, connection, last_change):
+        """
+        Gaps among the last GAP_WINDOW feed ids. Read before the questions,
+        so an entry committed in between is both in the rows and no gap.
+        """
+        recent = connection.execute(text(
+            'SELECT id FROM question_changes WHERE id > :start AND id <= :last'),
+            start=last_change - GAP_WINDOW, last=last_change)
+        gaps = {}
+        self._note_gaps(gaps, [row[0] for row in recent],
+                        max(last_change - GAP_WINDOW, 0), last_change)
+        return gaps
+
+    @staticmethod
+    def _note_gaps(gaps, seen, after, last):
+        """Record the ids in (after, last] missing from ``seen`` as gaps."""
+        now = time.monotonic()
+        seen = set(seen)
+        for change_id in range(after + 1, last + 1):
+            if change_id not in seen:
+                gaps.setdefault(change_id, now)
+
+    def _snapshot(self, connection, change_ids=None):
+        """
+        The snapshot file once it reflects ``change_ids``, or on a first
+        load the whole feed, rebuilding it under the host wide lock when
+        it does not.
+        """
+        def fresh(snapshot):
+            if snapshot is None:
+                return False
+            if change_ids is None:
+                return snapshot.last_change >= (self._feed_bounds(connection)[1] or 0)
+            return snapshot.covers(change_ids)
+
+        snapshot = self._columns
+        if snapshot is None or snapshot.changed_on_disk():
+            snapshot = open_snapshot(self.snapshot_path)
+        if fresh(snapshot):
+            return snapshot
+        with build_lock(self.snapshot_path):
+            # another worker may have rebuilt it while we waited
+            snapshot = open_snapshot(self.snapshot_path)
+            if fresh(snapshot):
+                return snapshot
+            built_at = time.time()
+            last_change = self._feed_bounds(connection)[1] or 0
+            gaps = self._recent_gaps(connection, last_change)
+            write_snapshot(self.snapshot_path, self._question_rows(connection),
+                           last_change, gaps, built_at)
+            self.full_loads += 1
+        return open_snapshot(self.snapshot_path)
+
+    def _use_snapshot(self, snapshot):
+        # gaps recorded at build time expire GAP_TIMEOUT after the build
+        seen = time.monotonic() - max(time.time() - snapshot.built_at, 0)
+        with self._lock:
+            if snapshot is not self._columns:
+                self._columns = snapshot
+                self.version += 1
+            self._last_change = snapshot.last_change
+            self._gaps = {change_id: seen for change_id in snapshot.gaps}
+
+    def _follow(self, connection):
+        lowest, highest = self._feed_bounds(connection)
+        if highest is None or (highest <= self._last_change and not self._gaps):
+            return
+        if lowest > self._last_change + 1:
+            # entries we have not seen were pruned
+            self._reload(connection)
+            return
+
+        sql = 'SELECT id, question_id FROM question_changes WHERE id > :last'
+        params = {'last': self._last_change}
+        if self._gaps:
+            sql += ' OR id IN :gaps'
+            params['gaps'] = sorted(self._gaps)
+        statement = text(sql + ' ORDER BY id')
+        if self._gaps:
+            statement = statement.bindparams(bindparam('gaps', expanding=True))
+        changes = connection.execute(statement, params).fetchall()
+        question_ids = set(question_id for _, question_id in changes)
+        change_ids = [change_id for change_id, _ in changes]
+        if self.snapshot_path is not None and question_ids:
+            self._use_snapshot(self._snapshot(connection, change_ids))
+            self.changes_applied += len(question_ids)
+            self.syncs += 1
+            return
+        if len(question_ids) > RELOAD_THRESHOLD:
+            self._reload(connection)
+            return
+
+        rows = []
+        if question_ids:
+            rows = connection.execute(
+                text(QUESTION_SQL + ' WHERE id IN :ids').bindparams(bindparam('ids', expanding=True)),
+                ids=sorted(question_ids)).fetchall()
+
+        gaps = dict(self._gaps)
+        for change_id in change_ids:
+            gaps.pop(change_id, None)
+        last_change = max([self._last_change] + change_ids)
+        self._note_gaps(gaps, change_ids, self._last_change, last_change)
+        expired = time.monotonic() - GAP_TIMEOUT
+        gaps = {change_id: seen for change_id, seen in gaps.items() if seen > expired}
+
+        with self._lock:
+            found = set()
+            for row in rows:
+                self._columns.put(tuple(row))
+                found.add(row[0])
+            for question_id in question_ids - found:
+                self._columns.remove(question_id)
+            self._last_change = last_change
+            self._gaps = gaps
+            if question_ids:
+                self.version += 1
+                self.changes_applied += len(question_ids)
+            self.syncs += 1
+
+    def _start_listener(self, engine):
+        if not self.listen or self._listener is not None or engine.dialect.name != 'postgresql':
+            return
+        self._listener = threading.Thread(target=self._listen, args=(engine,),
+                                          name='question-store-listener', daemon=True)
+        self._listener.start()
+
+    def _listen(self, engine):
+        """Mark the store stale on every NOTIFY; polling carries on should this stop."""
+        try:
+            connection = engine.raw_connection()
+            connection.detach()
+            listener = connection.connection
+            listener.autocommit = True
+            listener.cursor().execute('LISTEN {}'.format(QUESTION_CHANGES_CHANNEL))
+            self.listening = True
+            while True:
+                if select.select([listener], [], [], LISTEN_TIMEOUT)[0]:
+                    listener.poll()
+                    if listener.notifies:
+                        del listener.notifies[:]
+                        self.mark_stale()
+        except Exception:
+            self.app.logger.exception('question store listener stopped, polling only')
+        finally:
+            self.listening = False
+
+    # reads
+
+    def page(self, category_id=None, page=1, after_id=None, per_page=QUESTIONS_PER_PAGE):
+        """Same as pagination.fetch_page, for all questions or one category."""
+        self.sync()
+        with self._lock:
+            columns = self._columns
+            ids = columns.ids if category_id is None else columns.by_category.get(category_id, EMPTY)
+            if after_id is not None:
+                start = bisect.bisect_right(ids, after_id)
+            else:
+                start = (page - 1) * per_page
+            selected = ids[start:start + per_page + 1]
+            next_cursor = None
+            if len(selected) > per_page:
+                selected = selected[:per_page]
+                next_cursor = encode_cursor(selected[-1])
+            questions = [question_dict(columns.row(columns.position(question_id)))
+                         for question_id in selected]
+            return Page(questions=questions, total=len(ids), next_cursor=next_cursor)
+
+    def questions(self, question_ids):
+        """question_dict rows by id for the given ids that exist."""
+        self.sync()
+        with self._lock:
+            columns = self._columns
+            found = {}
+            for question_id in question_ids:
+                position = columns.position(question_id)
+                if position is not None:
+                    found[question_id] = question_dict(columns.row(position))
+            return found
+
+    def index_rows(self):
+        """(id, category, difficulty) rows in id order, for QuestionIdIndex.load."""
+        self.sync()
+        with self._lock:
+            return self._columns.index_rows()
+
+    def stats(self):
+        with self._lock:
+            columns = self._columns
+            return {
+                'mode': 'memory' if self.snapshot_path is None else 'snapshot',
+                'loaded': columns is not None,
+                'questions': len(columns.ids) if columns is not None else 0,
+                'version': self.version,
+                'last_change': self._last_change,
+                'pending_gaps': len(self._gaps),
+                'full_loads': self.full_loads,
+                'syncs': self.syncs,
+                'changes_applied': self.changes_applied,
+                'listening': self.listening,
+                'memory': columns.memory_usage() if columns is not None else None,
+            }
+
+
+def prune_changes(keep=CHANGE_FEED_KEEP):
+    """Delete all but the newest ``keep`` change feed entries; the caller commits."""
+    return db.session.execute(text(
+        'DELETE FROM question_changes WHERE id <= '
+        '(SELECT max(id) FROM question_changes) - :keep'), {'keep': keep}).rowcount
+
+
+def make_question_store(app, setting=None):
+    """
+    The store named by ``setting``: None or False for none, True or
+    memory:// for columns in this process, snapshot:///path for a
+    snapshot file shared by the workers of the host.
+    """
+    if not setting:
+        return None
+    poll_interval = app.config.get('QUESTION_STORE_POLL_INTERVAL', POLL_INTERVAL)
+    if setting is True or setting.startswith('memory://'):
+        return QuestionStore(app, poll_interval)
+    if setting.startswith('snapshot://'):
+        return QuestionStore(app, poll_interval, snapshot_path=setting[len('snapshot://'):])
+    raise ValueError('unsupported question store: {}'.format(setting))
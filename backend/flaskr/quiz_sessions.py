@@ -0,0 +1,148 @@
+"""
+Server-side quiz sessions.
+
+A session holds its category and the set of question ids already served,
+so the client only sends its session id and each turn draws from the
+shared question index, excluding that set. A session costs memory for
+the questions it has played, not for the whole bank, and questions added
+or deleted mid-quiz are picked up by the index.
+
+Sessions live in a bounded, TTL-evicted store: an in-process dict by
+default (memory://), or Redis when QUIZ_SESSION_STORE is a redis:// URL.
+memory:// only suits a single process: with several workers a session
+is only known to the worker that created it, so set QUIZ_SESSION_STORE
+to redis:// there.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+SESSION_TTL = 30 * 60
+MAX_SESSIONS = 10000
+
+
+class MemorySessionStore(object):
+    """Sessions kept in this process, least recently used first."""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self, now):
+        # entries are ordered by last use, so expired ones sit at the front
+        while self._sessions:
+            session_id, (expires, _, _) = next(iter(self._sessions.items()))
+            if expires > now:
+                break
+            del self._sessions[session_id]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _touch(self, session_id, now):
+        self._evict(now)
+        entry = self._sessions[session_id]
+        entry[0] = now + self.ttl
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def create(self, category_id):
+        session_id = uuid.uuid4().hex
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_id] = [now + self.ttl, category_id, set()]
+            self._evict(now)
+        return session_id
+
+    def get(self, session_id):
+        """
+        Return the category id and a copy of the served ids of the session.
+        Raises KeyError for unknown or expired sessions.
+        """
+        with self._lock:
+            _, category_id, served = self._touch(session_id, time.monotonic())
+            return category_id, set(served)
+
+    def mark_served(self, session_id, question_id):
+        """
+        Record ``question_id`` as served, False if it already was (another
+        turn of the session got it first). Raises KeyError like get().
+        """
+        with self._lock:
+            served = self._touch(session_id, time.monotonic())[2]
+            if question_id in served:
+                return False
+            served.add(question_id)
+            return True
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class RedisSessionStore(object):
+    """
+    Sessions kept in Redis: the category under the session key and the
+    served ids in a set next to it. ``client`` is anything with the
+    redis-py interface, so a local stand-in such as fakeredis works as well.
+    """
+
+    def __init__(self, client, ttl=SESSION_TTL, prefix='trivia:quiz:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _keys(self, session_id):
+        key = self.prefix + session_id
+        # an empty Redis set does not exist, so liveness is kept in the key
+        return key, key + ':served'
+
+    def create(self, category_id):
+        session_id = uuid.uuid4().hex
+        self.client.set(self._keys(session_id)[0], category_id, ex=self.ttl)
+        return session_id
+
+    def get(self, session_id):
+        alive, served_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.get(alive)
+        pipe.expire(alive, self.ttl)
+        pipe.smembers(served_key)
+        pipe.expire(served_key, self.ttl)
+        category_id, _, served, _ = pipe.execute()
+        if category_id is None:
+            raise KeyError(session_id)
+        return int(category_id), {int(question_id) for question_id in served}
+
+    def mark_served(self, session_id, question_id):
+        alive, served_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.expire(alive, self.ttl)
+        pipe.sadd(served_key, question_id)
+        pipe.expire(served_key, self.ttl)
+        refreshed, added, _ = pipe.execute()
+        if not refreshed:
+            self.client.delete(served_key)
+            raise KeyError(session_id)
+        return bool(added)
+
+    def discard(self, session_id):
+        self.client.delete(*self._keys(session_id))
+
+
+def make_session_store(url=None):
+    """
+    Build the store named by ``url``: None or memory:// for this process
+    only, redis:// for sessions shared by every worker.
+    """
+    if not url or url.startswith('memory://'):
+        return MemorySessionStore()
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(url))
+    raise ValueError('unsupported quiz session store: {}'.format(url))
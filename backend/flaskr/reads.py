@@ -0,0 +1,69 @@
+"""
+Database reads shared by the Flask views and the native ASGI handlers.
+
+A read is written once as a generator of steps: it yields ``(sql,
+params)`` with ``?`` placeholders and is sent back the rows as tuples,
+or yields a function to call for blocking work that is not SQL (the
+question store). run() drives the steps with a blocking fetch in a
+Flask request, run_async() with the async driver of flaskr.asgi, so
+both serving modes execute the same SQL and the same checks. Steps
+abort() like a view does.
+"""
+import re
+
+from sqlalchemy import text
+
+from models import db
+
+CATEGORIES_SQL = 'SELECT id, type FROM categories ORDER BY id'
+QUESTION_COLUMNS_SQL = 'SELECT answer, category, difficulty, id, question FROM questions'
+QUESTION_INDEX_SQL = 'SELECT id, category, difficulty FROM questions ORDER BY id'
+
+
+def questions_by_id_sql(count):
+    return QUESTION_COLUMNS_SQL + ' WHERE id IN ({})'.format(', '.join('?' * count))
+
+
+def run(steps, fetch):
+    """Drive ``steps`` with the blocking ``fetch(sql, *params)``; returns their result."""
+    try:
+        step = next(steps)
+        while True:
+            step = steps.send(step() if callable(step) else fetch(step[0], *step[1]))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_async(steps, fetch, call):
+    """
+    Drive ``steps`` with the coroutine ``fetch(sql, *params)``. Blocking
+    steps go to the coroutine ``call(function)``, e.g. a thread pool.
+    """
+    try:
+        step = next(steps)
+        while True:
+            if callable(step):
+                step = steps.send(await call(step))
+            else:
+                step = steps.send(await fetch(step[0], *step[1]))
+    except StopIteration as stop:
+        return stop.value
+
+
+def session_fetch(sql, *params):
+    """Rows of ``sql`` through db.session, so replica routing and instrumentation apply."""
+    counter = iter(range(len(params)))
+    named = re.sub(r'\?', lambda match: ':p{}'.format(next(counter)), sql)
+    result = db.session.execute(text(named), {'p{}'.format(index): value
+                                              for index, value in enumerate(params)})
+    return [tuple(row) for row in result]
+
+
+def category_steps(category_cache):
+    """The category dictionary, loaded into ``category_cache`` when it is not fresh."""
+    categories = category_cache.peek()
+    if categories is None:
+        rows = yield CATEGORIES_SQL, ()
+        categories = {category_id: category_type for category_id, category_type in rows}
+        category_cache.put(categories)
+    return categories
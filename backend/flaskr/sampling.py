@@ -0,0 +1,407 @@
+"""
+Question selection for the quiz endpoint.
+
+The question ids of every (category, difficulty) pair are kept in a
+WeightedPool: a Fenwick tree over per-question weights, so drawing a
+weighted question and changing one weight both cost O(log n). Serves are
+numbered and a question's weight decays with the number of its last
+serve (least recently served balancing). The pools themselves are
+weighted per draw by how far their difficulty is from the requested
+one, which is how fixed difficulties and difficulty ramps are served.
+Excluded (already played) questions are rejected by probing, with a full
+scan only when most of the category has been played.
+"""
+import functools
+import random
+import threading
+import time
+
+from flask import abort
+
+from .reads import QUESTION_INDEX_SQL, questions_by_id_sql, run, session_fetch
+from .serialization import question_dict
+
+ALL_CATEGORIES = 0
+INDEX_TTL = 60
+PROBES = 8
+DIFFICULTY_FALLOFF = 0.25
+RAMP_EVERY = 2
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+MAX_BATCH = 50
+RECENCY_DECAY = 0.98
+RECENCY_WINDOW = 500
+
+
+def difficulty_weight(difficulty, target=None):
+    """Relative weight of ``difficulty`` when ``target`` is asked for."""
+    if target is None:
+        return 1.0
+    return DIFFICULTY_FALLOFF ** abs((difficulty or 0) - target)
+
+
+def ramp_target(played):
+    """Target difficulty after ``played`` questions: one step every RAMP_EVERY."""
+    return min(MIN_DIFFICULTY + played // RAMP_EVERY, MAX_DIFFICULTY)
+
+
+def quiz_target(body, played):
+    """
+    Target difficulty of a quiz request: a fixed ``difficulty``, a ramp
+    when ``ramp`` is true, or None. Raises ValueError unless ``ramp`` is a
+    boolean and ``difficulty`` an integer from MIN_DIFFICULTY to
+    MAX_DIFFICULTY.
+    """
+    ramp = body.get('ramp')
+    if ramp is not None and not isinstance(ramp, bool):
+        raise ValueError('ramp is not a boolean')
+    if ramp:
+        return ramp_target(played)
+    difficulty = body.get('difficulty')
+    if difficulty is None:
+        return None
+    if not isinstance(difficulty, int) or isinstance(difficulty, bool):
+        raise ValueError('difficulty is not an integer')
+    if not MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY:
+        raise ValueError('difficulty out of range')
+    return difficulty
+
+
+def quiz_batch_size(body):
+    """
+    The ``count`` of a quiz request, None when absent. Raises ValueError
+    unless it is an integer from 1 to MAX_BATCH.
+    """
+    count = body.get('count')
+    if count is None:
+        return None
+    if not isinstance(count, int) or isinstance(count, bool):
+        raise ValueError('count is not an integer')
+    if not 1 <= count <= MAX_BATCH:
+        raise ValueError('count out of range')
+    return count
+
+
+def quiz_steps(index, body, logger):
+    """
+    Steps (see reads.py) of POST /quizzes for the decoded JSON ``body``,
+    drawn from the QuestionIdIndex ``index``. Aborts with 500 when the
+    body or its quiz_category is malformed, after logging it to ``logger``,
+    and with 422 on a bad ``count``, ``difficulty`` or ``ramp``.
+    """
+    try:
+        previous_questions = body.get('previous_questions') or []
+        category_id = int(body.get('quiz_category')['id'])
+    except Exception:
+        logger.exception('malformed quiz request')
+        abort(500)
+    try:
+        count = quiz_batch_size(body)
+        targets = [quiz_target(body, len(previous_questions) + position)
+                   for position in range(count or 1)]
+    except ValueError:
+        abort(422)
+
+    questions = yield from index.draw_steps(category_id, count or 1, previous_questions, targets)
+    if count is not None:
+        return {
+            'questions': questions,
+            'question': questions[0] if questions else None
+        }
+    # quiz exhausted, the frontend ends the game on a null question
+    return {
+        'question': questions[0] if questions else None
+    }
+
+
+def served_weight(last_served, base):
+    """
+    Weight of a question last served by serve number ``last_served`` (None
+    if never served). Each later serve makes it RECENCY_DECAY times heavier
+    than the question served after it; serves up to ``base`` are forgotten.
+    """
+    if last_served is None or last_served <= base:
+        return 1.0
+    return RECENCY_DECAY ** (last_served - base)
+
+
+class FenwickTree(object):
+    """Prefix sums over float weights with O(log n) update and search."""
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self._tree = [0.0] + list(weights)
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self._tree[parent] += self._tree[index]
+
+    def add(self, position, delta):
+        index = position + 1
+        while index <= self.size:
+            self._tree[index] += delta
+            index += index & -index
+
+    def total(self):
+        total = 0.0
+        index = self.size
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def find(self, value):
+        """Position of the first element whose prefix sum exceeds ``value``."""
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            upper = index + step
+            if upper <= self.size and self._tree[upper] <= value:
+                index = upper
+                value -= self._tree[upper]
+            step >>= 1
+        return min(index, self.size - 1)
+
+
+class WeightedPool(object):
+
+    def __init__(self, ids, weights):
+        self.ids = ids
+        self.weights = list(weights)
+        self.positions = {question_id: position for position, question_id in enumerate(ids)}
+        self.tree = FenwickTree(self.weights)
+
+    def total(self):
+        return self.tree.total()
+
+    def sample(self):
+        return self.ids[self.tree.find(random.random() * self.total())]
+
+    def weight(self, question_id):
+        return self.weights[self.positions[question_id]]
+
+    def set_weight(self, question_id, weight):
+        position = self.positions[question_id]
+        self.tree.add(position, weight - self.weights[position])
+        self.weights[position] = weight
+
+
+class QuestionIdIndex(object):
+
+    def __init__(self, ttl=INDEX_TTL, store=None):
+        self.ttl = ttl
+        self.store = store
+        self._store_version = None
+        self._by_category = None
+        self._pools = None
+        self._placement = None
+        self._served = {}
+        self._serves = 0
+        self._base = -RECENCY_WINDOW
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+
+    def invalidate(self):
+        self._by_category = None
+
+    def stale(self):
+        if self.store is not None and self.store.version != self._store_version:
+            return True
+        return (self._by_category is None
+                or time.monotonic() - self._loaded_at > self.ttl)
+
+    def load(self, rows):
+        """Rebuild the index from (id, category, difficulty) rows in id order."""
+        by_category = {ALL_CATEGORIES: []}
+        grouped = {ALL_CATEGORIES: {}}
+        placement = {}
+        for question_id, category, difficulty in rows:
+            category = None if category is None else int(category)
+            by_category[ALL_CATEGORIES].append(question_id)
+            grouped[ALL_CATEGORIES].setdefault(difficulty, []).append(question_id)
+            if category is not None:
+                by_category.setdefault(category, []).append(question_id)
+                grouped.setdefault(category, {}).setdefault(difficulty, []).append(question_id)
+            placement[question_id] = (category, difficulty)
+
+        with self._lock:
+            base = self._serves - RECENCY_WINDOW
+            served = {question_id: serve for question_id, serve in self._served.items()
+                      if serve > base and question_id in placement}
+        pools = {
+            category: {
+                difficulty: WeightedPool(ids, [served_weight(served.get(question_id), base)
+                                               for question_id in ids])
+                for difficulty, ids in by_difficulty.items()
+            }
+            for category, by_difficulty in grouped.items()
+        }
+        with self._lock:
+            self._served = {question_id: serve for question_id, serve in self._served.items()
+                            if serve > base and question_id in placement}
+            self._base = base
+            self._pools = pools
+            self._placement = placement
+            self._by_category = by_category
+            self._loaded_at = time.monotonic()
+
+    def loaded_ids(self, category_id):
+        by_category = self._by_category
+        return [] if by_category is None else by_category.get(category_id, [])
+
+    def ensure_loaded(self):
+        if self.store is not None:
+            self.store.sync()
+        if self.stale():
+            with self._loading:
+                if self.stale():
+                    self.reload()
+
+    def reload(self):
+        if self.store is None:
+            self.load(session_fetch(QUESTION_INDEX_SQL))
+            return
+        version = self.store.version
+        self.load(self.store.index_rows())
+        self._store_version = version
+
+    def fetch(self, question_ids):
+        """question_dict rows of the ``question_ids`` that still exist, by id."""
+        if self.store is not None:
+            return self.store.questions(question_ids)
+        if not question_ids:
+            return {}
+        rows = session_fetch(questions_by_id_sql(len(question_ids)), *question_ids)
+        return {row[3]: question_dict(row) for row in rows}
+
+    def ids(self, category_id):
+        self.ensure_loaded()
+        return self.loaded_ids(category_id)
+
+    def choose(self, category_id, exclude=(), target=None):
+        """
+        Weighted random id of ``category_id`` that is not in ``exclude``,
+        or None. Uses the loaded index as is, see ensure_loaded().
+        """
+        exclude = set(exclude)
+        with self._lock:
+            pools = (self._pools or {}).get(category_id, {})
+            weighted = [(pool, difficulty_weight(difficulty, target) * pool.total())
+                        for difficulty, pool in pools.items()]
+            total = sum(weight for _, weight in weighted)
+            if total <= 0:
+                return None
+            for _ in range(PROBES):
+                point = random.random() * total
+                for pool, weight in weighted:
+                    point -= weight
+                    if point < 0:
+                        break
+                candidate = pool.sample()
+                if candidate not in exclude:
+                    return candidate
+            remaining = [(question_id, difficulty_weight(difficulty, target) * pool.weight(question_id))
+                         for difficulty, pool in pools.items()
+                         for question_id in pool.ids if question_id not in exclude]
+        if not remaining:
+            return None
+        ids, weights = zip(*remaining)
+        return random.choices(ids, weights)[0]
+
+    def choose_many(self, category_id, count, exclude=(), targets=None):
+        """
+        Up to ``count`` distinct ids, drawn one after the other with the
+        target difficulty ``targets[i]`` for the i-th draw when given.
+        """
+        exclude = set(exclude)
+        chosen = []
+        for position in range(count):
+            question_id = self.choose(category_id, exclude,
+                                      targets[position] if targets else None)
+            if question_id is None:
+                break
+            chosen.append(question_id)
+            exclude.add(question_id)
+        return chosen
+
+    def mark_served(self, question_id):
+        """Make ``question_id`` the lightest question so the least recently served come first."""
+        with self._lock:
+            if self._placement is None or question_id not in self._placement:
+                return
+            self._serves += 1
+            self._served[question_id] = self._serves
+            if self._serves - self._base > 2 * RECENCY_WINDOW:
+                self._rebase()
+            else:
+                self._set_served_weight(question_id)
+
+    def _rebase(self):
+        # Weights only depend on serves after the base, so moving it keeps
+        # the weights away from float underflow. Only the questions served
+        # since the old base change.
+        self._base = self._serves - RECENCY_WINDOW
+        for question_id in list(self._served):
+            self._set_served_weight(question_id)
+            if self._served[question_id] <= self._base:
+                del self._served[question_id]
+
+    def _set_served_weight(self, question_id):
+        weight = served_weight(self._served[question_id], self._base)
+        category, difficulty = self._placement[question_id]
+        for key in (ALL_CATEGORIES, category):
+            pool = self._pools.get(key, {}).get(difficulty)
+            if pool is not None:
+                pool.set_weight(question_id, weight)
+
+    def draw_steps(self, category_id, count, exclude=(), targets=None):
+        """
+        Steps (see reads.py) drawing up to ``count`` distinct question dicts
+        of ``category_id`` (0 for all categories) in draw order, loaded with
+        one query. Fewer come back once the quiz runs out of questions or
+        when drawn questions were deleted meanwhile; if all of them were,
+        the draw is retried once on a fresh index.
+        """
+        exclude = set(exclude)
+        if self.store is not None:
+            yield self.store.sync
+        for _ in range(2):
+            if self.stale():
+                if self.store is not None:
+                    yield self.reload
+                else:
+                    self.load((yield QUESTION_INDEX_SQL, ()))
+            question_ids = self.choose_many(category_id, count, exclude, targets)
+            if not question_ids:
+                return []
+            if self.store is not None:
+                rows = yield functools.partial(self.store.questions, question_ids)
+            else:
+                rows = yield questions_by_id_sql(len(question_ids)), question_ids
+                rows = {row[3]: question_dict(row) for row in rows}
+            found = [question_id for question_id in question_ids if question_id in rows]
+            for question_id in found:
+                self.mark_served(question_id)
+            if found:
+                if len(found) < len(question_ids):
+                    # some were deleted by another worker since the index was built
+                    self.invalidate()
+                return [rows[question_id] for question_id in found]
+            self.invalidate()
+            exclude.update(question_ids)
+        return []
+
+    def draw(self, category_id, exclude=(), target=None):
+        """
+        Return a question dict of ``category_id`` (0 for all categories)
+        that is not in ``exclude``, weighted towards difficulty ``target`` when
+        given, or None once the quiz is exhausted.
+        """
+        questions = self.draw_many(category_id, 1, exclude, [target])
+        return questions[0] if questions else None
+
+    def draw_many(self, category_id, count, exclude=(), targets=None):
+        """draw_steps() through db.session, after a locked reload of a stale index."""
+        self.ensure_loaded()
+        return run(self.draw_steps(category_id, count, exclude, targets), session_fetch)
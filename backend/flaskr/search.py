@@ -0,0 +1,133 @@
+"""
+Question search.
+
+On Postgres the questions table carries a ``search_vector`` tsvector
+(migration 0004), so a search is a GIN index lookup rather than a
+sequential scan. Other databases, SQLite in the tests, use an
+in-process inverted index, rebuilt after local writes and at the latest
+every SEARCH_INDEX_TTL seconds for those of other workers. Terms are
+ANDed and matched as word prefixes, results are ranked and paginated.
+Both sides use the 'simple' text search configuration (migration 0009):
+no stemming and no stopwords, so "the" finds the same questions on
+either.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import func, literal_column
+
+from models import Question, db
+from .pagination import QUESTIONS_PER_PAGE, Page, fetch_page
+from .serialization import question_dict, question_rows
+
+QUESTION_WEIGHT = 1.0
+ANSWER_WEIGHT = 0.4
+SEARCH_INDEX_TTL = 60
+
+_token = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def tokenize(text_value):
+    return _token.findall((text_value or '').lower())
+
+
+class InvertedIndex(object):
+    """Token -> question ids maps for the question and answer fields."""
+
+    def __init__(self, rows):
+        self.questions = defaultdict(set)
+        self.answers = defaultdict(set)
+        for question_id, question, answer in rows:
+            for token in tokenize(question):
+                self.questions[token].add(question_id)
+            for token in tokenize(answer):
+                self.answers[token].add(question_id)
+        self._question_tokens = sorted(self.questions)
+        self._answer_tokens = sorted(self.answers)
+
+    @staticmethod
+    def _prefixed(postings, tokens, prefix):
+        matched = set()
+        position = bisect_left(tokens, prefix)
+        while position < len(tokens) and tokens[position].startswith(prefix):
+            matched |= postings[tokens[position]]
+            position += 1
+        return matched
+
+    def search(self, terms, include_answers=False):
+        """Return matching ids, best ranked first."""
+        scores = defaultdict(float)
+        candidates = None
+        for term in terms:
+            in_question = self._prefixed(self.questions, self._question_tokens, term)
+            in_answer = set()
+            if include_answers:
+                in_answer = self._prefixed(self.answers, self._answer_tokens, term)
+            for question_id in in_question:
+                scores[question_id] += QUESTION_WEIGHT
+            for question_id in in_answer:
+                scores[question_id] += ANSWER_WEIGHT
+            matched = in_question | in_answer
+            candidates = matched if candidates is None else candidates & matched
+            if not candidates:
+                return []
+        return sorted(candidates, key=lambda question_id: (-scores[question_id], question_id))
+
+
+class SearchIndex(object):
+
+    def __init__(self, ttl=SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._fallback = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._fallback = None
+
+    def search(self, search_term, include_answers=False, page=1,
+               per_page=QUESTIONS_PER_PAGE):
+        terms = tokenize(search_term)
+        if not terms:
+            return fetch_page(page=page, per_page=per_page)
+        if db.engine.dialect.name == 'postgresql':
+            return self._search_postgres(terms, include_answers, page, per_page)
+        return self._search_fallback(terms, include_answers, page, per_page)
+
+    def _search_postgres(self, terms, include_answers, page, per_page):
+        weights = 'AB' if include_answers else 'A'
+        tsquery = func.to_tsquery(
+            'simple', ' & '.join('{}:*{}'.format(term, weights) for term in terms))
+        vector = literal_column('questions.search_vector')
+        matches = Question.query.filter(vector.op('@@')(tsquery))
+
+        total = matches.with_entities(func.count(Question.id)).scalar()
+        rows = (question_rows(matches)
+                .order_by(func.ts_rank(vector, tsquery).desc(), Question.id)
+                .offset((page - 1) * per_page)
+                .limit(per_page)
+                .all())
+        return Page(questions=[question_dict(row) for row in rows],
+                    total=total, next_cursor=None)
+
+    def _index(self):
+        with self._lock:
+            if self._fallback is None or time.monotonic() - self._loaded_at > self.ttl:
+                rows = db.session.query(Question.id, Question.question, Question.answer)
+                self._fallback = InvertedIndex(rows)
+                self._loaded_at = time.monotonic()
+            return self._fallback
+
+    def _search_fallback(self, terms, include_answers, page, per_page):
+        ranked = self._index().search(terms, include_answers)
+        page_ids = ranked[(page - 1) * per_page:page * per_page]
+        by_id = {}
+        if page_ids:
+            rows = question_rows(Question.query.filter(Question.id.in_(page_ids)))
+            by_id = {row.id: question_dict(row) for row in rows}
+        return Page(questions=[by_id[question_id]
+                               for question_id in page_ids if question_id in by_id],
+                    total=len(ranked), next_cursor=None)
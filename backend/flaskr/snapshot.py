@@ -0,0 +1,229 @@
+"""
+Question bank snapshot file, shared by the workers of a host.
+
+The file holds the questions as fixed width columns followed by one
+string table, so every worker maps it read-only and reads records
+straight out of the page cache: the bank is resident once per host, not
+once per worker. Layout, little-endian, each section 8 byte aligned:
+
+    header         magic, format, built_at, last_change and the counts
+    ids            int64[questions], ascending
+    categories     int32[questions], NULL_INT for NULL
+    difficulties   int32[questions], NULL_INT for NULL
+    question_refs  int64[questions], index into the string table, -1 for NULL
+    answer_refs    int64[questions], same
+    groups         int64[groups], the category values in ascending order
+    group_starts   uint64[groups + 1], offsets into group_ids
+    group_ids      int64[...], ids of each category, ascending
+    gaps           int64[gaps], change feed ids not committed at build time
+    string_offsets uint64[strings + 1], offsets into the text
+    text           UTF-8, every distinct string once
+
+A snapshot is written next to its final path and renamed over it, so a
+reader sees either the old file or the new one. Mappings of a replaced
+file stay valid until the last reader lets go of them.
+"""
+import array
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+MAGIC = b'TRIVSNAP'
+FORMAT = 1
+HEADER = struct.Struct('<8sIxxxxdqQQQQQ')
+NULL_INT = -2 ** 31
+NULL_REF = -1
+
+
+def _int_column(values):
+    return array.array('i', (NULL_INT if value is None else value for value in values))
+
+
+def _padding(size):
+    return b'\0' * (-size % 8)
+
+
+def write_snapshot(path, rows, last_change, gaps=(), built_at=None):
+    """
+    Write the (id, category, difficulty, question, answer) ``rows``, in id
+    order, as the snapshot at ``path``, atomically replacing it.
+    """
+    ids = array.array('q')
+    categories = []
+    difficulties = []
+    question_refs = array.array('q')
+    answer_refs = array.array('q')
+    strings = {}
+    text = bytearray()
+    string_offsets = array.array('Q', [0])
+    by_category = {}
+
+    def ref(value):
+        if value is None:
+            return NULL_REF
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+            text.extend(value.encode('utf-8'))
+            string_offsets.append(len(text))
+        return index
+
+    for question_id, category, difficulty, question, answer in rows:
+        ids.append(question_id)
+        categories.append(category)
+        difficulties.append(difficulty)
+        question_refs.append(ref(question))
+        answer_refs.append(ref(answer))
+        if category is not None:
+            by_category.setdefault(category, array.array('q')).append(question_id)
+
+    groups = array.array('q', sorted(by_category))
+    group_starts = array.array('Q', [0])
+    group_ids = array.array('q')
+    for category in groups:
+        group_ids.extend(by_category[category])
+        group_starts.append(len(group_ids))
+    gaps = array.array('q', sorted(gaps))
+
+    sections = [ids, _int_column(categories), _int_column(difficulties), question_refs,
+                answer_refs, groups, group_starts, group_ids, gaps, string_offsets]
+    header = HEADER.pack(MAGIC, FORMAT, time.time() if built_at is None else built_at,
+                         last_change, len(ids), len(groups), len(gaps), len(strings), len(text))
+
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary, 'wb') as out:
+            out.write(header)
+            for section in sections:
+                data = section.tobytes()
+                out.write(data)
+                out.write(_padding(len(data)))
+            out.write(text)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+@contextmanager
+def build_lock(path):
+    """Exclusive lock of the workers of a host around rebuilding ``path``."""
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def open_snapshot(path):
+    """The snapshot at ``path``, or None when there is none or it is unreadable."""
+    try:
+        return QuestionSnapshot(path)
+    except (OSError, ValueError):
+        return None
+
+
+class QuestionSnapshot(object):
+    """
+    Read-only view of a snapshot file, with the column interface of
+    question_store.QuestionColumns. Columns are memoryviews of the
+    mapping; only the strings that are read get decoded.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            stat = os.fstat(source.fileno())
+            if stat.st_size < HEADER.size:
+                raise ValueError('truncated snapshot')
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        self.size = stat.st_size
+
+        (magic, file_format, self.built_at, self.last_change, count, groups, gaps,
+         strings, text_size) = HEADER.unpack_from(self._map)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError('not a question snapshot')
+
+        view = memoryview(self._map)
+        offset = HEADER.size
+
+        def take(code, length):
+            nonlocal offset
+            size = struct.calcsize(code) * length
+            if offset + size > self.size:
+                raise ValueError('truncated snapshot')
+            column = view[offset:offset + size].cast(code)
+            offset += size + (-size % 8)
+            return column
+
+        self.ids = take('q', count)
+        self._categories = take('i', count)
+        self._difficulties = take('i', count)
+        self._question_refs = take('q', count)
+        self._answer_refs = take('q', count)
+        group_values = take('q', groups)
+        group_starts = take('Q', groups + 1)
+        group_ids = take('q', group_starts[groups])
+        self.gaps = frozenset(take('q', gaps))
+        self._string_offsets = take('Q', strings + 1)
+        if offset + text_size > self.size:
+            raise ValueError('truncated snapshot')
+        self._text = view[offset:offset + text_size]
+        self.by_category = {
+            category: group_ids[group_starts[position]:group_starts[position + 1]]
+            for position, category in enumerate(group_values)
+        }
+
+    def changed_on_disk(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns) != self.identity
+
+    def covers(self, change_ids):
+        """True if every change feed entry in ``change_ids`` is reflected here."""
+        return all(change_id <= self.last_change and change_id not in self.gaps
+                   for change_id in change_ids)
+
+    def position(self, question_id):
+        position = bisect.bisect_left(self.ids, question_id)
+        if position < len(self.ids) and self.ids[position] == question_id:
+            return position
+        return None
+
+    def _string(self, ref):
+        if ref == NULL_REF:
+            return None
+        return str(self._text[self._string_offsets[ref]:self._string_offsets[ref + 1]], 'utf-8')
+
+    @staticmethod
+    def _int(value):
+        return None if value == NULL_INT else value
+
+    def row(self, position):
+        """The question_dict row (answer, category, difficulty, id, question) at ``position``."""
+        return (self._string(self._answer_refs[position]),
+                self._int(self._categories[position]),
+                self._int(self._difficulties[position]),
+                self.ids[position],
+                self._string(self._question_refs[position]))
+
+    def index_rows(self):
+        return [(question_id, self._int(category), self._int(difficulty))
+                for question_id, category, difficulty
+                in zip(self.ids, self._categories, self._difficulties)]
+
+    def memory_usage(self):
+        # the mapping is shared by every worker that reads this file
+        return {
+            'shared_file': self.size,
+            'total': self.size,
+            'per_question': round(self.size / len(self.ids), 1) if len(self.ids) else 0,
+        }
@@ -0,0 +1,53 @@
+"""
+Question counts from the question_stats table.
+
+question_stats is maintained by database triggers (migration 0005) in
+the same transaction as every insert, update and delete on questions,
+so totals are a lookup over a few dozen rows instead of a COUNT(*)
+over the bank. reconcile() rebuilds it from scratch should it ever
+drift, e.g. after triggers were disabled for a manual load.
+"""
+from sqlalchemy import text
+
+from migrations import QUESTION_STATS_BACKFILL
+from models import db
+
+UNCATEGORIZED = 0
+
+TOTAL_SQL = 'SELECT coalesce(sum(total), 0) FROM question_stats'
+
+
+def stats_summary(categories):
+    """
+    Totals overall, per category (split by difficulty) and per
+    difficulty. ``categories`` maps category ids to their names.
+    """
+    rows = db.session.execute(text(
+        'SELECT category, difficulty, total FROM question_stats '
+        'WHERE total > 0 ORDER BY category, difficulty'))
+    summary = {
+        'total_questions': 0,
+        'uncategorized': 0,
+        'categories': {},
+        'difficulties': {},
+    }
+    for category_id, difficulty, total in rows:
+        summary['total_questions'] += total
+        summary['difficulties'][difficulty] = summary['difficulties'].get(difficulty, 0) + total
+        if category_id == UNCATEGORIZED:
+            summary['uncategorized'] += total
+            continue
+        entry = summary['categories'].setdefault(category_id, {
+            'type': categories.get(category_id),
+            'total': 0,
+            'difficulties': {},
+        })
+        entry['total'] += total
+        entry['difficulties'][difficulty] = total
+    return summary
+
+
+def reconcile():
+    """Recount question_stats from the questions table; the caller commits."""
+    db.session.execute(text('DELETE FROM question_stats'))
+    db.session.execute(text(QUESTION_STATS_BACKFILL))
@@ -0,0 +1,456 @@
+"""
+Write-behind queue for POST /questions/add.
+
+With QUESTION_WRITE_BEHIND set to a directory, an added question is
+acknowledged as soon as it is in an append-only log on local disk, not
+after a transaction of its own. A flusher thread inserts the logged
+questions in batches (bulk_import.insert_batch) of up to
+QUESTION_WRITE_BEHIND_BATCH_SIZE, or whatever has gathered after
+QUESTION_WRITE_BEHIND_INTERVAL seconds, one transaction per batch. An
+acknowledged question is durable, but only shows in reads once flushed.
+
+Every process appends to log files of its own, named by a random id and
+held under an exclusive flock for as long as the process lives. A log is
+created and locked as <id>.new and only then renamed to <id>.log, the
+name replay looks for. A record is
+
+    length    uint32, of the payload
+    checksum  uint32, CRC-32 of sequence and payload
+    sequence  uint64, increasing within the process
+    payload   JSON [question, answer, difficulty, category]
+
+Adds that arrive together share one fsync. The last sequence inserted
+from each log is committed with the batch in question_log_progress
+(migration 0008), so a crash between the commit and the removal of the
+log does not insert twice. A log whose lock is free belongs to a process
+that is gone: it is replayed by the flusher of the next process to start
+one, or by `flask replay-question-log`. A torn last record, from a crash
+in the middle of an append, fails its checksum and is dropped; it was
+never acknowledged.
+"""
+import atexit
+import fcntl
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from models import db
+from .bulk_import import insert_batch
+
+MAGIC = b'TRIVLOG1'
+RECORD = struct.Struct('<IIQ')
+SEQUENCE = struct.Struct('<Q')
+LOG_SUFFIX = '.log'
+NEW_SUFFIX = '.new'
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.2
+SEGMENT_SIZE = 16 * 1024 * 1024
+RETRY_INTERVAL = 5.0
+CLOSE_TIMEOUT = 30.0
+
+PROGRESS_SQL = ('INSERT INTO question_log_progress (log, sequence) VALUES (:log, :sequence) '
+                'ON CONFLICT (log) DO UPDATE SET sequence = excluded.sequence')
+
+
+def _checksum(sequence, payload):
+    return zlib.crc32(payload, zlib.crc32(SEQUENCE.pack(sequence)))
+
+
+def encode_record(sequence, row):
+    payload = json.dumps(list(row), separators=(',', ':')).encode('utf-8')
+    return RECORD.pack(len(payload), _checksum(sequence, payload), sequence) + payload
+
+
+def read_log(source):
+    """(sequence, row) records of a log file object, up to the first torn or corrupt one."""
+    data = source.read()
+    records = []
+    if not data.startswith(MAGIC):
+        return records
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        length, checksum, sequence = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or _checksum(sequence, payload) != checksum:
+            break
+        records.append((sequence, tuple(json.loads(payload.decode('utf-8')))))
+        offset = start + length
+    return records
+
+
+def _sync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LogSegment(object):
+    """One log file of this process, locked for as long as it is open."""
+
+    def __init__(self, directory):
+        self.name = uuid.uuid4().hex
+        self.path = os.path.join(directory, self.name + LOG_SUFFIX)
+        # locked under a name replay ignores, so no replay can take a log before its owner
+        new_path = os.path.join(directory, self.name + NEW_SUFFIX)
+        self.fd = os.open(new_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.size = 0
+        self.last_sequence = 0
+        self.closed = False
+        self._write(MAGIC)
+        os.fsync(self.fd)
+        os.rename(new_path, self.path)
+        # the name has to survive a crash as well as the records
+        _sync_directory(directory)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.size += len(data)
+
+    def append(self, sequence, record):
+        self._write(record)
+        self.last_sequence = sequence
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+        self.closed = True
+
+
+# inserting logged questions
+
+def record_progress(records):
+    """Note the last of the (log, sequence, row) ``records`` of every log; the caller commits."""
+    last = {}
+    for log, sequence, _ in records:
+        last[log] = max(last.get(log, 0), sequence)
+    db.session.execute(text(PROGRESS_SQL), [{'log': log, 'sequence': sequence}
+                                            for log, sequence in last.items()])
+
+
+def forget_progress(logs):
+    db.session.execute(text('DELETE FROM question_log_progress WHERE log = :log'),
+                       [{'log': log} for log in logs])
+    db.session.commit()
+
+
+def refused(err):
+    """True for integrity violations, wrapped by SQLAlchemy or raised straight out of a COPY."""
+    return (isinstance(err, IntegrityError)
+            or str(getattr(err, 'pgcode', None) or '').startswith('23'))
+
+
+def insert_records(records, logger):
+    """
+    Insert the (log, sequence, row) ``records`` in one transaction with
+    their progress. Should a row be refused, e.g. for a category removed
+    since it was logged, the records go one by one and the refused ones
+    are dropped. Returns the numbers inserted and dropped.
+    """
+    try:
+        insert_batch([row for _, _, row in records])
+        record_progress(records)
+        db.session.commit()
+        return len(records), 0
+    except Exception as err:
+        db.session.rollback()
+        if not refused(err):
+            raise
+        if len(records) == 1:
+            logger.warning('dropped logged question %r, the database refused it', records[0][2])
+            record_progress(records)
+            db.session.commit()
+            return 0, 1
+    inserted = dropped = 0
+    for record in records:
+        counts = insert_records([record], logger)
+        inserted += counts[0]
+        dropped += counts[1]
+    return inserted, dropped
+
+
+def replay_logs(directory, logger, batch_size=BATCH_SIZE):
+    """
+    Insert what is left in the logs of processes that are gone and
+    remove the logs. Returns the numbers inserted and dropped.
+    """
+    inserted = dropped = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(LOG_SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            # another process may have replayed and removed it meanwhile
+            opened = os.fstat(fd)
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if (opened.st_dev, opened.st_ino) != (current.st_dev, current.st_ino):
+                continue
+
+            log = name[:-len(LOG_SUFFIX)]
+            done = db.session.execute(text(
+                'SELECT sequence FROM question_log_progress WHERE log = :log'),
+                {'log': log}).scalar() or 0
+            with open(fd, 'rb', closefd=False) as source:
+                records = [(log, sequence, row) for sequence, row in read_log(source)
+                           if sequence > done]
+            for start in range(0, len(records), batch_size):
+                counts = insert_records(records[start:start + batch_size], logger)
+                inserted += counts[0]
+                dropped += counts[1]
+            os.unlink(path)
+            forget_progress([log])
+            if records:
+                logger.info('replayed %d questions from %s', len(records), path)
+        finally:
+            os.close(fd)
+    return inserted, dropped
+
+
+class WriteBehindQueue(object):
+    """
+    Questions logged by append() and inserted in batches by a flusher
+    thread, started with the first append of the process.
+    """
+
+    def __init__(self, app, directory, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL,
+                 segment_size=SEGMENT_SIZE, on_flush=None):
+        self.app = app
+        self.directory = directory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.segment_size = segment_size
+        self.on_flush = on_flush
+        self.appended = 0
+        self.inserted = 0
+        self.batches = 0
+        self.syncs = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failures = 0
+        self._pending = deque()
+        self._segments = []
+        self._segment = None
+        self._sequence = 0
+        self._synced = 0
+        self._closed = False
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._flushing = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, row):
+        """
+        Log a (question, answer, difficulty, category) ``row``, returning
+        once it is on disk. Returns its sequence number.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('write-behind queue is closed')
+            self._start()
+            segment = self._segment
+            if segment is None or segment.size >= self.segment_size:
+                segment = self._rotate()
+            self._sequence += 1
+            sequence = self._sequence
+            segment.append(sequence, encode_record(sequence, row))
+            self._pending.append((segment, sequence, tuple(row)))
+            self.appended += 1
+            if len(self._pending) >= self.batch_size:
+                self._lock.notify_all()
+        self._sync(segment, sequence)
+        return sequence
+
+    def _start(self):
+        # after a fork the flusher and the logs of the parent are not ours
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # inherited descriptors would keep the parent's logs locked once it is gone
+            for segment in self._segments:
+                os.close(segment.fd)
+        self._pid = os.getpid()
+        self._pending.clear()
+        self._segments = []
+        self._segment = None
+        self._thread = threading.Thread(target=self._run, name='question-write-behind',
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _rotate(self):
+        if self._segment is not None:
+            self._segment.sync()
+            self._synced = max(self._synced, self._segment.last_sequence)
+        self._segment = LogSegment(self.directory)
+        self._segments.append(self._segment)
+        return self._segment
+
+    def _sync(self, segment, sequence):
+        # group commit: whoever gets here first syncs every record written so far
+        with self._sync_lock:
+            with self._lock:
+                if self._synced >= sequence or segment.closed:
+                    return
+                target = segment.last_sequence
+            segment.sync()
+            with self._lock:
+                self._synced = max(self._synced, target)
+                self.syncs += 1
+
+    def _run(self):
+        try:
+            with self.app.app_context():
+                inserted, dropped = replay_logs(self.directory, self.app.logger, self.batch_size)
+            self.replayed += inserted
+            self.dropped += dropped
+            if inserted and self.on_flush is not None:
+                self.on_flush()
+        except Exception:
+            self.app.logger.exception('replaying the question logs failed')
+        while True:
+            with self._lock:
+                deadline = None
+                while not self._closed and len(self._pending) < self.batch_size:
+                    if not self._pending:
+                        deadline = None
+                        self._lock.wait()
+                        continue
+                    if deadline is None:
+                        deadline = time.monotonic() + self.interval
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                if self._closed and not self._pending:
+                    return
+                closed = self._closed
+            succeeded = self.flush() if closed else self._flush_batch() is not False
+            if not succeeded:
+                time.sleep(RETRY_INTERVAL)
+
+    def flush(self):
+        """
+        Insert everything pending, batch by batch. Returns False if the
+        database failed; the questions stay pending and logged.
+        """
+        while True:
+            flushed = self._flush_batch()
+            if not flushed:
+                return flushed is None
+
+    def _flush_batch(self):
+        """Insert the oldest batch: True when done, None with nothing pending, False on failure."""
+        with self._flushing, self.app.app_context():
+            with self._lock:
+                batch = list(itertools.islice(self._pending, self.batch_size))
+            if not batch:
+                return None
+            records = [(segment.name, sequence, row) for segment, sequence, row in batch]
+            try:
+                inserted, dropped = insert_records(records, self.app.logger)
+            except Exception:
+                db.session.rollback()
+                self.failures += 1
+                self.app.logger.exception('inserting %d logged questions failed', len(batch))
+                return False
+            with self._lock:
+                for _ in batch:
+                    self._pending.popleft()
+                self.inserted += inserted
+                self.dropped += dropped
+                self.batches += 1
+            self._remove_done()
+        if self.on_flush is not None:
+            self.on_flush()
+        return True
+
+    def _remove_done(self, include_current=False):
+        """Remove the logs all of whose records are inserted."""
+        with self._sync_lock, self._lock:
+            oldest = self._pending[0][1] if self._pending else self._sequence + 1
+            done = [segment for segment in self._segments
+                    if segment.last_sequence < oldest
+                    and (include_current or segment is not self._segment)]
+            for segment in done:
+                self._segments.remove(segment)
+                segment.remove()
+                if segment is self._segment:
+                    self._segment = None
+        if done:
+            try:
+                forget_progress([segment.name for segment in done])
+            except Exception:
+                # a leftover progress row is only a few bytes
+                db.session.rollback()
+
+    def close(self):
+        """Take no more adds, insert what is pending and remove the logs."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(CLOSE_TIMEOUT)
+        if self.flush():
+            with self.app.app_context():
+                self._remove_done(include_current=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'appended': self.appended,
+                'inserted': self.inserted,
+                'batches': self.batches,
+                'syncs': self.syncs,
+                'replayed': self.replayed,
+                'dropped': self.dropped,
+                'failures': self.failures,
+                'logs': len(self._segments),
+            }
+
+
+def make_write_behind(app, setting=None, on_flush=None):
+    """The write-behind queue logging into directory ``setting``, or None when it is not set."""
+    if not setting:
+        return None
+    return WriteBehindQueue(app, setting,
+                            batch_size=app.config.get('QUESTION_WRITE_BEHIND_BATCH_SIZE', BATCH_SIZE),
+                            interval=app.config.get('QUESTION_WRITE_BEHIND_INTERVAL', FLUSH_INTERVAL),
+                            on_flush=on_flush)
@@ -0,0 +1,407 @@
+"""
+Versioned schema migrations.
+
+Each migration is a (version, name, upgrade) entry; upgrade receives an
+open connection. migrate(engine) applies the versions that are not yet
+recorded in the schema_migrations table, in order, inside one
+transaction. On Postgres an advisory lock keeps concurrently starting
+workers from migrating twice.
+"""
+from sqlalchemy import Column, Integer, MetaData, String, Table, text
+
+MIGRATION_LOCK_ID = 0x7472697669  # "trivi"
+
+"""
+0001 baseline
+    the tables as db.create_all() used to create them
+"""
+def create_baseline(connection):
+    metadata = MetaData()
+    Table('categories', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('type', String))
+    Table('questions', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('question', String),
+          Column('answer', String),
+          Column('category', String),
+          Column('difficulty', Integer))
+    metadata.create_all(connection)
+
+"""
+0002 integer category
+    questions.category becomes an integer foreign key to categories.id,
+    so filtering by category id no longer needs an implicit cast
+"""
+def convert_category_to_integer(connection):
+    if connection.dialect.name == 'postgresql':
+        column_type = connection.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'questions' AND column_name = 'category'")).scalar()
+        if column_type != 'integer':
+            connection.execute(text(
+                "ALTER TABLE questions ALTER COLUMN category TYPE integer "
+                "USING NULLIF(trim(category), '')::integer"))
+        has_foreign_key = connection.execute(text(
+            "SELECT 1 FROM information_schema.table_constraints "
+            "WHERE table_name = 'questions' AND constraint_type = 'FOREIGN KEY'")).scalar()
+        if not has_foreign_key:
+            connection.execute(text(
+                "ALTER TABLE questions ADD CONSTRAINT questions_category_fkey "
+                "FOREIGN KEY (category) REFERENCES categories (id) "
+                "ON UPDATE CASCADE ON DELETE SET NULL"))
+    else:
+        # SQLite cannot alter a column type, rebuild the table instead
+        connection.execute(text(
+            "CREATE TABLE questions_migrated ("
+            "id INTEGER NOT NULL PRIMARY KEY, "
+            "question VARCHAR, "
+            "answer VARCHAR, "
+            "category INTEGER REFERENCES categories (id) "
+            "ON UPDATE CASCADE ON DELETE SET NULL, "
+            "difficulty INTEGER)"))
+        connection.execute(text(
+            "INSERT INTO questions_migrated (id, question, answer, category, difficulty) "
+            "SELECT id, question, answer, CAST(category AS INTEGER), difficulty "
+            "FROM questions"))
+        connection.execute(text("DROP TABLE questions"))
+        connection.execute(text("ALTER TABLE questions_migrated RENAME TO questions"))
+
+"""
+0003 category indexes
+    (category, id) serves category listings in id order, and
+    (category, difficulty) serves difficulty filtered quizzes
+"""
+def add_category_indexes(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_id "
+        "ON questions (category, id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty "
+        "ON questions (category, difficulty)"))
+
+"""
+0004 search index
+    Postgres only: the search tsvector (question text weighted A, answer
+    weighted B), the trigger keeping it current and its GIN index
+"""
+SEARCH_INDEX_DDL = [
+    "ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """
+    CREATE OR REPLACE FUNCTION questions_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', coalesce(NEW.question, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.answer, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS questions_search_vector_trigger ON questions",
+    """
+    CREATE TRIGGER questions_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF question, answer ON questions
+    FOR EACH ROW EXECUTE PROCEDURE questions_search_vector_update()
+    """,
+    "UPDATE questions SET question = question WHERE search_vector IS NULL",
+    """
+    CREATE INDEX IF NOT EXISTS questions_search_vector_idx
+    ON questions USING gin (search_vector)
+    """,
+]
+
+def add_search_index(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+
+"""
+0005 question stats
+    question_stats holds the number of questions per (category,
+    difficulty), NULLs counted under 0. Triggers keep it current in the
+    writing transaction: statement-level with transition tables on
+    Postgres, so a COPY of many rows costs one upsert per group, and
+    row-level on SQLite
+"""
+QUESTION_STATS_TABLE = """
+    CREATE TABLE IF NOT EXISTS question_stats (
+        category INTEGER NOT NULL,
+        difficulty INTEGER NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (category, difficulty)
+    )
+"""
+
+QUESTION_STATS_BACKFILL = """
+    INSERT INTO question_stats (category, difficulty, total)
+    SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*)
+    FROM questions GROUP BY coalesce(category, 0), coalesce(difficulty, 0)
+"""
+
+QUESTION_STATS_PG_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION questions_stats_update() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE question_stats AS stats SET total = stats.total - changed.removed
+            FROM (SELECT coalesce(category, 0) AS category,
+                         coalesce(difficulty, 0) AS difficulty,
+                         count(*) AS removed
+                  FROM old_rows GROUP BY 1, 2) AS changed
+            WHERE stats.category = changed.category
+              AND stats.difficulty = changed.difficulty;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO question_stats (category, difficulty, total)
+            SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*)
+            FROM new_rows GROUP BY 1, 2
+            ON CONFLICT (category, difficulty)
+            DO UPDATE SET total = question_stats.total + EXCLUDED.total;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS questions_stats_insert ON questions",
+    "DROP TRIGGER IF EXISTS questions_stats_delete ON questions",
+    "DROP TRIGGER IF EXISTS questions_stats_update ON questions",
+    """
+    CREATE TRIGGER questions_stats_insert AFTER INSERT ON questions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE questions_stats_update()
+    """,
+    """
+    CREATE TRIGGER questions_stats_delete AFTER DELETE ON questions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE questions_stats_update()
+    """,
+    """
+    CREATE TRIGGER questions_stats_update AFTER UPDATE ON questions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE questions_stats_update()
+    """,
+]
+
+def _sqlite_stats_change(row, sign):
+    key = "coalesce({0}.category, 0), coalesce({0}.difficulty, 0)".format(row)
+    return (
+        "INSERT OR IGNORE INTO question_stats (category, difficulty, total) "
+        "VALUES ({key}, 0); "
+        "UPDATE question_stats SET total = total {sign} 1 "
+        "WHERE category = coalesce({row}.category, 0) "
+        "AND difficulty = coalesce({row}.difficulty, 0);").format(key=key, sign=sign, row=row)
+
+QUESTION_STATS_SQLITE_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS questions_stats_insert AFTER INSERT ON questions "
+    "BEGIN " + _sqlite_stats_change('NEW', '+') + " END",
+    "CREATE TRIGGER IF NOT EXISTS questions_stats_delete AFTER DELETE ON questions "
+    "BEGIN " + _sqlite_stats_change('OLD', '-') + " END",
+    "CREATE TRIGGER IF NOT EXISTS questions_stats_update "
+    "AFTER UPDATE OF category, difficulty ON questions "
+    "BEGIN " + _sqlite_stats_change('OLD', '-') + " " + _sqlite_stats_change('NEW', '+') + " END",
+]
+
+def add_question_stats(connection):
+    connection.execute(text(QUESTION_STATS_TABLE))
+    if connection.dialect.name == 'postgresql':
+        ddl = QUESTION_STATS_PG_DDL
+    else:
+        ddl = QUESTION_STATS_SQLITE_DDL
+    for statement in ddl:
+        connection.execute(text(statement))
+    # CREATE TRIGGER locks out writers until the migration commits, so
+    # the backfill cannot race with the triggers
+    connection.execute(text("DELETE FROM question_stats"))
+    connection.execute(text(QUESTION_STATS_BACKFILL))
+
+"""
+0006 question changes
+    question_changes is a feed of the ids of inserted, updated and
+    deleted questions, written by triggers in the writing transaction,
+    for processes that keep a copy of the bank (flaskr.question_store).
+    On Postgres the trigger also sends a NOTIFY on question_changes
+"""
+QUESTION_CHANGES_CHANNEL = 'question_changes'
+
+QUESTION_CHANGES_PG_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS question_changes (
+        id BIGSERIAL PRIMARY KEY,
+        question_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION questions_log_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            INSERT INTO question_changes (question_id) SELECT id FROM old_rows;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO question_changes (question_id) SELECT id FROM new_rows;
+        END IF;
+        PERFORM pg_notify('question_changes', '');
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS questions_changes_insert ON questions",
+    "DROP TRIGGER IF EXISTS questions_changes_delete ON questions",
+    "DROP TRIGGER IF EXISTS questions_changes_update ON questions",
+    """
+    CREATE TRIGGER questions_changes_insert AFTER INSERT ON questions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE questions_log_change()
+    """,
+    """
+    CREATE TRIGGER questions_changes_delete AFTER DELETE ON questions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE questions_log_change()
+    """,
+    """
+    CREATE TRIGGER questions_changes_update AFTER UPDATE ON questions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE questions_log_change()
+    """,
+]
+
+QUESTION_CHANGES_SQLITE_DDL = [
+    "CREATE TABLE IF NOT EXISTS question_changes ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "question_id INTEGER NOT NULL)",
+    "CREATE TRIGGER IF NOT EXISTS questions_changes_insert AFTER INSERT ON questions "
+    "BEGIN INSERT INTO question_changes (question_id) VALUES (NEW.id); END",
+    "CREATE TRIGGER IF NOT EXISTS questions_changes_delete AFTER DELETE ON questions "
+    "BEGIN INSERT INTO question_changes (question_id) VALUES (OLD.id); END",
+    "CREATE TRIGGER IF NOT EXISTS questions_changes_update AFTER UPDATE ON questions "
+    "BEGIN INSERT INTO question_changes (question_id) VALUES (OLD.id); "
+    "INSERT INTO question_changes (question_id) VALUES (NEW.id); END",
+]
+
+def add_question_changes(connection):
+    if connection.dialect.name == 'postgresql':
+        ddl = QUESTION_CHANGES_PG_DDL
+    else:
+        ddl = QUESTION_CHANGES_SQLITE_DDL
+    for statement in ddl:
+        connection.execute(text(statement))
+
+"""
+0007 question signatures
+    MinHash signatures of the question texts and their LSH band buckets
+    (flaskr.duplicates), removed with their question: by foreign key on
+    Postgres, by trigger on SQLite which does not enforce them by default.
+    Rows are filled by the app and by `flask index-duplicates`
+"""
+QUESTION_SIGNATURES_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS question_signatures (
+        question_id INTEGER PRIMARY KEY REFERENCES questions (id) ON DELETE CASCADE,
+        signature {blob} NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS question_buckets (
+        band SMALLINT NOT NULL,
+        bucket BIGINT NOT NULL,
+        question_id INTEGER NOT NULL REFERENCES questions (id) ON DELETE CASCADE,
+        PRIMARY KEY (band, bucket, question_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_question_buckets_question_id ON question_buckets (question_id)",
+]
+
+QUESTION_SIGNATURES_SQLITE_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS questions_signatures_delete AFTER DELETE ON questions "
+    "BEGIN DELETE FROM question_signatures WHERE question_id = OLD.id; "
+    "DELETE FROM question_buckets WHERE question_id = OLD.id; END",
+]
+
+def add_question_signatures(connection):
+    postgres = connection.dialect.name == 'postgresql'
+    for statement in QUESTION_SIGNATURES_DDL:
+        connection.execute(text(statement.format(blob='BYTEA' if postgres else 'BLOB')))
+    if not postgres:
+        for statement in QUESTION_SIGNATURES_SQLITE_DDL:
+            connection.execute(text(statement))
+
+"""
+0008 question log progress
+    The last record of each write-behind log (flaskr.write_behind) that
+    has been inserted, committed together with the questions so a replay
+    after a crash skips them
+"""
+def add_question_log_progress(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS question_log_progress ("
+        "log VARCHAR(64) PRIMARY KEY, "
+        "sequence BIGINT NOT NULL)"))
+
+"""
+0009 simple search vector
+    Postgres only: rebuild search_vector with the 'simple' configuration,
+    which keeps stopwords and does not stem, so searches match what the
+    in-process index of other databases matches (see flaskr.search)
+"""
+SIMPLE_SEARCH_VECTOR_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION questions_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.question, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(NEW.answer, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    UPDATE questions SET search_vector =
+        setweight(to_tsvector('simple', coalesce(question, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(answer, '')), 'B')
+    """,
+]
+
+def use_simple_search_vector(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    for statement in SIMPLE_SEARCH_VECTOR_DDL:
+        connection.execute(text(statement))
+
+
+MIGRATIONS = [
+    (1, 'baseline', create_baseline),
+    (2, 'integer category', convert_category_to_integer),
+    (3, 'category indexes', add_category_indexes),
+    (4, 'search index', add_search_index),
+    (5, 'question stats', add_question_stats),
+    (6, 'question changes', add_question_changes),
+    (7, 'question signatures', add_question_signatures),
+    (8, 'question log progress', add_question_log_progress),
+    (9, 'simple search vector', use_simple_search_vector),
+]
+
+def applied_versions(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "name VARCHAR NOT NULL)"))
+    return set(row[0] for row in connection.execute(text(
+        "SELECT version FROM schema_migrations")))
+
+def migrate(engine):
+    """Apply pending migrations and return the versions applied."""
+    applied = []
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text("SELECT pg_advisory_xact_lock(:id)"),
+                               id=MIGRATION_LOCK_ID)
+        done = applied_versions(connection)
+        for version, name, upgrade in MIGRATIONS:
+            if version in done:
+                continue
+            upgrade(connection)
+            connection.execute(text(
+                "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                version=version, name=name)
+            applied.append(version)
+    return applied
@@ -1,23 +1,99 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, any_, bindparam, create_engine, orm
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql.dml import UpdateBase
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 import json
 
+
 database_name = "trivia"
-database_path ="postgresql://{}:{}@{}/{}".format('postgres', 'abc','localhost:5432', database_name)
+database_path = os.environ.get(
+    'DATABASE_URL',
+    "postgresql://{}:{}@{}/{}".format('postgres', 'abc','localhost:5432', database_name))
+
+REPLICA_BIND = 'replica'
+DELETE_CHUNK_SIZE = 500
+
+"""
+Connection pool and session settings, overridable through the app
+config or environment variables of the same name
+"""
+DB_SETTINGS = {
+    'DB_POOL_SIZE': 10,
+    'DB_MAX_OVERFLOW': 20,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT_MS': 0,
+}
 
-db = SQLAlchemy()
+"""
+RoutingSession
+    sends reads to the read replica while the request is flagged with
+    g.read_replica; flushes and INSERT/UPDATE/DELETE statements always
+    go to the primary
+"""
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self._flushing or isinstance(clause, UpdateBase)
+                or not has_request_context() or not g.get('read_replica')):
+            return SignallingSession.get_bind(self, mapper, clause)
+        return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+
+
+class TriviaSQLAlchemy(SQLAlchemy):
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            return
+        options.update(
+            pool_size=app.config['DB_POOL_SIZE'],
+            max_overflow=app.config['DB_MAX_OVERFLOW'],
+            pool_timeout=app.config['DB_POOL_TIMEOUT'],
+            pool_recycle=app.config['DB_POOL_RECYCLE'],
+            pool_pre_ping=app.config['DB_POOL_PRE_PING'])
+        timeout = app.config['DB_STATEMENT_TIMEOUT_MS']
+        if timeout and sa_url.drivername.startswith('postgresql'):
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = '-c statement_timeout={}'.format(int(timeout))
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = TriviaSQLAlchemy()
+
+def configure_db(app):
+    for key, default in DB_SETTINGS.items():
+        value = os.environ.get(key)
+        if value is None:
+            app.config.setdefault(key, default)
+        elif isinstance(default, bool):
+            app.config.setdefault(key, value.lower() in ('1', 'true', 'yes'))
+        else:
+            app.config.setdefault(key, int(value))
+    replica_path = app.config.get('DATABASE_REPLICA_PATH') or os.environ.get('DATABASE_REPLICA_URL')
+    if replica_path:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: replica_path}
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. Nothing connects
+    here: the engine is created on first use, and the schema is brought
+    up to date by the explicit `flask migrate` step (see migrations.py).
+    Sessions are scoped to the request: Flask-SQLAlchemy removes the
+    session, rolling back anything left uncommitted, when the app context
+    is torn down.
 """
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    configure_db(app)
     db.app = app
     db.init_app(app)
-    db.create_all()
 
 """
 Question
@@ -25,11 +101,15 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -49,6 +129,32 @@ class Question(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    @classmethod
+    def delete_many(cls, ids):
+        """
+        Delete the questions with the given ids in one statement and return
+        the set of ids that were actually deleted. The caller commits.
+        """
+        table = cls.__table__
+        ids = sorted(set(ids))
+        if not ids:
+            return set()
+        if db.engine.dialect.name == 'postgresql':
+            # one DELETE ... WHERE id = ANY(array) RETURNING id, whatever the list size
+            statement = (table.delete()
+                         .where(table.c.id == any_(bindparam('ids', type_=ARRAY(Integer))))
+                         .returning(table.c.id))
+            return {row[0] for row in db.session.execute(statement, {'ids': ids})}
+        # no RETURNING here: read the matching ids in the same transaction,
+        # chunked below SQLite's bound parameter limit
+        deleted = set()
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[start:start + DELETE_CHUNK_SIZE]
+            deleted.update(row[0] for row in db.session.execute(
+                table.select().with_only_columns([table.c.id]).where(table.c.id.in_(chunk))))
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+        return deleted
+
     def format(self):
         return {
             'id': self.id,
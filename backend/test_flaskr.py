@@ -1,10 +1,29 @@
 import os
+import asyncio
+import gzip
+import importlib.util
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import random
+from sqlalchemy import create_engine, text
+
+from flask import jsonify
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import TriviaASGI
+from benchmarks.asgi import asgi_call, asgi_request
+from benchmarks.timing import percentile
+from flaskr.answers import CompiledAnswer
+from flaskr.duplicates import duplicates_report
+from flaskr.instrumentation import metrics
+from flaskr.quiz_sessions import RedisSessionStore
+from flaskr.sampling import FenwickTree, QuestionIdIndex
+from flaskr.search import SearchIndex
+from flaskr.serialization import json_response, question_dict
+from flaskr.write_behind import LogSegment, encode_record, replay_logs
+from models import Question, Category, db
+from migrations import MIGRATIONS, migrate
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -13,25 +32,207 @@ class TriviaTestCase(unittest.TestCase):
     new_question = {'question':'What do you call a group of crows', 'answer':'A murder', 'difficulty': 1, 'category': 1}
     bad_question = {'question':'What do you call a group of crows', 'answer':'A murder', 'difficulty': 1, 'category': 9}
     
+    database_name = "trivia_test"
+    database_path ="postgresql://{}:{}@{}/{}".format('postgres', 'abc','localhost:5432', database_name)
+
+    @classmethod
+    def setUpClass(cls):
+        """Bring the test schema up to date once per run."""
+        engine = create_engine(cls.database_path)
+        migrate(engine)
+        engine.dispose()
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app({'DATABASE_PATH': self.database_path})
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path ="postgresql://{}:{}@{}/{}".format('postgres', 'abc','localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
     
     def tearDown(self):
         """Executed after reach test"""
         pass
 
+    def sqlite_copy(self):
+        """The categories and questions of the test database, copied to a new SQLite file."""
+        path = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'trivia_test.db')
+        source, target = create_engine(self.database_path), create_engine(path)
+        migrate(target)
+        with source.connect() as reader, target.begin() as writer:
+            for table, columns in [('categories', ['id', 'type']),
+                                   ('questions', ['id', 'question', 'answer', 'difficulty', 'category'])]:
+                rows = [dict(row) for row in reader.execute(
+                    text('SELECT {} FROM {}'.format(', '.join(columns), table)))]
+                writer.execute(text('INSERT INTO {} ({}) VALUES ({})'.format(
+                    table, ', '.join(columns), ', '.join(':' + column for column in columns))), rows)
+        source.dispose()
+        target.dispose()
+        return path
+
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'aiosqlite is not installed')
+    def test_asgi_matches_wsgi(self):
+        app = create_app({'DATABASE_PATH': self.sqlite_copy()})
+        asgi_app = TriviaASGI(app)
+        loop = asyncio.new_event_loop()
+        try:
+            for method, path, body in [('GET', '/categories', None),
+                                       ('GET', '/questions?page=1', None),
+                                       ('GET', '/questions?page=1000', None),
+                                       ('GET', '/questions?page=0', None),
+                                       ('GET', '/categories/5/questions', None),
+                                       ('GET', '/categories/5/questions?shape=columns', None),
+                                       ('POST', '/questions', {'searchTerm': 'title'}),
+                                       ('POST', '/quizzes', {'quiz_category': '1'})]:
+                status, data = loop.run_until_complete(asgi_call(asgi_app, method, path, body))
+                res = app.test_client().open(path, method=method, json=body)
+                self.assertEqual(status, res.status_code)
+                self.assertEqual(data, res.data)
+
+            requests_before = metrics.counters[(
+                'trivia_requests_total', (('endpoint', 'get_quiz'), ('method', 'POST'), ('status', 200)))]
+            status, headers, data = loop.run_until_complete(asgi_request(
+                asgi_app, 'POST', '/quizzes', {'previous_questions': [], 'quiz_category': {'id': 5}}))
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(data)['question']['category'], 5)
+            self.assertIn('db;dur=', headers['server-timing'])
+            self.assertEqual(metrics.counters[(
+                'trivia_requests_total', (('endpoint', 'get_quiz'), ('method', 'POST'), ('status', 200)))],
+                requests_before + 1)
+
+            status, headers, data = loop.run_until_complete(asgi_request(
+                asgi_app, 'GET', '/questions?page=1', headers=[('Accept-Encoding', 'gzip')]))
+            res = app.test_client().get('/questions?page=1', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(headers['content-encoding'], 'gzip')
+            self.assertEqual(headers['etag'], res.headers['ETag'])
+            self.assertEqual(gzip.decompress(data), gzip.decompress(res.data))
+            self.assertIn('server-timing', headers)
+        finally:
+            loop.run_until_complete(asgi_app.close())
+            loop.close()
+
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'aiosqlite is not installed')
+    def test_asgi_answers_500_when_the_database_fails(self):
+        app = create_app({'DATABASE_PATH': self.sqlite_copy()})
+        asgi_app = TriviaASGI(app)
+        loop = asyncio.new_event_loop()
+
+        async def broken_fetch(sql, *params):
+            raise RuntimeError('database went away')
+
+        asgi_app.databases[True].fetch = broken_fetch
+        try:
+            status, data = loop.run_until_complete(asgi_call(asgi_app, 'GET', '/questions?page=1'))
+            self.assertEqual(status, 500)
+            self.assertEqual(json.loads(data), {'success': 'False', 'error': 500,
+                                                'message': 'internal server error'})
+        finally:
+            loop.run_until_complete(asgi_app.close())
+            loop.close()
+
+    def test_stats_follow_inserts_and_deletes(self):
+        before = json.loads(self.client().get('/stats').data)
+        with self.app.app_context():
+            question = Question('Counted?', 'Yes', 1, 5)
+            question.insert()
+            question_id = question.id
+        during = json.loads(self.client().get('/stats').data)
+        self.client().delete('/questions/{}'.format(question_id))
+        after = json.loads(self.client().get('/stats').data)
+
+        self.assertEqual(during['total_questions'], before['total_questions'] + 1)
+        self.assertEqual(during['categories']['1']['difficulties']['5'],
+                         before['categories']['1']['difficulties'].get('5', 0) + 1)
+        self.assertEqual(after, before)
+
+    def test_question_store_matches_database_and_follows_writes(self):
+        store_app = create_app({'DATABASE_PATH': self.database_path, 'QUESTION_STORE': True})
+        for path in ['/questions?page=1', '/questions?page=1000', '/categories/5/questions']:
+            res = self.client().get(path)
+            stored = store_app.test_client().get(path)
+            self.assertEqual(stored.status_code, res.status_code)
+            self.assertEqual(stored.data, res.data)
+
+        store = store_app.extensions['trivia']['question_store']
+        with self.app.app_context():
+            question = Question('Held in memory?', 'Yes', 1, 5)
+            question.insert()
+            question_id = question.id
+        store.mark_stale()
+        self.assertEqual(store.questions([question_id])[question_id]['answer'], 'Yes')
+
+        self.client().delete('/questions/{}'.format(question_id))
+        store.mark_stale()
+        self.assertEqual(store.questions([question_id]), {})
+
+    def test_question_snapshot_is_built_once_for_all_workers(self):
+        workdir = tempfile.mkdtemp()
+        config = {'DATABASE_PATH': self.database_path,
+                  'QUESTION_STORE': 'snapshot://' + os.path.join(workdir, 'questions.snapshot')}
+        workers = [create_app(config), create_app(config)]
+        stores = [worker.extensions['trivia']['question_store'] for worker in workers]
+        for worker in workers:
+            res = worker.test_client().get('/categories/5/questions')
+            self.assertEqual(res.data, self.client().get('/categories/5/questions').data)
+        self.assertEqual(sum(store.full_loads for store in stores), 1)
+
+        with self.app.app_context():
+            question = Question('Mapped by every worker?', 'Yes', 1, 5)
+            question.insert()
+            question_id = question.id
+        for store in stores:
+            store.mark_stale()
+            self.assertEqual(store.questions([question_id])[question_id]['question'],
+                             'Mapped by every worker?')
+        self.assertEqual(sum(store.full_loads for store in stores), 2)
+        self.client().delete('/questions/{}'.format(question_id))
+
+    def test_migrations_are_recorded_once(self):
+        with self.app.app_context():
+            self.assertEqual(migrate(db.engine), [])
+            versions = [row[0] for row in db.engine.execute('SELECT version FROM schema_migrations ORDER BY version')]
+
+        self.assertEqual(versions, [version for version, _, _ in MIGRATIONS])
+
+    def test_migrate_command_reports_up_to_date(self):
+        result = self.app.test_cli_runner().invoke(args=['migrate'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('schema is up to date', result.output)
+
+    def test_reads_are_routed_to_replica(self):
+        replica_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        replica_path = 'sqlite:///' + replica_file.name
+        replica = create_engine(replica_path)
+        migrate(replica)
+        replica.execute("INSERT INTO categories (id, type) VALUES (1, 'Science')")
+        replica.execute("INSERT INTO questions (question, answer, difficulty, category) "
+                        "VALUES ('Only on the replica?', 'Yes', 1, 1)")
+
+        app = create_app({'DATABASE_PATH': self.database_path, 'DATABASE_REPLICA_PATH': replica_path})
+        res = app.test_client().get('/questions/export')
+        rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+        self.assertEqual([row['question'] for row in rows], ['Only on the replica?'])
+
+        res = app.test_client().post('/questions/add', json=self.new_question)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(replica.execute('SELECT count(*) FROM questions').scalar(), 1)
+        os.unlink(replica_file.name)
+
+    def test_server_timing_and_metrics(self):
+        res = self.client().get('/questions?page=1')
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint="get_a_page_of_questions"', res.data.decode('utf-8'))
+
+    def test_fast_serializer_matches_jsonify(self):
+        payload = {
+            'questions': [question_dict(('Caf\u00e9', 1, 2, 3, 'Tab\there?'))],
+            'categories': {1: 'Science', 10: 'Music', 2: 'Art'},
+            'current_category': None
+        }
+        with self.app.test_request_context():
+            self.assertEqual(json_response(payload).data, jsonify(payload).data)
+
     """
     TODO
     Write at least one test for each test for successful operation and for expected errors.
@@ -43,6 +244,80 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
 
         self.assertTrue(len(data['categories']))
+
+    def test_gzip_and_columnar_questions(self):
+        res = self.client().get('/questions?page=1&shape=columns', headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(data['questions']['columns'], ['answer', 'category', 'difficulty', 'id', 'question'])
+        self.assertEqual(len(data['questions']['rows']), 10)
+
+        res = self.client().get('/questions?page=1&shape=columns',
+                                headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_categories_not_modified(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        self.assertIn('max-age', res.headers['Cache-Control'])
+
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_category_cache_counts_hits(self):
+        self.client().get('/categories')
+        before = json.loads(self.client().get('/cache/stats').data)['categories']
+        self.client().get('/questions?page=2')
+        after = json.loads(self.client().get('/cache/stats').data)['categories']
+
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(after['misses'], before['misses'])
+
+    def test_category_cache_is_per_app(self):
+        other = create_app({'DATABASE_PATH': self.database_path})
+        self.client().get('/categories')
+        stats = json.loads(other.test_client().get('/cache/stats').data)['categories']
+
+        self.assertEqual(stats['hits'], 0)
+        self.assertIsNot(other.extensions['trivia']['category_cache'],
+                         self.app.extensions['trivia']['category_cache'])
+
+    def test_category_changes_retire_cached_responses_in_every_worker(self):
+        config = {'DATABASE_PATH': self.database_path,
+                  'RESPONSE_CACHE': 'shm://' + os.path.join(tempfile.mkdtemp(), 'version')}
+        workers = [create_app(config), create_app(config)]
+        before = [worker.test_client().get('/categories') for worker in workers]
+        with workers[0].app_context():
+            category = Category('Cached?')
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+
+        try:
+            for worker, old in zip(workers, before):
+                res = worker.test_client().get('/categories')
+                self.assertNotEqual(res.headers['ETag'], old.headers['ETag'])
+                self.assertEqual(json.loads(res.data)['categories'][str(category_id)], 'Cached?')
+        finally:
+            with workers[0].app_context():
+                Category.query.filter_by(id=category_id).delete()
+                db.session.commit()
+
+    def test_responses_are_cached_until_the_bank_changes(self):
+        first = self.client().get('/questions?page=1')
+        second = self.client().get('/questions?page=1', headers={'If-None-Match': first.headers['ETag']})
+        stats = json.loads(self.client().get('/cache/stats').data)['responses']
+
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(stats['hits'], 1)
+
+        self.client().post('/questions/add', json=self.new_question)
+        third = self.client().get('/questions?page=1', headers={'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third.headers['ETag'], first.headers['ETag'])
     
     # test pagination
     
@@ -62,7 +337,23 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], 'False')
         self.assertEqual(data['message'],'resource not found')
-        
+
+    def test_get_questions_after_cursor(self):
+        first = json.loads(self.client().get('/questions?page=1').data)
+        res = self.client().get('/questions?after_id=' + first['next_cursor'])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], first['total_questions'])
+        self.assertGreater(data['questions'][0]['id'], first['questions'][-1]['id'])
+
+    def test_400_on_malformed_cursor(self):
+        res = self.client().get('/questions?after_id=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'],'bad request')
+
     # test questions per category
         
     def test_get_questions_per_category(self):
@@ -103,7 +394,40 @@ class TriviaTestCase(unittest.TestCase):
                                 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['totalQuestions'],0)
+
+    def test_search_question_including_answers(self):
+        res = self.client().post('/questions', json={'searchTerm': 'muhammad'})
+        self.assertEqual(json.loads(res.data)['totalQuestions'], 0)
+
+        res = self.client().post('/questions', json={'searchTerm': 'muhammad', 'include_answers': True})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['answer'], 'Muhammad Ali')
     
+    def test_400_for_search_term_that_is_not_text(self):
+        for term in [5, ['title'], {'term': 'title'}]:
+            res = self.client().post('/questions', json={'searchTerm': term})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['error'], 400)
+
+    def test_search_keeps_stopwords(self):
+        res = self.client().post('/questions', json={'searchTerm': 'the'})
+        self.assertTrue(json.loads(res.data)['totalQuestions'])
+
+    def test_search_sees_other_workers_writes_after_ttl(self):
+        with self.app.test_request_context():
+            index = SearchIndex(ttl=0)
+            self.assertEqual(index.search('zyzzyva').total, 0)
+            question = Question('Who wrote zyzzyva?', 'Nobody', 1, 1)
+            question.insert()
+            try:
+                self.assertEqual(index.search('zyzzyva').total, 1)
+            finally:
+                question.delete()
+
     # delete questions by id
     
     def test_delete_question_by_id(self):
@@ -117,6 +441,26 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
+
+    def test_batch_delete_reports_exact_counts(self):
+        with self.app.app_context():
+            questions = [Question('Delete me?', 'Yes', 1, 1) for _ in range(3)]
+            db.session.add_all(questions)
+            db.session.commit()
+            ids = [question.id for question in questions]
+
+        res = self.client().delete('/questions', json={'ids': ids + [999999]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 3)
+        self.assertEqual(data['question_ids'], sorted(ids))
+        self.assertEqual(data['not_found'], [999999])
+
+    def test_422_batch_delete_without_ids(self):
+        res = self.client().delete('/questions', json={'ids': 'all'})
+
+        self.assertEqual(res.status_code, 422)
         
         
     """
@@ -131,6 +475,145 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
 
     
+    def test_added_question_is_found_as_duplicate(self):
+        copy = dict(self.new_question, question='What do you call a group of crows?!')
+        self.client().post('/questions/add', json=self.new_question)
+        self.client().post('/questions/add', json=copy)
+        with self.app.app_context():
+            original, duplicate = [question.id for question in Question.query.filter(
+                Question.question.like('What do you call a group of crows%')).order_by(Question.id)[-2:]]
+
+        res = self.client().get('/questions/{}/duplicates'.format(original))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(duplicate, [question['id'] for question in data['duplicates']])
+        self.assertEqual(data['duplicates'][0]['similarity'], 1.0)
+
+    def test_duplicates_errors(self):
+        res = self.client().get('/questions/100000/duplicates')
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client().get('/questions/2/duplicates?threshold=2')
+        self.assertEqual(res.status_code, 400)
+
+    def test_duplicates_report_groups_near_duplicates(self):
+        rows = [(1, 'Which planet is known as the Red Planet?'),
+                (2, 'Which planet is known as the red planet'),
+                (3, 'Who painted the Mona Lisa?')]
+        report = duplicates_report(rows, processes=2)
+
+        self.assertEqual(report['clusters'], 1)
+        self.assertEqual(report['groups'][0]['ids'], [1, 2])
+
+    def test_bulk_import_ndjson_reports_bad_rows(self):
+        rows = [self.new_question, self.bad_question, {'question': 'No answer', 'difficulty': 1, 'category': 1}]
+        body = '\n'.join(json.dumps(row) for row in rows)
+        res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['rejected'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 3])
+
+    def test_bulk_import_csv(self):
+        body = 'question,answer,difficulty,category\nWhat is H2O?,Water,1,1\n'
+        res = self.client().post('/questions/bulk', data=body, content_type='text/csv')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+
+    def test_write_behind_adds_are_inserted_in_batches(self):
+        app = create_app({'DATABASE_PATH': self.database_path,
+                          'QUESTION_WRITE_BEHIND': tempfile.mkdtemp(),
+                          'QUESTION_WRITE_BEHIND_BATCH_SIZE': 50,
+                          'QUESTION_WRITE_BEHIND_INTERVAL': 3600})
+        queue = app.extensions['trivia']['write_behind']
+        for number in range(120):
+            res = app.test_client().post('/questions/add', json=dict(
+                self.new_question, question='Queued question {}?'.format(number)))
+            self.assertEqual(json.loads(res.data)['queued'], True)
+        res = app.test_client().post('/questions/add', json=self.bad_question)
+        self.assertEqual(res.status_code, 422)
+        queue.close()
+
+        stats = queue.stats()
+        self.assertEqual(stats['inserted'], 120)
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(os.listdir(queue.directory), [])
+        with self.app.app_context():
+            queued = Question.query.filter(Question.question.like('Queued question %'))
+            self.assertEqual(queued.count(), 120)
+            queued.delete(synchronize_session=False)
+            db.session.commit()
+
+    def test_write_behind_log_is_replayed_once_after_a_crash(self):
+        directory = tempfile.mkdtemp()
+        segment = LogSegment(directory)
+        for sequence in range(1, 6):
+            segment.append(sequence, encode_record(
+                sequence, ('Logged question {}?'.format(sequence), 'Yes', 1, 1)))
+        segment.append(6, encode_record(6, ('Torn question?', 'Yes', 1, 1))[:-3])
+        # the process dies after committing the first record but before removing the log
+        os.close(segment.fd)
+        with self.app.app_context():
+            Question('Logged question 1?', 'Yes', 1, 1).insert()
+            db.session.execute(text('INSERT INTO question_log_progress (log, sequence) '
+                                    'VALUES (:log, 1)'), {'log': segment.name})
+            db.session.commit()
+
+        app = create_app({'DATABASE_PATH': self.database_path, 'QUESTION_WRITE_BEHIND': directory})
+        result = app.test_cli_runner().invoke(args=['replay-question-log'])
+
+        self.assertIn('replayed 4', result.output)
+        self.assertEqual(os.listdir(directory), [])
+        with self.app.app_context():
+            logged = Question.query.filter(Question.question.like('Logged question %'))
+            self.assertEqual(sorted(question.question for question in logged),
+                             ['Logged question {}?'.format(number) for number in range(1, 6)])
+            self.assertEqual(Question.query.filter_by(question='Torn question?').count(), 0)
+            logged.delete(synchronize_session=False)
+            db.session.commit()
+
+    def test_write_behind_replay_leaves_live_logs_alone(self):
+        directory = tempfile.mkdtemp()
+        segment = LogSegment(directory)
+        segment.append(1, encode_record(1, ('Live question?', 'Yes', 1, 1)))
+
+        with self.app.app_context():
+            self.assertEqual(replay_logs(directory, self.app.logger), (0, 0))
+        self.assertEqual(os.listdir(directory), [segment.name + '.log'])
+        segment.remove()
+        segment = LogSegment(directory)
+        os.unlink(segment.path)
+        segment.remove()
+
+    def test_export_questions_as_ndjson(self):
+        res = self.client().get('/questions/export?category=5')
+        rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row['category'] == 5 for row in rows))
+
+    def test_export_questions_not_gzipped_when_refused(self):
+        for accept in ['gzip;q=0', 'br, gzip;q=0.0', 'identity']:
+            res = self.client().get('/questions/export?format=csv', headers={'Accept-Encoding': accept})
+
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('Content-Encoding', res.headers)
+            self.assertTrue(res.data.startswith(b'id,question,answer,difficulty,category'))
+
+    def test_export_questions_gzipped_csv(self):
+        res = self.client().get('/questions/export?format=csv', headers={'Accept-Encoding': 'gzip'})
+        lines = gzip.decompress(res.data).decode('utf-8').splitlines()
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(lines[0], 'id,question,answer,difficulty,category')
+
     def test_422_if_question_creation_not_allowed(self):
         res = self.client().post('/questions/add', json=self.bad_question)
         data = json.loads(res.data)
@@ -148,7 +631,160 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(data['question']))  
 
+    def test_post_quiz_exhausted(self):
+        res = self.client().post('/quizzes', json={'previous_questions':[2, 4, 6], 'quiz_category': {'id': 5}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['question'])
+
+    def test_quiz_session_serves_each_question_once(self):
+        res = self.client().post('/quizzes/sessions', json={'quiz_category': {'id': 5}})
+        session = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+
+        url = '/quizzes/sessions/{}/next'.format(session['session_id'])
+        served = [json.loads(self.client().post(url).data)['question']['id']
+                  for _ in range(session['total_questions'])]
+        self.assertEqual(len(set(served)), session['total_questions'])
+        self.assertIsNone(json.loads(self.client().post(url).data)['question'])
+
+    def test_quiz_session_serves_batches(self):
+        res = self.client().post('/quizzes/sessions', json={'quiz_category': {'id': 0}})
+        session = json.loads(res.data)
+        url = '/quizzes/sessions/{}/next'.format(session['session_id'])
+
+        first = json.loads(self.client().post(url, json={'count': 5}).data)['questions']
+        rest = json.loads(self.client().post(url, json={'count': 50}).data)['questions']
+        ids = [question['id'] for question in first + rest]
+
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(ids), session['total_questions'])
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(self.client().post(url, json={'count': 51}).status_code, 422)
+
+    def test_404_for_unknown_quiz_session(self):
+        res = self.client().post('/quizzes/sessions/unknown/next')
+
+        self.assertEqual(res.status_code, 404)
+
+    @unittest.skipUnless(importlib.util.find_spec('fakeredis'), 'fakeredis is not installed')
+    def test_redis_quiz_sessions_are_shared_by_workers(self):
+        import fakeredis
+        client = fakeredis.FakeStrictRedis()
+        first = RedisSessionStore(client, ttl=60)
+        second = RedisSessionStore(client, ttl=60)
+
+        session_id = first.create(5)
+        self.assertTrue(first.mark_served(session_id, 2))
+        self.assertFalse(second.mark_served(session_id, 2))
+        self.assertTrue(second.mark_served(session_id, 4))
+        self.assertEqual(first.get(session_id), (5, {2, 4}))
+        self.assertEqual(client.ttl(first.prefix + session_id + ':served'), 60)
+
+        second.discard(session_id)
+        with self.assertRaises(KeyError):
+            first.get(session_id)
+        with self.assertRaises(KeyError):
+            first.mark_served(session_id, 6)
+        self.assertFalse(client.exists(first.prefix + session_id + ':served'))
+
         
+    def test_target_difficulty_dominates_draws(self):
+        random.seed(17)
+        index = QuestionIdIndex()
+        index.load([(question_id, 1, question_id % 5 + 1) for question_id in range(1, 101)])
+        drawn = [index.choose(1, target=3) % 5 + 1 for _ in range(1000)]
+
+        # pools weigh 1, 0.25 and 0.0625 at 0, 1 and 2 steps from the target
+        self.assertGreater(drawn.count(3), 550)
+        self.assertGreater(min(drawn.count(2), drawn.count(4)),
+                           max(drawn.count(1), drawn.count(5)))
+
+    def test_post_quiz_batch(self):
+        res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 5},
+                                                   'count': 5})
+        data = json.loads(res.data)
+        ids = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(ids)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertTrue(all(question['category'] == 5 for question in data['questions']))
+        self.assertEqual(data['question'], data['questions'][0])
+
+    def test_422_for_quiz_batch_out_of_range(self):
+        for count in [0, 51, 'five', True]:
+            res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 5},
+                                                       'count': count})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422, count)
+            self.assertEqual(data['error'], 422)
+
+    def test_422_for_bad_quiz_difficulty(self):
+        for fields in [{'difficulty': 'hard'}, {'difficulty': 0}, {'difficulty': 2.5},
+                       {'ramp': 'yes'}, {'ramp': 1}]:
+            body = dict({'previous_questions': [], 'quiz_category': {'id': 5}}, **fields)
+            res = self.client().post('/quizzes', json=body)
+
+            self.assertEqual(res.status_code, 422, fields)
+
+    def test_check_quiz_answer_forgives_form_and_typos(self):
+        for question_id, guess, correct in [(20, 'liver', True),
+                                            (20, 'THE LIVER!', True),
+                                            (2, 'apolo 13', True),
+                                            (2, 'Apollo 12', False),
+                                            (2, 'Titanic', False)]:
+            res = self.client().post('/quizzes/answer', json={'question_id': question_id, 'answer': guess})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['correct'], correct, guess)
+
+    def test_check_quiz_answer_errors(self):
+        res = self.client().post('/quizzes/answer', json={'question_id': 100000, 'answer': 'x'})
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client().post('/quizzes/answer', json={'question_id': 2})
+        self.assertEqual(res.status_code, 422)
+
+    def test_percentile_is_nearest_rank(self):
+        ordered = list(range(1, 501))
+        self.assertEqual(percentile(ordered, 0.99), 495)
+        self.assertEqual(percentile(ordered, 0.5), 250)
+        self.assertEqual(percentile(list(range(1, 101)), 0.07), 7)
+
+    def test_fenwick_tree_finds_weighted_positions(self):
+        weights = [0.5, 0.0, 2.0, 1.0, 0.25]
+        tree = FenwickTree(weights)
+        tree.add(1, 1.0)
+        weights[1] = 1.0
+
+        self.assertAlmostEqual(tree.total(), sum(weights))
+        for value, position in [(0.0, 0), (0.6, 1), (1.5, 2), (3.49, 2), (3.5, 3), (4.6, 4)]:
+            self.assertEqual(tree.find(value), position)
+
+    def test_answer_distance_is_levenshtein(self):
+        compiled = CompiledAnswer('kitten')
+        self.assertEqual(compiled.distance('sitting', 5), 3)
+        self.assertEqual(compiled.distance('kitten', 0), 0)
+        self.assertEqual(compiled.distance('sitting', 1), 2)
+
+    def test_least_recently_served_questions_come_first(self):
+        random.seed(17)
+        index = QuestionIdIndex()
+        index.load([(1, 1, 1), (2, 1, 1)])
+        for _ in range(100):
+            index.mark_served(1)
+        for _ in range(60):
+            index.mark_served(2)
+        picks = [index.choose(1) for _ in range(500)]
+
+        # 1 was served more often, but 2 more recently
+        self.assertGreater(picks.count(1), picks.count(2))
+        self.assertIsNone(index.choose(1, exclude=[1, 2]))
+
     def test_post_failure_500_quiz(self):
         res = self.client().post('/quizzes', json={'previous_questions':[], 'quiz_category': '1'})
         data = json.loads(res.data)
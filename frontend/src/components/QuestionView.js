@@ -13,6 +13,8 @@ class QuestionView extends Component {
       totalQuestions: 0,
       categories: {},
       currentCategory: null,
+      // what the page buttons page through: all questions, a category or a search
+      listing: { kind: 'all' },
     };
   }
 
@@ -41,9 +43,22 @@ class QuestionView extends Component {
   };
 
   selectPage(num) {
-    this.setState({ page: num }, () => this.getQuestions());
+    const listing = this.state.listing;
+    this.setState({ page: num }, () => {
+      if (listing.kind === 'category') {
+        this.getByCategory(listing.id, num);
+      } else if (listing.kind === 'search') {
+        this.submitSearch(listing.searchTerm, num);
+      } else {
+        this.getQuestions();
+      }
+    });
   }
 
+  showAllQuestions = () => {
+    this.setState({ page: 1, listing: { kind: 'all' } }, () => this.getQuestions());
+  };
+
   createPagination() {
     let pageNumbers = [];
     let maxPage = Math.ceil(this.state.totalQuestions / 10);
@@ -63,15 +78,17 @@ class QuestionView extends Component {
     return pageNumbers;
   }
 
-  getByCategory = (id) => {
+  getByCategory = (id, page = 1) => {
     $.ajax({
-      url: `/categories/${id}/questions`, //TODO: update request URL
+      url: `/categories/${id}/questions?page=${page}`, //TODO: update request URL
       type: 'GET',
       success: (result) => {
         this.setState({
           questions: result.questions,
           totalQuestions: result.total_questions,
           currentCategory: result.current_category,
+          page: page,
+          listing: { kind: 'category', id: id },
         });
         return;
       },
@@ -82,13 +99,13 @@ class QuestionView extends Component {
     });
   };
 
-  submitSearch = (searchTerm) => {
+  submitSearch = (searchTerm, page = 1) => {
     $.ajax({
       url: `/questions`, //TODO: update request URL
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({ searchTerm: searchTerm }),
+      data: JSON.stringify({ searchTerm: searchTerm, page: page }),
       xhrFields: {
         withCredentials: true,
       },
@@ -96,8 +113,10 @@ class QuestionView extends Component {
       success: (result) => {
         this.setState({
           questions: result.questions,
-          totalQuestions: result.total_questions,
-          currentCategory: result.current_category,
+          totalQuestions: result.totalQuestions,
+          currentCategory: result.currentCategory,
+          page: page,
+          listing: { kind: 'search', searchTerm: searchTerm },
         });
         return;
       },
@@ -115,7 +134,7 @@ class QuestionView extends Component {
           url: `/questions/${id}`, //TODO: update request URL
           type: 'DELETE',
           success: (result) => {
-            this.getQuestions();
+            this.selectPage(this.state.page);
           },
           error: (error) => {
             alert('Unable to load questions. Please try your request again');
@@ -132,7 +151,7 @@ class QuestionView extends Component {
         <div className='categories-list'>
           <h2
             onClick={() => {
-              this.getQuestions();
+              this.showAllQuestions();
             }}
           >
             Categories
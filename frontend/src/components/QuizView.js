@@ -9,12 +9,14 @@ class QuizView extends Component {
     super();
     this.state = {
       quizCategory: null,
+      quizQuestions: [],
       previousQuestions: [],
       showAnswer: false,
       categories: {},
       numCorrect: 0,
       currentQuestion: {},
       guess: '',
+      correct: false,
       forceEnd: false,
     };
   }
@@ -35,7 +37,56 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    // the server keeps the played questions of a session, the first
+    // request of a session fetches the whole quiz at once
+    $.ajax({
+      url: '/quizzes/sessions',
+      type: 'POST',
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        quiz_category: { type, id },
+      }),
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (result) => {
+        this.fetchQuestions(result.session_id, { type, id });
+        return;
+      },
+      error: (error) => {
+        alert('Unable to start the quiz. Please try your request again');
+        return;
+      },
+    });
+  };
+
+  fetchQuestions = (sessionId, quizCategory) => {
+    $.ajax({
+      url: `/quizzes/sessions/${sessionId}/next`,
+      type: 'POST',
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        count: questionsPerPlay,
+      }),
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (result) => {
+        this.setState(
+          { quizCategory, quizQuestions: result.questions },
+          this.getNextQuestion
+        );
+        return;
+      },
+      error: (error) => {
+        alert('Unable to load questions. Please try your request again');
+        return;
+      },
+    });
   };
 
   handleChange = (event) => {
@@ -48,14 +99,28 @@ class QuizView extends Component {
       previousQuestions.push(this.state.currentQuestion.id);
     }
 
+    const [nextQuestion, ...quizQuestions] = this.state.quizQuestions;
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      quizQuestions: quizQuestions,
+      currentQuestion: nextQuestion || {},
+      guess: '',
+      forceEnd: nextQuestion ? false : true,
+    });
+  };
+
+  submitGuess = (event) => {
+    event.preventDefault();
+    // the server forgives case, accents, punctuation and small typos
     $.ajax({
-      url: '/quizzes', //TODO: update request URL
+      url: '/quizzes/answer',
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
       data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory,
+        question_id: this.state.currentQuestion.id,
+        answer: this.state.guess,
       }),
       xhrFields: {
         withCredentials: true,
@@ -63,33 +128,25 @@ class QuizView extends Component {
       crossDomain: true,
       success: (result) => {
         this.setState({
-          showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
-          guess: '',
-          forceEnd: result.question ? false : true,
+          numCorrect: result.correct
+            ? this.state.numCorrect + 1
+            : this.state.numCorrect,
+          correct: result.correct,
+          showAnswer: true,
         });
         return;
       },
       error: (error) => {
-        alert('Unable to load question. Please try your request again');
+        alert('Unable to check your answer. Please try your request again');
         return;
       },
     });
   };
 
-  submitGuess = (event) => {
-    event.preventDefault();
-    let evaluate = this.evaluateAnswer();
-    this.setState({
-      numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
-      showAnswer: true,
-    });
-  };
-
   restartGame = () => {
     this.setState({
       quizCategory: null,
+      quizQuestions: [],
       previousQuestions: [],
       showAnswer: false,
       numCorrect: 0,
@@ -139,19 +196,8 @@ class QuizView extends Component {
     );
   }
 
-  evaluateAnswer = () => {
-    const formatGuess = this.state.guess
-      // eslint-disable-next-line
-      .replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g, '')
-      .toLowerCase();
-    const answerArray = this.state.currentQuestion.answer
-      .toLowerCase()
-      .split(' ');
-    return answerArray.every((el) => formatGuess.includes(el));
-  };
-
   renderCorrectAnswer() {
-    let evaluate = this.evaluateAnswer();
+    const evaluate = this.state.correct;
     return (
       <div className='quiz-play-holder'>
         <div className='quiz-question'>
@@ -8,6 +8,8 @@ service postgresql start
 su - postgres bash -c "psql < /home/workspace/backend/setup-trivia.sql"
 su - postgres bash -c "psql trivia < /home/workspace/backend/trivia.psql"
 
+# bring the schema up to date, workers no longer migrate on startup
+(cd /home/workspace/backend && FLASK_APP=flaskr flask migrate && FLASK_APP=flaskr flask index-duplicates)
 
 # setup and populate the testing database
 su - postgres bash -c "psql < /home/workspace/backend/setup-test.sql"